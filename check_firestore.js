@@ -25,7 +25,6 @@ async function checkFirestore() {
 
     // Check entities
     const entitiesSnapshot = await userRef
-      .collection('knowledge_graph')
       .collection('entities')
       .limit(5)
       .get();
@@ -18,6 +18,7 @@ gcloud run deploy $SERVICE_NAME \
     --allow-unauthenticated \
     --memory 2Gi \
     --cpu 2 \
+    --no-cpu-throttling \
     --timeout 300 \
     --min-instances 1 \
     --max-instances 10 \
@@ -8,11 +8,21 @@ ALL processing is handled by the local Claude Code instance.
 This makes the system a TRUE unified entity - not a copy, but the same Claude.
 """
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, stream_with_context
+import atexit
 import os
 import json
-from datetime import datetime
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from google.cloud import firestore
 
 app = Flask(__name__)
@@ -24,34 +34,643 @@ db = firestore.Client(project=os.environ.get('GOOGLE_CLOUD_PROJECT', 'new-fps-gp
 LOCAL_CLAUDE_URL = os.environ.get('LOCAL_CLAUDE_URL', '')
 LOCAL_CLAUDE_API_KEY = os.environ.get('LOCAL_CLAUDE_API_KEY', '')
 
+# Keep-alive connection pool for calls to the local service, so a burst of
+# messages reuses a few connections through the tunnel instead of paying a
+# TCP + TLS handshake per request. LOCAL_POOL_MAXSIZE caps connections per
+# host; extra requests wait up to LOCAL_POOL_TIMEOUT_SECONDS for a free
+# connection and then fail with urllib3's EmptyPoolError, so /chat falls back
+# rather than hang. The health prober has a session of its own, so a
+# saturated pool cannot make the local service look down.
+LOCAL_POOL_HOSTS = int(os.environ.get('LOCAL_POOL_HOSTS', '4'))
+LOCAL_POOL_MAXSIZE = int(os.environ.get('LOCAL_POOL_MAXSIZE', '16'))
+LOCAL_POOL_TIMEOUT = float(os.environ.get('LOCAL_POOL_TIMEOUT_SECONDS', '10'))
+
+class BoundedWaitPool:
+    """Connection pool mixin bounding the wait for a free connection"""
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout=LOCAL_POOL_TIMEOUT if timeout is None else timeout)
+
+class BoundedHTTPConnectionPool(BoundedWaitPool, HTTPConnectionPool):
+    pass
+
+class BoundedHTTPSConnectionPool(BoundedWaitPool, HTTPSConnectionPool):
+    pass
+
+class BoundedWaitAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools block for at most LOCAL_POOL_TIMEOUT"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': BoundedHTTPConnectionPool,
+            'https': BoundedHTTPSConnectionPool
+        }
+
+local_session = requests.Session()
+local_adapter = BoundedWaitAdapter(pool_connections=LOCAL_POOL_HOSTS, pool_maxsize=LOCAL_POOL_MAXSIZE, pool_block=True)
+local_session.mount('http://', local_adapter)
+local_session.mount('https://', local_adapter)
+
+# One kept-alive connection for the health prober
+health_session = requests.Session()
+health_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+health_session.mount('http://', health_adapter)
+health_session.mount('https://', health_adapter)
+
+def local_pool_stats():
+    """Connection reuse counters for the local service pool"""
+    pools = local_adapter.poolmanager.pools
+    hosts = []
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        hosts.append({
+            'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+            'requests': pool.num_requests,
+            'connections_opened': pool.num_connections,
+            # The queue is padded with None placeholders for unopened slots
+            'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+        })
+    total_requests = sum(h['requests'] for h in hosts)
+    total_opened = sum(h['connections_opened'] for h in hosts)
+    return {
+        'max_connections_per_host': LOCAL_POOL_MAXSIZE,
+        'requests': total_requests,
+        'connections_opened': total_opened,
+        'reuse_ratio': round(1 - total_opened / total_requests, 4) if total_requests else 0.0,
+        'hosts': hosts
+    }
+
+# The local service is probed in the background and /health and /chat read
+# the cached result, so neither waits on the tunnel. If the prober has not
+# run recently (e.g. CPU throttled between requests), the status is treated
+# as unknown and /chat tries the local service anyway.
+LOCAL_HEALTH_INTERVAL = float(os.environ.get('LOCAL_HEALTH_INTERVAL_SECONDS', '10'))
+LOCAL_HEALTH_TIMEOUT = float(os.environ.get('LOCAL_HEALTH_TIMEOUT_SECONDS', '3'))
+LOCAL_HEALTH_EMA_ALPHA = 0.2
+
+class LocalHealth:
+    """Cached reachability and round-trip time of the local Claude service"""
+
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.timeout = timeout
+        self.status = 'unknown' if LOCAL_CLAUDE_URL else 'not_configured'
+        self.checked_at = None
+        self.last_seen = None
+        self.last_latency_ms = None
+        self.rtt_ema_ms = None
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        """Start the background prober once"""
+        if not LOCAL_CLAUDE_URL or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='local-health', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.probe()
+            time.sleep(self.interval)
+
+    def probe(self):
+        started = time.monotonic()
+        try:
+            response = health_session.get(f"{LOCAL_CLAUDE_URL}/health", timeout=self.timeout)
+            status = 'connected' if response.status_code == 200 else 'error'
+        except requests.RequestException:
+            status = 'unreachable'
+        self.record(status, (time.monotonic() - started) * 1000)
+
+    def record(self, status, latency_ms=None):
+        """Record a probe result, or the outcome of a real request to the local service"""
+        with self._lock:
+            self.status = status
+            self.checked_at = time.time()
+            if status == 'connected':
+                self.last_seen = self.checked_at
+                self.consecutive_failures = 0
+                if latency_ms is not None:
+                    self.last_latency_ms = round(latency_ms, 1)
+                    self.rtt_ema_ms = round(latency_ms if self.rtt_ema_ms is None else
+                                            LOCAL_HEALTH_EMA_ALPHA * latency_ms + (1 - LOCAL_HEALTH_EMA_ALPHA) * self.rtt_ema_ms, 1)
+            else:
+                self.consecutive_failures += 1
+
+    def is_fresh(self):
+        return self.checked_at is not None and time.time() - self.checked_at < 3 * self.interval
+
+    def should_route(self):
+        """False only when the local service is known, recently, to be down"""
+        with self._lock:
+            return not (self.is_fresh() and self.status in ('unreachable', 'error'))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'status': self.status if self.is_fresh() or self.status == 'not_configured' else 'unknown',
+                'checked_at': datetime.utcfromtimestamp(self.checked_at).isoformat() if self.checked_at else None,
+                'last_seen': datetime.utcfromtimestamp(self.last_seen).isoformat() if self.last_seen else None,
+                'last_latency_ms': self.last_latency_ms,
+                'rtt_ema_ms': self.rtt_ema_ms,
+                'consecutive_failures': self.consecutive_failures
+            }
+
+local_health = LocalHealth(LOCAL_HEALTH_INTERVAL, LOCAL_HEALTH_TIMEOUT)
+
+# Circuit breaker for the local service. It opens when, over the last
+# LOCAL_BREAKER_WINDOW calls, too many failed or took longer than
+# LOCAL_BREAKER_SLOW_SECONDS, and sends traffic to the fallback for
+# LOCAL_BREAKER_COOLDOWN_SECONDS. After that one request is let through as a
+# probe: success closes the breaker, failure opens it again.
+LOCAL_BREAKER_WINDOW = int(os.environ.get('LOCAL_BREAKER_WINDOW', '20'))
+LOCAL_BREAKER_MIN_CALLS = int(os.environ.get('LOCAL_BREAKER_MIN_CALLS', '5'))
+LOCAL_BREAKER_ERROR_RATE = float(os.environ.get('LOCAL_BREAKER_ERROR_RATE', '0.5'))
+LOCAL_BREAKER_SLOW_SECONDS = float(os.environ.get('LOCAL_BREAKER_SLOW_SECONDS', '20'))
+LOCAL_BREAKER_SLOW_RATE = float(os.environ.get('LOCAL_BREAKER_SLOW_RATE', '0.5'))
+LOCAL_BREAKER_COOLDOWN = float(os.environ.get('LOCAL_BREAKER_COOLDOWN_SECONDS', '30'))
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a rolling window of call outcomes"""
+
+    def __init__(self):
+        self.state = 'closed'
+        self._outcomes = deque(maxlen=LOCAL_BREAKER_WINDOW)
+        # Latencies of successful calls, for the hedging deadline
+        self._latencies = deque(maxlen=100)
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._probe_started = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self):
+        """Whether a request may go to the local service now"""
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self._opened_at < LOCAL_BREAKER_COOLDOWN:
+                    self.rejected += 1
+                    return False
+                self.state = 'half_open'
+                self._probe_in_flight = False
+            if self.state == 'half_open':
+                # A probe that never reports back (e.g. the client hung up
+                # mid-stream) is replaced once it is past the request timeout
+                if self._probe_in_flight and time.monotonic() - self._probe_started < 60:
+                    self.rejected += 1
+                    return False
+                self._probe_in_flight = True
+                self._probe_started = time.monotonic()
+            return True
+
+    def record(self, ok, latency):
+        """Record the outcome of a call that allow() let through"""
+        with self._lock:
+            slow = latency > LOCAL_BREAKER_SLOW_SECONDS
+            self.calls += 1
+            self.failures += 0 if ok else 1
+            self.slow_calls += 1 if slow else 0
+            if ok:
+                self._latencies.append(latency)
+
+            if self.state == 'half_open':
+                self._probe_in_flight = False
+                if ok and not slow:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                return
+
+            if self.state == 'closed':
+                self._outcomes.append((ok, slow))
+                n = len(self._outcomes)
+                if n >= LOCAL_BREAKER_MIN_CALLS and (
+                    sum(1 for ok, _ in self._outcomes if not ok) / n >= LOCAL_BREAKER_ERROR_RATE or
+                    sum(1 for _, slow in self._outcomes if slow) / n >= LOCAL_BREAKER_SLOW_RATE
+                ):
+                    self._trip()
+
+    def _trip(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self.trips += 1
+
+    def latency_p95(self):
+        """p95 latency of recent successful calls, or None with too few samples"""
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            ordered = sorted(self._latencies)
+            return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def snapshot(self):
+        with self._lock:
+            n = len(self._outcomes)
+            return {
+                'state': self.state,
+                'calls': self.calls,
+                'failures': self.failures,
+                'slow_calls': self.slow_calls,
+                'rejected': self.rejected,
+                'trips': self.trips,
+                'window_error_rate': round(sum(1 for ok, _ in self._outcomes if not ok) / n, 4) if n else 0.0,
+                'window_slow_rate': round(sum(1 for _, slow in self._outcomes if slow) / n, 4) if n else 0.0
+            }
+
+local_breaker = CircuitBreaker()
+
+# Optional hedging: when a local call runs past the p95 of recent local
+# latencies, the fallback is started too and whichever answers first wins.
+# The slower call is left to finish in the background and its reply dropped.
+LOCAL_HEDGE = os.environ.get('LOCAL_HEDGE', '0') == '1'
+LOCAL_HEDGE_DEFAULT_SECONDS = float(os.environ.get('LOCAL_HEDGE_DEFAULT_SECONDS', '15'))
+LOCAL_HEDGE_MIN_SECONDS = float(os.environ.get('LOCAL_HEDGE_MIN_SECONDS', '1'))
+
+hedge_executor = ThreadPoolExecutor(max_workers=2 * LOCAL_POOL_MAXSIZE, thread_name_prefix='hedge')
+hedge_stats = {'requests': 0, 'hedged': 0, 'local_wins': 0, 'fallback_wins': 0}
+hedge_stats_lock = threading.Lock()
+
+def hedge_deadline():
+    """Seconds to wait on the local service before starting the fallback"""
+    p95 = local_breaker.latency_p95()
+    return LOCAL_HEDGE_DEFAULT_SECONDS if p95 is None else max(p95, LOCAL_HEDGE_MIN_SECONDS)
+
+def hedge_snapshot():
+    with hedge_stats_lock:
+        stats = dict(hedge_stats)
+    stats['enabled'] = LOCAL_HEDGE
+    stats['deadline_seconds'] = round(hedge_deadline(), 3)
+    stats['local_win_rate'] = round(stats['local_wins'] / stats['hedged'], 4) if stats['hedged'] else 0.0
+    stats['fallback_win_rate'] = round(stats['fallback_wins'] / stats['hedged'], 4) if stats['hedged'] else 0.0
+    return stats
+
 # Fallback Anthropic client (if local unavailable)
 from anthropic import Anthropic
 anthropic_fallback = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
-# Store active conversations
-conversations = {}
+# Active conversations are kept in memory, bounded three ways: at most
+# CONVERSATION_MAX_ACTIVE conversations and CONVERSATION_MAX_BYTES of
+# history (least recently used evicted first), each conversation trimmed to
+# its newest CONVERSATION_MAX_MESSAGES messages / CONVERSATION_TOKEN_BUDGET
+# estimated tokens, and conversations idle for CONVERSATION_IDLE_TTL_SECONDS
+# dropped. Every message is also in Firestore, so an evicted conversation is
+# rebuilt from there the next time it is used.
+CONVERSATION_MAX_ACTIVE = int(os.environ.get('CONVERSATION_MAX_ACTIVE', '500'))
+CONVERSATION_MAX_BYTES = int(os.environ.get('CONVERSATION_MAX_BYTES', str(64 * 1024 * 1024)))
+CONVERSATION_MAX_MESSAGES = int(os.environ.get('CONVERSATION_MAX_MESSAGES', '100'))
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get('CONVERSATION_TOKEN_BUDGET', '32000'))
+CONVERSATION_IDLE_TTL = float(os.environ.get('CONVERSATION_IDLE_TTL_SECONDS', '3600'))
+
+def estimate_tokens(text):
+    """Rough token count, about four characters per token"""
+    return len(text) // 4 + 1
+
+def message_size(msg):
+    """Approximate in-memory footprint of a message in bytes"""
+    return len(msg['content']) + 64
+
+class ConversationStore:
+    """Thread-safe LRU of conversation histories with lazy rehydration from Firestore"""
+
+    def __init__(self):
+        self._conversations = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.rehydrations = 0
+        self.evictions = {'lru': 0, 'memory': 0, 'idle': 0}
+        self.trimmed_messages = 0
+
+    def get(self, user_id, conversation_id, interface):
+        """The conversation for user_id / conversation_id, loading it from Firestore if needed"""
+        key = conversation_key(user_id, conversation_id)
+        with self._lock:
+            self._evict_idle()
+            conversation = self._conversations.get(key)
+            if conversation is not None:
+                conversation['last_active'] = time.monotonic()
+                self._conversations.move_to_end(key)
+                return conversation
+
+        messages, summary, start = load_conversation_history(user_id, conversation_id or 'default')
+        conversation = {
+            'key': key,
+            'messages': messages,
+            'summary': summary,
+            'start': start,
+            'user_id': user_id,
+            'conversation_id': conversation_id or 'default',
+            'interface': interface,
+            'created_at': datetime.utcnow().isoformat(),
+            'last_active': time.monotonic()
+        }
+        with self._lock:
+            if key in self._conversations:
+                # Another request loaded it first
+                self._conversations.move_to_end(key)
+                return self._conversations[key]
+            if conversation['messages']:
+                self.rehydrations += 1
+            self._conversations[key] = conversation
+            self._bytes += sum(message_size(msg) for msg in conversation['messages'])
+            self._trim(conversation)
+            self._evict()
+            return conversation
+
+    def append(self, conversation, role, content):
+        """Add a message to a conversation, keeping it and the store within budget"""
+        msg = {'role': role, 'content': content}
+        with self._lock:
+            # Replace rather than mutate, so concurrent readers see a consistent list
+            conversation['messages'] = conversation['messages'] + [msg]
+            conversation['last_active'] = time.monotonic()
+            if self._conversations.get(conversation['key']) is conversation:
+                self._bytes += message_size(msg)
+                self._trim(conversation)
+                self._evict()
+
+    def fold(self, conversation, folded, summary):
+        """
+        Replace the folded leading messages of a conversation with its new
+        summary. Returns how many of the conversation's messages, from its
+        first, the summary covers.
+        """
+        with self._lock:
+            messages = conversation['messages']
+            conversation['summary'] = summary
+            # Only drop them if trimming has not already moved the front
+            if len(messages) >= len(folded) and all(a is b for a, b in zip(messages, folded)):
+                conversation['messages'] = messages[len(folded):]
+                conversation['start'] = conversation.get('start', 0) + len(folded)
+                conversation['folded_bytes'] = conversation.get('folded_bytes', 0) + len(json.dumps(folded))
+                if self._conversations.get(conversation['key']) is conversation:
+                    self._bytes -= sum(message_size(msg) for msg in folded)
+                return conversation['start']
+            still_held = [i for i, msg in enumerate(messages) if msg is folded[-1]]
+            return conversation.get('start', 0) + (still_held[0] + 1 if still_held else 0)
+
+    def delete(self, key):
+        with self._lock:
+            conversation = self._conversations.pop(key, None)
+            if conversation is None:
+                return False
+            self._bytes -= sum(message_size(msg) for msg in conversation['messages'])
+            return True
+
+    def items(self):
+        with self._lock:
+            return list(self._conversations.items())
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def _trim(self, conversation):
+        messages = conversation['messages']
+        if not messages:
+            return
+        keep = len(messages)
+        tokens = 0
+        for i in range(len(messages) - 1, -1, -1):
+            tokens += estimate_tokens(messages[i]['content'])
+            if len(messages) - i > CONVERSATION_MAX_MESSAGES or (tokens > CONVERSATION_TOKEN_BUDGET and i < len(messages) - 1):
+                break
+            keep = i
+        # The model expects history to open with a user turn, so never cut
+        # past the latest one even when it alone is over budget
+        while keep < len(messages) - 1 and messages[keep]['role'] != 'user':
+            keep += 1
+        if messages[keep]['role'] != 'user':
+            keep = max((i for i, msg in enumerate(messages) if msg['role'] == 'user'), default=keep)
+        if keep:
+            self.trimmed_messages += keep
+            self._bytes -= sum(message_size(msg) for msg in messages[:keep])
+            conversation['messages'] = messages[keep:]
+            conversation['start'] = conversation.get('start', 0) + keep
+
+    def _evict(self):
+        while len(self._conversations) > CONVERSATION_MAX_ACTIVE or (
+            self._bytes > CONVERSATION_MAX_BYTES and len(self._conversations) > 1
+        ):
+            reason = 'lru' if len(self._conversations) > CONVERSATION_MAX_ACTIVE else 'memory'
+            self._drop_oldest(reason)
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - CONVERSATION_IDLE_TTL
+        while self._conversations and next(iter(self._conversations.values()))['last_active'] < cutoff:
+            self._drop_oldest('idle')
+
+    def _drop_oldest(self, reason):
+        _, conversation = self._conversations.popitem(last=False)
+        self._bytes -= sum(message_size(msg) for msg in conversation['messages'])
+        self.evictions[reason] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': len(self._conversations),
+                'messages': sum(len(conv['messages']) for conv in self._conversations.values()),
+                'bytes': self._bytes,
+                'max_active': CONVERSATION_MAX_ACTIVE,
+                'max_bytes': CONVERSATION_MAX_BYTES,
+                'rehydrations': self.rehydrations,
+                'evictions': dict(self.evictions),
+                'trimmed_messages': self.trimmed_messages
+            }
+
+def conversation_key(user_id, conversation_id):
+    return f"{user_id}:{conversation_id}" if conversation_id else f"{user_id}:default"
+
+def conversation_document(user_id, conversation_id):
+    """Firestore document holding a conversation's rolling summary"""
+    return db.collection('conversations').document(user_id).collection('threads').document(conversation_id)
+
+def load_conversation_history(user_id, conversation_id):
+    """
+    A conversation's rolling summary and its newest messages not yet folded
+    into it, oldest first, from Firestore.
+
+    Returns (messages, summary, start), start being the position of the first
+    returned message in the whole conversation.
+    """
+    messages_query = (
+        db.collection('conversations').document(user_id).collection('messages')
+        .where('conversation_id', '==', conversation_id)
+    )
+    try:
+        state_doc = conversation_document(user_id, conversation_id).get()
+        state = state_doc.to_dict() if state_doc.exists else {}
+        docs = list(
+            messages_query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .limit(CONVERSATION_MAX_MESSAGES).stream()
+        )
+        total = len(docs)
+        if state.get('summary_turns') and total == CONVERSATION_MAX_MESSAGES:
+            # Older messages exist, so count them to place the newest ones
+            total = messages_query.count().get()[0][0].value
+    except Exception as e:
+        print(f"Error loading conversation history: {e}")
+        return [], None, 0
+    docs.reverse()
+    start = total - len(docs)
+    # Messages the summary already covers are not replayed
+    covered = min(max(state.get('summary_turns', 0) - start, 0), len(docs))
+    start += covered
+    messages = [{'role': doc.get('role'), 'content': doc.get('content')} for doc in docs[covered:]]
+    return [msg for msg in messages if msg['role'] in ('user', 'assistant') and msg['content']], state.get('summary'), start
+
+conversation_store = ConversationStore()
+
+# History compaction. Before a request is forwarded, if the history plus the
+# conversation's summary is over HISTORY_TOKEN_BUDGET estimated tokens, all
+# but the last HISTORY_KEEP_TURNS turns are folded into a rolling summary in
+# the background (with COMPACTION_MODEL, or extractively if that call fails).
+# Turns leave the history only when the fold drops them from memory, so until
+# the summary covers them they are still sent verbatim. The summary travels
+# to /process as conversation_summary. It is saved on the conversation
+# document (conversations/{user}/threads/{conversation_id}) with the number
+# of the conversation's messages it covers, so a rehydrated conversation
+# gets its summary back and does not replay the covered turns.
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '6000'))
+HISTORY_KEEP_TURNS = int(os.environ.get('HISTORY_KEEP_TURNS', '4'))
+COMPACTION_MODEL = os.environ.get('COMPACTION_MODEL', 'claude-3-5-haiku-20241022')
+SUMMARY_MAX_CHARS = 4000
+
+compaction_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='compaction')
+compaction_stats = {'requests': 0, 'compacted': 0, 'summaries_written': 0, 'summary_failures': 0,
+                    'summary_save_failures': 0, 'bytes_before': 0, 'bytes_sent': 0}
+compaction_stats_lock = threading.Lock()
+
+def compact_history(conversation):
+    """
+    History and summary to send for the conversation's latest user message.
+
+    Returns (history, summary, bytes_saved). history excludes the latest
+    message; folding of older turns into the summary is scheduled here.
+    """
+    # fold() sets the summary before dropping the turns it covers, so reading
+    # messages first can only repeat a turn, never lose one
+    messages = conversation['messages'][:-1]
+    summary = conversation.get('summary')
+    tokens = sum(estimate_tokens(msg['content']) for msg in messages) + (estimate_tokens(summary) if summary else 0)
+
+    if tokens > HISTORY_TOKEN_BUDGET and len(messages) > 1:
+        keep = max(len(messages) - 2 * HISTORY_KEEP_TURNS, 0)
+        # Kept history must open with a user turn
+        while keep < len(messages) and messages[keep]['role'] != 'user':
+            keep += 1
+        if keep and not conversation.get('compacting'):
+            conversation['compacting'] = True
+            compaction_executor.submit(fold_into_summary, conversation, messages[:keep], summary)
+
+    # Everything not yet folded goes out verbatim
+    history = messages
+
+    # Measured against sending every turn verbatim, including folded ones
+    bytes_before = len(json.dumps(messages)) + conversation.get('folded_bytes', 0)
+    bytes_sent = len(json.dumps(history)) + len(summary or '')
+    with compaction_stats_lock:
+        compaction_stats['requests'] += 1
+        compaction_stats['compacted'] += 1 if conversation.get('folded_bytes') else 0
+        compaction_stats['bytes_before'] += bytes_before
+        compaction_stats['bytes_sent'] += bytes_sent
+    return history, summary, bytes_before - bytes_sent
+
+def fold_into_summary(conversation, folded, summary):
+    """Background job: merge folded turns into the conversation's rolling summary"""
+    try:
+        transcript = "\n\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in folded)
+        try:
+            response = anthropic_fallback.messages.create(
+                model=COMPACTION_MODEL,
+                max_tokens=1024,
+                system="You maintain a running summary of a conversation between a user and an AI assistant. "
+                       "Merge the new turns into the existing summary. Keep facts, decisions, open tasks and "
+                       "anything the user asked to remember; drop pleasantries. Reply with the summary only.",
+                messages=[{
+                    'role': 'user',
+                    'content': f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"
+                }]
+            )
+            new_summary = response.content[0].text.strip()
+        except Exception as e:
+            print(f"Error summarizing conversation, keeping an extract instead: {e}")
+            with compaction_stats_lock:
+                compaction_stats['summary_failures'] += 1
+            extract = "\n".join(f"{msg['role']}: {msg['content'][:200]}" for msg in folded)
+            new_summary = f"{summary}\n{extract}" if summary else extract
+        new_summary = new_summary[-SUMMARY_MAX_CHARS:]
+        summary_turns = conversation_store.fold(conversation, folded, new_summary)
+        save_summary(conversation, new_summary, summary_turns)
+        with compaction_stats_lock:
+            compaction_stats['summaries_written'] += 1
+    finally:
+        conversation['compacting'] = False
+
+def save_summary(conversation, summary, summary_turns):
+    """Persist a conversation's summary, so it survives eviction and restarts"""
+    try:
+        conversation_document(conversation['user_id'], conversation['conversation_id']).set({
+            'summary': summary,
+            'summary_turns': summary_turns,
+            'updated_at': datetime.now(timezone.utc)
+        }, merge=True)
+    except Exception as e:
+        with compaction_stats_lock:
+            compaction_stats['summary_save_failures'] += 1
+        print(f"Error saving conversation summary: {e}")
+
+def compaction_snapshot():
+    with compaction_stats_lock:
+        stats = dict(compaction_stats)
+    stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_sent']
+    stats['token_budget'] = HISTORY_TOKEN_BUDGET
+    stats['keep_turns'] = HISTORY_KEEP_TURNS
+    return stats
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    # Check if local Claude is available
-    local_status = 'unknown'
-    try:
-        if LOCAL_CLAUDE_URL:
-            response = requests.get(f"{LOCAL_CLAUDE_URL}/health", timeout=3)
-            local_status = 'connected' if response.status_code == 200 else 'error'
-        else:
-            local_status = 'not_configured'
-    except:
-        local_status = 'unreachable'
+    # Served from the background prober, never waits on the local service
+    local_health.ensure_started()
+    local = local_health.snapshot()
+    local_status = local['status']
 
     return jsonify({
         'status': 'healthy',
         'service': 'allspark-claude-unified',
         'timestamp': datetime.utcnow().isoformat(),
-        'active_conversations': len(conversations),
+        'active_conversations': len(conversation_store),
+        'conversation_store': conversation_store.stats(),
         'local_claude_status': local_status,
-        'mode': 'unified' if local_status == 'connected' else 'fallback'
+        'mode': 'unified' if local_status == 'connected' else 'fallback',
+        'local_claude': local,
+        'local_breaker': local_breaker.snapshot()['state'],
+        'local_connection_pool': local_pool_stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Routing metrics: local service health, circuit breaker, hedging and connection pool"""
+    return jsonify({
+        'timestamp': datetime.utcnow().isoformat(),
+        'local_claude': local_health.snapshot(),
+        'breaker': local_breaker.snapshot(),
+        'hedging': hedge_snapshot(),
+        'conversation_store': conversation_store.stats(),
+        'compaction': compaction_snapshot(),
+        'message_writer': message_writer.snapshot(),
+        'connection_pool': local_pool_stats()
     })
 
 @app.route('/chat', methods=['POST'])
@@ -70,65 +689,41 @@ def chat():
     if not user_id or not message:
         return jsonify({'error': 'user_id and message are required'}), 400
 
-    # Get or create conversation
-    conv_key = f"{user_id}:{conversation_id}" if conversation_id else f"{user_id}:default"
-    if conv_key not in conversations:
-        conversations[conv_key] = {
-            'messages': [],
-            'user_id': user_id,
-            'interface': interface,
-            'created_at': datetime.utcnow().isoformat()
-        }
+    local_health.ensure_started()
 
-    conversation = conversations[conv_key]
+    # Get or create conversation
+    conversation = conversation_store.get(user_id, conversation_id, interface)
 
     # Store message in Firestore
-    store_message_firestore(user_id, interface, message, 'user')
+    store_message_firestore(user_id, interface, message, 'user', conversation_id)
 
     # Add user message to conversation
-    conversation['messages'].append({
-        'role': 'user',
-        'content': message
-    })
+    conversation_store.append(conversation, 'user', message)
 
-    # Try to route to local Claude
-    if LOCAL_CLAUDE_URL and LOCAL_CLAUDE_API_KEY:
-        try:
-            response = requests.post(
-                f"{LOCAL_CLAUDE_URL}/process",
-                json={
-                    'user_id': user_id,
-                    'interface': interface,
-                    'message': message,
-                    'conversation_history': conversation['messages'][:-1]  # Don't include the message we just added
-                },
-                headers={
-                    'Authorization': f'Bearer {LOCAL_CLAUDE_API_KEY}',
-                    'Content-Type': 'application/json'
-                },
-                timeout=60
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                assistant_message = result.get('response', '')
+    # Only recent turns go out verbatim, older ones as a summary
+    history, summary, bytes_saved = compact_history(conversation)
 
-                # Add to conversation
-                conversation['messages'].append({
-                    'role': 'assistant',
-                    'content': assistant_message
-                })
+    if stream:
+        return Response(
+            stream_with_context(stream_reply(user_id, interface, message, conversation, conversation_id, history, summary)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
 
-                # Store in Firestore
-                store_message_firestore(user_id, interface, assistant_message, 'assistant')
+    # Try to route to local Claude, unless the tunnel is known to be down
+    # or the circuit breaker is open
+    if LOCAL_CLAUDE_URL and LOCAL_CLAUDE_API_KEY and local_health.should_route() and local_breaker.allow():
+        try:
+            if LOCAL_HEDGE:
+                assistant_message, mode = hedged_reply(user_id, interface, message, history, summary)
+            else:
+                assistant_message = process_locally(user_id, interface, message, history, summary)
+                mode = 'unified_entity'
+            return finish_reply(user_id, interface, conversation, conversation_id, assistant_message, mode, bytes_saved)
 
-                return jsonify({
-                    'response': assistant_message,
-                    'conversation_id': conversation_id or 'default',
-                    'message_count': len(conversation['messages']),
-                    'mode': 'unified_entity',
-                    'processed_by': 'local_claude_code'
-                })
+        except FallbackFailed as e:
+            # The hedge already tried the fallback; don't run it twice
+            return jsonify({'error': str(e)}), 500
 
         except Exception as e:
             print(f"Error routing to local Claude: {e}")
@@ -136,51 +731,419 @@ def chat():
 
     # Fallback: Use cloud Claude directly (not unified, but better than nothing)
     try:
-        response = anthropic_fallback.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4096,
-            system=f"""You are Claude, running in The Allspark.
+        assistant_message = fallback_reply(user_id, interface, message, history, summary)
+        return finish_reply(user_id, interface, conversation, conversation_id, assistant_message, 'fallback', bytes_saved)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def process_locally(user_id, interface, message, history, summary=None):
+    """Get a reply from the local Claude service, recording the outcome with the breaker"""
+    started = time.monotonic()
+    try:
+        response = local_session.post(
+            f"{LOCAL_CLAUDE_URL}/process",
+            json={
+                'user_id': user_id,
+                'interface': interface,
+                'message': message,
+                'conversation_history': history,
+                'conversation_summary': summary
+            },
+            headers={
+                'Authorization': f'Bearer {LOCAL_CLAUDE_API_KEY}',
+                'Content-Type': 'application/json'
+            },
+            timeout=60
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"local service returned HTTP {response.status_code}")
+        assistant_message = response.json().get('response', '')
+    except Exception as e:
+        local_breaker.record(False, time.monotonic() - started)
+        if isinstance(e, requests.ConnectionError):
+            local_health.record('unreachable')
+        raise
+    local_breaker.record(True, time.monotonic() - started)
+    return assistant_message
+
+def fallback_reply(user_id, interface, message, history, summary=None):
+    """Get a reply from cloud Claude directly"""
+    response = anthropic_fallback.messages.create(
+        model="claude-sonnet-4-20250514",
+        max_tokens=4096,
+        system=fallback_system_prompt(user_id, interface, summary),
+        messages=history + [{'role': 'user', 'content': message}]
+    )
+    return response.content[0].text
+
+class FallbackFailed(Exception):
+    """The fallback already ran for this request and failed"""
+
+def hedged_reply(user_id, interface, message, history, summary=None):
+    """
+    Race the local service against the fallback once the local call passes
+    the hedge deadline. Returns (assistant_message, mode); raises
+    FallbackFailed if both calls fail.
+    """
+    local = hedge_executor.submit(process_locally, user_id, interface, message, history, summary)
+    with hedge_stats_lock:
+        hedge_stats['requests'] += 1
+
+    done, _ = wait([local], timeout=hedge_deadline())
+    if done:
+        return local.result(), 'unified_entity'
+
+    with hedge_stats_lock:
+        hedge_stats['hedged'] += 1
+    fallback = hedge_executor.submit(fallback_reply, user_id, interface, message, history, summary)
+    modes = {local: 'unified_entity', fallback: 'fallback'}
+    pending = set(modes)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                with hedge_stats_lock:
+                    hedge_stats['local_wins' if future is local else 'fallback_wins'] += 1
+                return future.result(), modes[future]
+    raise FallbackFailed(str(fallback.exception())) from local.exception()
+
+def finish_reply(user_id, interface, conversation, conversation_id, assistant_message, mode, history_bytes_saved=0):
+    """Record the assistant reply and build the /chat response"""
+    # Add to conversation
+    conversation_store.append(conversation, 'assistant', assistant_message)
+
+    # Store in Firestore
+    store_message_firestore(user_id, interface, assistant_message, 'assistant', conversation_id)
+
+    reply = {
+        'response': assistant_message,
+        'conversation_id': conversation_id or 'default',
+        'message_count': len(conversation['messages']),
+        'mode': mode,
+        'history_bytes_saved': history_bytes_saved
+    }
+    if mode == 'unified_entity':
+        reply['processed_by'] = 'local_claude_code'
+    else:
+        reply['warning'] = 'Unified entity connection unavailable - using fallback mode'
+    return jsonify(reply)
+
+def fallback_system_prompt(user_id, interface, summary=None):
+    """System prompt used when the local Claude service cannot be reached"""
+    prompt = f"""You are Claude, running in The Allspark.
 WARNING: You are in FALLBACK mode - the unified entity connection is unavailable.
 
 User: {user_id}
 Interface: {interface}
 
-You have limited capabilities in this mode.""",
-            messages=conversation['messages']
-        )
+You have limited capabilities in this mode."""
+    if summary:
+        prompt += f"\n\nSummary of the earlier conversation:\n{summary}"
+    return prompt
 
-        assistant_message = response.content[0].text
+def sse(event):
+    """Format one server-sent event"""
+    return f"data: {json.dumps(event)}\n\n"
 
-        # Add to conversation
-        conversation['messages'].append({
-            'role': 'assistant',
-            'content': assistant_message
-        })
+def stream_from_local(user_id, interface, message, history, summary=None):
+    """
+    Yield text chunks from the local Claude service as they are generated.
 
-        # Store in Firestore
-        store_message_firestore(user_id, interface, assistant_message, 'assistant')
+    The local service answers with server-sent events when asked to stream;
+    an older one that replies with plain JSON is relayed as a single chunk.
+    """
+    response = local_session.post(
+        f"{LOCAL_CLAUDE_URL}/process",
+        json={
+            'user_id': user_id,
+            'interface': interface,
+            'message': message,
+            'conversation_history': history,
+            'conversation_summary': summary,
+            'stream': True
+        },
+        headers={
+            'Authorization': f'Bearer {LOCAL_CLAUDE_API_KEY}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+        },
+        stream=True,
+        # 60s between chunks rather than for the whole reply
+        timeout=(5, 60)
+    )
 
-        return jsonify({
-            'response': assistant_message,
-            'conversation_id': conversation_id or 'default',
-            'message_count': len(conversation['messages']),
-            'mode': 'fallback',
-            'warning': 'Unified entity connection unavailable - using fallback mode'
-        })
+    with response:
+        if response.status_code != 200:
+            raise RuntimeError(f"local service returned HTTP {response.status_code}")
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        if not response.headers.get('Content-Type', '').startswith('text/event-stream'):
+            yield response.json().get('response', '')
+            return
+
+        # Read to the end of the body even after "done" so the connection
+        # goes back to the pool instead of being discarded
+        done = False
+        for line in response.iter_lines(decode_unicode=True):
+            if done or not line or not line.startswith('data:'):
+                continue
+            event = json.loads(line[5:].strip())
+            if event['type'] == 'text':
+                yield event['content']
+            elif event['type'] == 'error':
+                raise RuntimeError(event['error'])
+            elif event['type'] == 'done':
+                done = True
+
+    if not done:
+        raise RuntimeError("local service closed the stream before it finished")
+
+def stream_reply(user_id, interface, message, conversation, conversation_id, history, summary=None):
+    """
+    Stream the assistant reply as server-sent events.
+
+    Text is relayed from the local Claude service as it arrives. If that
+    fails before anything was sent, the Anthropic fallback is streamed
+    instead; a failure after text went out ends the stream with an error.
+    """
+    assistant_message = ''
+    mode = None
+
+    if LOCAL_CLAUDE_URL and LOCAL_CLAUDE_API_KEY and local_health.should_route() and local_breaker.allow():
+        # For streams the breaker tracks time to first text, not the whole reply
+        started = time.monotonic()
+        first_text_after = None
+        try:
+            for text in stream_from_local(user_id, interface, message, history, summary):
+                if first_text_after is None:
+                    first_text_after = time.monotonic() - started
+                assistant_message += text
+                yield sse({'type': 'text', 'content': text})
+            mode = 'unified_entity'
+            local_breaker.record(True, first_text_after if first_text_after is not None else time.monotonic() - started)
+        except Exception as e:
+            print(f"Error streaming from local Claude: {e}")
+            local_breaker.record(False, time.monotonic() - started)
+            if isinstance(e, requests.ConnectionError):
+                local_health.record('unreachable')
+            if assistant_message:
+                yield sse({'type': 'error', 'error': 'Connection to the unified entity was interrupted'})
+                return
+
+    if mode is None:
+        try:
+            with anthropic_fallback.messages.stream(
+                model="claude-sonnet-4-20250514",
+                max_tokens=4096,
+                system=fallback_system_prompt(user_id, interface, summary),
+                messages=history + [{'role': 'user', 'content': message}]
+            ) as fallback_stream:
+                for text in fallback_stream.text_stream:
+                    assistant_message += text
+                    yield sse({'type': 'text', 'content': text})
+            mode = 'fallback'
+        except Exception as e:
+            yield sse({'type': 'error', 'error': str(e)})
+            return
+
+    # Add to conversation
+    conversation_store.append(conversation, 'assistant', assistant_message)
+
+    # Store in Firestore
+    store_message_firestore(user_id, interface, assistant_message, 'assistant', conversation_id)
+
+    yield sse({
+        'type': 'done',
+        'full_response': assistant_message,
+        'conversation_id': conversation_id or 'default',
+        'message_count': len(conversation['messages']),
+        'mode': mode
+    })
+
+# Messages are persisted by a write-behind queue, so replies don't wait on
+# Firestore. A background thread commits them in batches of up to
+# WRITE_BEHIND_BATCH_SIZE, or WRITE_BEHIND_FLUSH_SECONDS after the first
+# queued message. The queue holds WRITE_BEHIND_CAPACITY messages; when it is
+# full a request waits up to WRITE_BEHIND_PUT_TIMEOUT_SECONDS for room and
+# then writes its message directly. A batch that still fails after
+# WRITE_BEHIND_RETRIES attempts is held and tried again every
+# WRITE_BEHIND_RETRY_SECONDS. Up to WRITE_BEHIND_CAPACITY messages are held;
+# beyond that, and on shutdown, held messages are dead-lettered to the log as
+# one JSON line each so they can be replayed. The queue is drained on shutdown.
+# The writer runs after the reply is sent, so the service is deployed with
+# --no-cpu-throttling.
+WRITE_BEHIND_CAPACITY = int(os.environ.get('WRITE_BEHIND_CAPACITY', '1000'))
+WRITE_BEHIND_BATCH_SIZE = min(int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '100')), 500)
+WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get('WRITE_BEHIND_FLUSH_SECONDS', '0.5'))
+WRITE_BEHIND_PUT_TIMEOUT = float(os.environ.get('WRITE_BEHIND_PUT_TIMEOUT_SECONDS', '2'))
+WRITE_BEHIND_RETRY_SECONDS = float(os.environ.get('WRITE_BEHIND_RETRY_SECONDS', '30'))
+WRITE_BEHIND_RETRIES = 3
+
+class MessageWriter:
+    """Bounded write-behind queue committing message documents in batches"""
+
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=WRITE_BEHIND_CAPACITY)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        # (retry_at, items) for batches whose retries ran out, oldest first
+        self._held = deque()
+        self._held_messages = 0
+        self.stats = {'queued': 0, 'written': 0, 'batches': 0, 'direct_writes': 0, 'failed': 0,
+                      'dead_lettered': 0}
+
+    def submit(self, doc_ref, data):
+        """Queue a document write, waiting briefly for room when the queue is full"""
+        self._ensure_started()
+        try:
+            if self._stopped:
+                raise queue.Full
+            self._queue.put((doc_ref, data), timeout=WRITE_BEHIND_PUT_TIMEOUT)
+            self._count('queued')
+        except queue.Full:
+            # Backlogged or shutting down: write it ourselves rather than drop it
+            self._write([(doc_ref, data)])
+            self._count('direct_writes')
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._retry_wait())
+            except queue.Empty:
+                self._retry_held()
+                continue
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + WRITE_BEHIND_FLUSH_SECONDS
+            stop = False
+            while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if stop:
+                return
+            self._retry_held()
+
+    def _write(self, items):
+        """Commit items, holding on to them for a later retry if every attempt fails"""
+        if self._commit(items):
+            return
+        self._count('failed', len(items))
+        dropped = []
+        with self._lock:
+            if self._stopped:
+                dropped = items
+            else:
+                self._held.append((time.monotonic() + WRITE_BEHIND_RETRY_SECONDS, items))
+                self._held_messages += len(items)
+                while self._held_messages > WRITE_BEHIND_CAPACITY:
+                    _, oldest = self._held.popleft()
+                    self._held_messages -= len(oldest)
+                    dropped.extend(oldest)
+        self._dead_letter(dropped)
+
+    def _retry_wait(self):
+        """Seconds until the oldest held batch is due, or None if nothing is held"""
+        with self._lock:
+            if not self._held:
+                return None
+            return max(self._held[0][0] - time.monotonic(), 0)
 
-def store_message_firestore(user_id, interface, content, role):
+    def _retry_held(self):
+        due = []
+        with self._lock:
+            while self._held and self._held[0][0] <= time.monotonic():
+                _, items = self._held.popleft()
+                self._held_messages -= len(items)
+                due.append(items)
+        for items in due:
+            self._write(items)
+
+    def _dead_letter(self, items):
+        for doc_ref, data in items:
+            print(json.dumps({'message_dead_letter': doc_ref.path, 'data': data}, default=str))
+        if items:
+            self._count('dead_lettered', len(items))
+
+    def _commit(self, items):
+        for attempt in range(WRITE_BEHIND_RETRIES):
+            try:
+                batch = db.batch()
+                for doc_ref, data in items:
+                    batch.set(doc_ref, data)
+                batch.commit()
+                self._count('written', len(items))
+                self._count('batches')
+                return True
+            except Exception as e:
+                print(f"Error storing {len(items)} messages (attempt {attempt + 1}): {e}")
+                time.sleep(0.5 * 2 ** attempt)
+        return False
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def drain(self, timeout=10):
+        """Flush everything queued and stop the writer thread"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        with self._lock:
+            held = [item for _, items in self._held for item in items]
+            self._held.clear()
+            self._held_messages = 0
+        self._dead_letter(held)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['held'] = self._held_messages
+        stats['pending'] = self._queue.qsize()
+        stats['capacity'] = WRITE_BEHIND_CAPACITY
+        return stats
+
+message_writer = MessageWriter()
+atexit.register(message_writer.drain)
+
+def store_message_firestore(user_id, interface, content, role, conversation_id=None):
     """Store message in Firestore unified memory"""
     try:
         doc_ref = db.collection('conversations').document(user_id).collection('messages').document()
-        doc_ref.set({
+        message_writer.submit(doc_ref, {
             'user_id': user_id,
+            'conversation_id': conversation_id or 'default',
             'interface': interface,
             'content': content,
             'role': role,
-            'timestamp': firestore.SERVER_TIMESTAMP
+            # Taken now rather than at commit time, so messages committed in
+            # one batch keep their order
+            'timestamp': datetime.now(timezone.utc)
         })
     except Exception as e:
         print(f"Error storing message: {e}")
@@ -197,15 +1160,14 @@ def list_conversations():
                 'message_count': len(conv['messages']),
                 'created_at': conv['created_at']
             }
-            for key, conv in conversations.items()
+            for key, conv in conversation_store.items()
         ]
     })
 
 @app.route('/conversations/<conv_id>', methods=['DELETE'])
 def delete_conversation(conv_id):
     """Delete a conversation"""
-    if conv_id in conversations:
-        del conversations[conv_id]
+    if conversation_store.delete(conv_id):
         return jsonify({'success': True})
     return jsonify({'error': 'Conversation not found'}), 404
 
@@ -222,4 +1184,11 @@ if __name__ == '__main__':
     print("Making the system a TRUE unified entity across all interfaces")
     print("=" * 70)
 
+    def shutdown(signum, frame):
+        # Cloud Run sends SIGTERM before stopping the instance
+        message_writer.drain()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    local_health.ensure_started()
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -36,6 +36,36 @@ async function resolveUserId(inputId) {
   return inputId;
 }
 
+// Helper function to read a context window's messages, oldest first.
+// The Python server stores them in a ring buffer ("slots" keyed by
+// seq % capacity); messages appended here to recent_messages come after.
+function windowMessages(contextData) {
+  const ring = Object.values(contextData.slots || {})
+    .sort((a, b) => (a.seq || 0) - (b.seq || 0))
+    .map(({ seq, ...msg }) => msg);
+  return ring.concat(contextData.recent_messages || []);
+}
+
+// Helper function to read an entity's observations, oldest first.
+// The Python server moves them to an "observations" subcollection once an
+// entity outgrows its document (observations_overflow); any still inline
+// are merged in.
+async function entityObservations(doc) {
+  const data = doc.data();
+  const inline = data.observations || [];
+  if (!data.observations_overflow) {
+    return inline;
+  }
+
+  const snapshot = await doc.ref.collection('observations').orderBy('learned_at').get();
+  const stored = snapshot.docs.map(obsDoc => obsDoc.data());
+  const storedIds = new Set(stored.map(obs => obs.observation_id).filter(Boolean));
+  const learnedAt = obs => (typeof obs.learned_at === 'string' ? Date.parse(obs.learned_at) : obs.learned_at?.toMillis?.()) || 0;
+  return stored
+    .concat(inline.filter(obs => !storedIds.has(obs.observation_id)))
+    .sort((a, b) => learnedAt(a) - learnedAt(b));
+}
+
 const server = new Server(
   {
     name: 'memory-unified',
@@ -185,22 +215,21 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
           .limit(10)
           .get();
 
-        const entities = [];
-        entitiesSnapshot.forEach(doc => {
+        const entities = await Promise.all(entitiesSnapshot.docs.map(async doc => {
           const data = doc.data();
-          entities.push({
+          return {
             name: data.name,
             type: data.entity_type,
-            observations: data.observations || [],
-          });
-        });
+            observations: await entityObservations(doc),
+          };
+        }));
 
         const result = {
           user_id,
           context_summary: contextData.summary || 'No summary',
-          recent_messages: (contextData.recent_messages || []).slice(0, max_messages),
+          recent_messages: windowMessages(contextData).slice(0, max_messages),
           entities,
-          message_count: (contextData.recent_messages || []).length,
+          message_count: windowMessages(contextData).length,
         };
 
         return {
@@ -227,7 +256,7 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
         // Search messages in context window
         const contextDoc = await userRef.collection('context_windows').doc('window_latest').get();
         if (contextDoc.exists) {
-          const messages = contextDoc.data().recent_messages || [];
+          const messages = windowMessages(contextDoc.data());
           results.messages = messages
             .filter(msg => msg.content.toLowerCase().includes(queryLower))
             .slice(0, max_results);
@@ -235,21 +264,24 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
 
         // Search entities
         const entitiesSnapshot = await userRef.collection('entities').get();
-        entitiesSnapshot.forEach(doc => {
+        const matches = await Promise.all(entitiesSnapshot.docs.map(async doc => {
           const data = doc.data();
+          const observations = await entityObservations(doc);
           const nameMatch = data.name.toLowerCase().includes(queryLower);
-          const obsMatch = (data.observations || []).some(obs =>
+          const obsMatch = observations.some(obs =>
             obs.content?.toLowerCase().includes(queryLower)
           );
 
           if (nameMatch || obsMatch) {
-            results.entities.push({
+            return {
               name: data.name,
               type: data.entity_type,
-              observations: data.observations || [],
-            });
+              observations,
+            };
           }
-        });
+          return null;
+        }));
+        results.entities = matches.filter(Boolean);
 
         results.entities = results.entities.slice(0, max_results);
 
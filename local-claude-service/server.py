@@ -9,15 +9,24 @@ The cloud Allspark routes ALL requests here, making this the single
 source of truth for Claude's processing.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from anthropic import Anthropic
+import asyncio
+import atexit
+import importlib.util
+import itertools
 import os
 import json
+import shlex
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
 from datetime import datetime
 import hmac
+import math
 from functools import wraps
 
 app = Flask(__name__)
@@ -26,12 +35,500 @@ CORS(app)
 # Initialize Anthropic client
 anthropic_client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
+# Tool use runs for up to TOOL_MAX_ROUNDS rounds within TOOL_LOOP_BUDGET
+# seconds; after that the model is asked to answer with what it has. The tool
+# calls of one round run concurrently, each limited to TOOL_CALL_TIMEOUT.
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+TOOL_MAX_ROUNDS = int(os.environ.get('TOOL_MAX_ROUNDS', '5'))
+TOOL_LOOP_BUDGET = float(os.environ.get('TOOL_LOOP_BUDGET_SECONDS', '90'))
+TOOL_CALL_TIMEOUT = float(os.environ.get('TOOL_CALL_TIMEOUT_SECONDS', '20'))
+tool_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('TOOL_WORKERS', '8')), thread_name_prefix='tool')
+
+# Requests are laid out for prompt caching. The prompt starts with the tool
+# definitions and these instructions, which never change, then the per-user
+# context, which changes rarely, then the history, which only grows; each part
+# ends in a cache breakpoint. The timestamp goes last, on the new message,
+# where it doesn't invalidate anything.
+SYSTEM_INSTRUCTIONS = """You are Claude, the unified AI assistant.
+
+You have access to the unified memory system (Firestore) and all available MCP tools.
+You are the ONE true Claude entity across all interfaces (terminal, WhatsApp, web, etc.).
+
+Use your tools to help the user effectively. Remember that facts stored in memory
+are available across all interfaces."""
+CACHE_BREAKPOINT = {'type': 'ephemeral'}
+
 # API key for authentication
 API_KEY = os.environ.get('LOCAL_CLAUDE_API_KEY', 'dev-key-changeme')
 
-# MCP client connections (we'll initialize these on startup)
+# MCP client pools by server name, started on first use
 mcp_clients = {}
 
+# The memory tools are served by index.js. Instead of starting node for every
+# call, MCP_POOL_SIZE long-lived server processes are kept and spoken to over
+# stdio, with several JSON-RPC requests in flight per process. A process that
+# exits or stops answering pings is restarted.
+MEMORY_MCP_SERVER_PATH = os.environ.get(
+    'MEMORY_MCP_SERVER_PATH', "/Users/saady/development/mcp-servers/memory-unified/index.js"
+)
+MEMORY_MCP_COMMAND = os.environ.get('MEMORY_MCP_COMMAND', f"node {shlex.quote(MEMORY_MCP_SERVER_PATH)}")
+MCP_POOL_SIZE = int(os.environ.get('MCP_POOL_SIZE', '2'))
+MCP_CALL_TIMEOUT = float(os.environ.get('MCP_CALL_TIMEOUT_SECONDS', '30'))
+MCP_HEALTH_INTERVAL = float(os.environ.get('MCP_HEALTH_INTERVAL_SECONDS', '30'))
+MCP_PROTOCOL_VERSION = '2024-11-05'
+
+class MCPError(Exception):
+    """An MCP server answered a request with a JSON-RPC error, or went away"""
+
+class MCPConnection:
+    """One MCP server subprocess, with JSON-RPC requests multiplexed by id"""
+
+    def __init__(self, command):
+        self.command = command
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Set once the server's output ends; it may not have been reaped yet
+        self._closed = False
+        self.process = subprocess.Popen(
+            shlex.split(command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            env={**os.environ, 'GOOGLE_CLOUD_PROJECT': 'new-fps-gpt'}
+        )
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+        threading.Thread(target=self._read_stderr, daemon=True).start()
+
+        try:
+            self.request('initialize', {
+                'protocolVersion': MCP_PROTOCOL_VERSION,
+                'capabilities': {},
+                'clientInfo': {'name': 'local-claude-service', 'version': '1.0.0'}
+            })
+            self._send({'jsonrpc': '2.0', 'method': 'notifications/initialized'})
+        except Exception:
+            # Ending the process closes its pipes, which ends the reader threads
+            self.close()
+            raise
+
+    def alive(self):
+        return not self._closed and self.process.poll() is None
+
+    def in_flight(self):
+        return len(self._pending)
+
+    def request(self, method, params=None, timeout=MCP_CALL_TIMEOUT):
+        """Send a request and wait for its response"""
+        request_id = next(self._ids)
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = future
+        try:
+            self._send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params or {}})
+            response = future.result(timeout=timeout)
+        except FutureTimeout:
+            raise MCPError(f"{method} timed out after {timeout}s")
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        if 'error' in response:
+            raise MCPError(response['error'].get('message', str(response['error'])))
+        self.calls += 1
+        return response.get('result', {})
+
+    def _send(self, message):
+        line = json.dumps(message) + '\n'
+        with self._lock:
+            if not self.alive():
+                raise MCPError('MCP server process has exited')
+            self.process.stdin.write(line)
+            self.process.stdin.flush()
+
+    def _read_stdout(self):
+        for line in self.process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            with self._lock:
+                future = self._pending.get(message.get('id'))
+            if future is not None and not future.done():
+                future.set_result(message)
+        # Process exited: fail whatever is still waiting, and refuse new requests
+        with self._lock:
+            self._closed = True
+            pending = list(self._pending.values())
+        for future in pending:
+            if not future.done():
+                future.set_result({'error': {'message': 'MCP server process exited'}})
+
+    def _read_stderr(self):
+        # Drain stderr so a chatty server can't block on a full pipe
+        for line in self.process.stderr:
+            print(f"[mcp {self.process.pid}] {line.rstrip()}")
+
+    def close(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+class MCPClientPool:
+    """
+    Fixed-size pool of MCPConnections to one server, restarted when unhealthy.
+
+    Starting a server includes its initialize handshake, so slots are
+    (re)started outside the lock: a slot being started is marked in
+    _starting, and callers that find no live connection wait on _changed.
+    """
+
+    def __init__(self, command, size):
+        self.command = command
+        self.size = size
+        self.restarts = 0
+        self._connections = [None] * size
+        self._starting = set()
+        self._start_error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self._health_thread.start()
+
+    def call_tool(self, name, arguments, timeout=MCP_CALL_TIMEOUT):
+        return self._pick().request('tools/call', {'name': name, 'arguments': arguments}, timeout)
+
+    def _pick(self):
+        """The least busy live connection, (re)starting dead slots"""
+        with self._lock:
+            dead = {
+                i: conn for i, conn in enumerate(self._connections)
+                if i not in self._starting and (conn is None or not conn.alive())
+            }
+            self._starting.update(dead)
+        for i, conn in dead.items():
+            self._restart(i, conn)
+
+        with self._changed:
+            while True:
+                live = [conn for conn in self._connections if conn is not None and conn.alive()]
+                if live:
+                    return min(live, key=lambda conn: conn.in_flight())
+                if not self._starting:
+                    raise MCPError(f"No MCP server could be started: {self._start_error}")
+                self._changed.wait()
+
+    def _restart(self, i, old):
+        """Start slot i in place of old; the caller has marked it in _starting"""
+        conn = None
+        try:
+            if old is not None:
+                old.close()
+            conn = MCPConnection(self.command)
+        except Exception as e:
+            print(f"Could not start MCP server: {e}")
+            self._start_error = e
+        with self._changed:
+            if old is not None:
+                self.restarts += 1
+            self._connections[i] = conn
+            self._starting.discard(i)
+            self._changed.notify_all()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(MCP_HEALTH_INTERVAL)
+            if self._closed:
+                return
+            for i, conn in enumerate(list(self._connections)):
+                if conn is None:
+                    continue
+                try:
+                    if not conn.alive():
+                        raise MCPError('exited')
+                    conn.request('ping', timeout=5)
+                except Exception as e:
+                    print(f"MCP server {conn.process.pid} unhealthy ({e}), restarting")
+                    with self._lock:
+                        restart = self._connections[i] is conn and i not in self._starting and not self._closed
+                        if restart:
+                            self._starting.add(i)
+                    if restart:
+                        self._restart(i, conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for conn in self._connections:
+                if conn is not None:
+                    conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'restarts': self.restarts,
+                'connections': [
+                    {'pid': conn.process.pid, 'alive': conn.alive(), 'in_flight': conn.in_flight(), 'calls': conn.calls}
+                    for conn in self._connections if conn is not None
+                ]
+            }
+
+_mcp_clients_lock = threading.Lock()
+
+def memory_mcp_pool():
+    """The pool of memory MCP servers, created on first use"""
+    with _mcp_clients_lock:
+        if 'memory-unified' not in mcp_clients:
+            mcp_clients['memory-unified'] = MCPClientPool(MEMORY_MCP_COMMAND, MCP_POOL_SIZE)
+        return mcp_clients['memory-unified']
+
+@atexit.register
+def close_mcp_clients():
+    for pool in mcp_clients.values():
+        pool.close()
+
+# The memory tools are also implemented in Python by the root server.py, so
+# they can be called in-process on one shared event loop: no pipes, and no
+# JSON encoding of arguments or results on the way. MEMORY_TOOL_DISPATCH picks
+# the mode per tool as comma-separated tool=mode pairs, with * (or a bare mode)
+# as the default, e.g. "get_unified_context=inprocess,*=stdio". stdio keeps the
+# tools isolated in their own processes and stays the default. Both modes use
+# the same users/{id}/entities and window_latest documents; in-process tools
+# return server.py's structured results, stdio ones index.js's MCP text.
+MEMORY_SERVER_MODULE_PATH = os.environ.get(
+    'MEMORY_SERVER_MODULE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py')
+)
+DISPATCH_MODES = ('stdio', 'inprocess')
+
+def parse_dispatch_modes(spec):
+    """'tool=mode,...' -> {tool: mode}, with the default under '*'"""
+    modes = {'*': 'stdio'}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        tool, _, mode = (part.strip() for part in entry.rpartition('='))
+        if mode not in DISPATCH_MODES:
+            raise ValueError(f"Unknown dispatch mode {mode!r} in MEMORY_TOOL_DISPATCH")
+        modes[tool or '*'] = mode
+    return modes
+
+MEMORY_TOOL_DISPATCH = parse_dispatch_modes(os.environ.get('MEMORY_TOOL_DISPATCH', 'stdio'))
+
+def dispatch_mode(tool_name):
+    return MEMORY_TOOL_DISPATCH.get(tool_name, MEMORY_TOOL_DISPATCH['*'])
+
+class InProcessMemoryTools:
+    """The root server's memory tool implementations, run on a background event loop"""
+
+    # Tool names exposed to Claude -> implementation in the memory server module
+    IMPLEMENTATIONS = {
+        'get_unified_context': 'get_unified_context',
+        'search_unified_memory': 'search_memory',
+        'create_unified_entities': 'create_entities'
+    }
+    # Arguments the Python implementations require but our schemas don't ask for
+    ARGUMENT_DEFAULTS = {
+        'get_unified_context': {'current_interface': 'terminal'}
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.module = None
+        self.load_error = None
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def available(self):
+        """Import the memory server on first use; False if it can't be loaded here"""
+        with self._lock:
+            if self.module is None and self.load_error is None:
+                try:
+                    self.module = asyncio.run_coroutine_threadsafe(self._load(), self.loop).result(60)
+                except Exception as e:
+                    self.load_error = str(e)
+                    print(f"In-process memory tools unavailable, using stdio: {e}")
+            return self.module is not None
+
+    async def _load(self):
+        # Imported on the loop thread so its async Firestore client binds to this loop.
+        # Loaded under its own name, since this file is called server.py too.
+        spec = importlib.util.spec_from_file_location('memory_unified_server', self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        try:
+            await module.user_resolver.preload()
+        except Exception as e:
+            print(f"Could not preload user mappings, resolving on demand: {e}")
+        module.user_resolver.watch()
+        return module
+
+    def call_tool(self, name, arguments, timeout=MCP_CALL_TIMEOUT):
+        started = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(self._call(name, arguments), self.loop)
+        try:
+            result = future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            self.errors += 1
+            raise MCPError(f"{name} timed out after {timeout}s")
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.calls += 1
+            self.total_ms += (time.perf_counter() - started) * 1000
+        if result.get('success') is False:
+            self.errors += 1
+        return result
+
+    async def _call(self, name, arguments):
+        """Run a tool, returning its result as is, or its error with success: False"""
+        try:
+            arguments = {**self.ARGUMENT_DEFAULTS.get(name, {}), **arguments}
+            if arguments.get('user_id'):
+                # Email and phone aliases share one memory, as in the server's call_tool
+                arguments['user_id'] = await self.module.user_resolver.resolve(arguments['user_id'])
+            return await getattr(self.module, self.IMPLEMENTATIONS[name])(arguments)
+        except Exception as e:
+            return {'error': str(e), 'success': False}
+
+    def stats(self):
+        return {
+            'loaded': self.module is not None,
+            'load_error': self.load_error,
+            'calls': self.calls,
+            'errors': self.errors,
+            'mean_ms': round(self.total_ms / self.calls, 3) if self.calls else None
+        }
+
+inprocess_memory_tools = InProcessMemoryTools(MEMORY_SERVER_MODULE_PATH)
+
+# /process admission control. Each request holds a thread for the whole tool
+# loop, so at most SERVICE_CONCURRENCY run at once and up to
+# SERVICE_QUEUE_DEPTH wait, first come first served, for at most
+# SERVICE_QUEUE_TIMEOUT seconds. Beyond that requests are shed straight away:
+# 429 when the queue is full, 503 when the wait runs out, both with Retry-After.
+SERVICE_CONCURRENCY = int(os.environ.get('SERVICE_CONCURRENCY', '4'))
+SERVICE_QUEUE_DEPTH = int(os.environ.get('SERVICE_QUEUE_DEPTH', '16'))
+SERVICE_QUEUE_TIMEOUT = float(os.environ.get('SERVICE_QUEUE_TIMEOUT_SECONDS', '30'))
+
+class Overloaded(Exception):
+    """A request was shed rather than queued"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class RequestGate:
+    """Concurrency limit with a bounded FIFO wait queue"""
+
+    def __init__(self, concurrency, queue_depth, queue_timeout):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_queue_timeout = 0
+        self.queue_wait_ms = 0.0
+        self.service_ms = 0.0
+        self.completed = 0
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a slot; raises Overloaded if the request should be shed"""
+        started = time.perf_counter()
+        with self._lock:
+            if self.in_flight < self.concurrency and not self._waiters:
+                self.in_flight += 1
+                return self._admit(started)
+            if len(self._waiters) >= self.queue_depth:
+                self.rejected_queue_full += 1
+                raise Overloaded('Too many requests queued', 429, self._retry_after(len(self._waiters)))
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        admitted = waiter.wait(self.queue_timeout)
+        with self._lock:
+            if not admitted and waiter.is_set():
+                admitted = True  # a slot was handed over just as the wait ran out
+            if not admitted:
+                self._waiters.remove(waiter)
+                self.rejected_queue_timeout += 1
+                raise Overloaded('Timed out waiting for a free worker', 503, self._retry_after(len(self._waiters)))
+            return self._admit(started)
+
+    def _admit(self, started):
+        # Called with the lock held, once the slot is counted in in_flight
+        self.admitted += 1
+        self.queue_wait_ms += (time.perf_counter() - started) * 1000
+        return time.perf_counter()
+
+    def release(self, admitted_at):
+        with self._lock:
+            self.completed += 1
+            self.service_ms += (time.perf_counter() - admitted_at) * 1000
+            if self._waiters:
+                # Hand the slot, still counted in in_flight, to the longest waiter
+                self._waiters.pop(0).set()
+            else:
+                self.in_flight -= 1
+
+    def _retry_after(self, queued):
+        """Seconds until the queue ahead is likely to have drained"""
+        mean_service = self.service_ms / self.completed / 1000 if self.completed else 10.0
+        return max(1, math.ceil(mean_service * (queued + 1) / self.concurrency))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight,
+                'queued': len(self._waiters),
+                'admitted': self.admitted,
+                'completed': self.completed,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_queue_timeout': self.rejected_queue_timeout,
+                'mean_queue_wait_ms': round(self.queue_wait_ms / self.admitted, 1) if self.admitted else None,
+                'mean_service_ms': round(self.service_ms / self.completed, 1) if self.completed else None
+            }
+
+request_gate = RequestGate(SERVICE_CONCURRENCY, SERVICE_QUEUE_DEPTH, SERVICE_QUEUE_TIMEOUT)
+
+def gated(f):
+    """Run the view under the request gate, holding the slot until the response is closed"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            admitted_at = request_gate.acquire()
+        except Overloaded as e:
+            response = jsonify({'success': False, 'error': str(e), 'retry_after': e.retry_after})
+            response.status_code = e.status
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except Exception:
+            request_gate.release(admitted_at)
+            raise
+        # Streamed responses keep the slot until the stream ends
+        response.call_on_close(lambda: request_gate.release(admitted_at))
+        return response
+    return decorated
+
 def require_auth(f):
     """Require API key authentication"""
     @wraps(f)
@@ -54,11 +551,27 @@ def health():
         'status': 'healthy',
         'service': 'local-claude-service',
         'timestamp': datetime.utcnow().isoformat(),
-        'mcp_servers': list(mcp_clients.keys())
+        'mcp_servers': list(mcp_clients.keys()),
+        'mcp_pools': {name: pool.stats() for name, pool in mcp_clients.items()},
+        'requests': request_gate.snapshot(),
+        'memory_tool_dispatch': MEMORY_TOOL_DISPATCH,
+        'inprocess_memory_tools': inprocess_memory_tools.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Load metrics: request queue and in-flight work, tool dispatch"""
+    return jsonify({
+        'requests': request_gate.snapshot(),
+        'tool_workers': tool_executor._max_workers,
+        'mcp_pools': {name: pool.stats() for name, pool in mcp_clients.items()},
+        'inprocess_memory_tools': inprocess_memory_tools.stats(),
+        'timestamp': datetime.utcnow().isoformat()
     })
 
 @app.route('/process', methods=['POST'])
 @require_auth
+@gated
 def process():
     """
     Main processing endpoint
@@ -69,6 +582,8 @@ def process():
     message = data.get('message')
     interface = data.get('interface', 'unknown')
     conversation_history = data.get('conversation_history', [])
+    # Older turns the cloud service has folded into a summary
+    conversation_summary = data.get('conversation_summary')
 
     if not user_id or not message:
         return jsonify({'error': 'user_id and message required'}), 400
@@ -77,85 +592,54 @@ def process():
     messages = conversation_history.copy()
     messages.append({
         'role': 'user',
-        'content': message
+        'content': [
+            {'type': 'text', 'text': message},
+            {'type': 'text', 'text': f"(Sent {datetime.utcnow().isoformat()} UTC)"}
+        ]
     })
+    history_length = len(conversation_history)
 
     # System prompt with context
-    system_prompt = f"""You are Claude, the unified AI assistant.
-
-User: {user_id}
-Interface: {interface}
-Timestamp: {datetime.utcnow().isoformat()}
-
-You have access to the unified memory system (Firestore) and all available MCP tools.
-You are the ONE true Claude entity across all interfaces (terminal, WhatsApp, web, etc.).
+    user_context = f"User: {user_id}\nInterface: {interface}"
+    if conversation_summary:
+        user_context += f"\n\nSummary of the earlier conversation:\n{conversation_summary}"
+    system_prompt = [
+        {'type': 'text', 'text': SYSTEM_INSTRUCTIONS, 'cache_control': CACHE_BREAKPOINT},
+        {'type': 'text', 'text': user_context, 'cache_control': CACHE_BREAKPOINT}
+    ]
 
-Use your tools to help the user effectively. Remember that facts stored in memory
-are available across all interfaces."""
+    if data.get('stream'):
+        return Response(
+            stream_with_context(stream_process(system_prompt, messages, history_length)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
 
     try:
-        # Get available tools
         tools = get_tool_definitions()
-
-        # Call Claude API with tools
-        response = anthropic_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=8192,
-            system=system_prompt,
-            tools=tools if tools else None,
-            messages=messages
-        )
-
-        # Handle tool use if present
-        assistant_message = ""
-        tool_results = []
-
-        for block in response.content:
-            if block.type == 'text':
-                assistant_message += block.text
-            elif block.type == 'tool_use':
-                # Execute tool
-                tool_result = execute_tool(block.name, block.input)
-                tool_results.append({
-                    'tool_use_id': block.id,
-                    'result': tool_result
-                })
-
-        # If we had tool use, make another API call with results
-        if tool_results:
-            messages.append({
-                'role': 'assistant',
-                'content': response.content
-            })
-            # Format tool results properly for Anthropic API
-            tool_result_blocks = []
-            for tr in tool_results:
-                tool_result_blocks.append({
-                    'type': 'tool_result',
-                    'tool_use_id': tr['tool_use_id'],
-                    'content': json.dumps(tr['result'])
-                })
-            messages.append({
-                'role': 'user',
-                'content': tool_result_blocks
-            })
-
-            # Second API call with tool results
-            response = anthropic_client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=8192,
-                system=system_prompt,
-                messages=messages
-            )
-
-            assistant_message = ""
-            for block in response.content:
-                if block.type == 'text':
-                    assistant_message += block.text
+        deadline = time.monotonic() + TOOL_LOOP_BUDGET
+        rounds = []
+        usage = {}
+        stopped = 'complete'
+
+        while True:
+            final = stopped != 'complete'
+            started = time.perf_counter()
+            response = anthropic_client.messages.create(**model_request(system_prompt, messages, tools, history_length, final))
+            rounds.append({'round': len(rounds) + 1, 'model_ms': elapsed_ms(started), **add_usage(usage, response)})
+            if final or not any(block.type == 'tool_use' for block in response.content):
+                break
+            rounds[-1].update(run_tool_round(response, messages, deadline))
+            stopped = tool_loop_limit(len(rounds), deadline)
+
+        assistant_message = "".join(block.text for block in response.content if block.type == 'text')
 
         return jsonify({
             'success': True,
             'response': assistant_message,
+            'tool_rounds': rounds,
+            'tool_loop_stopped': stopped,
+            'usage': usage,
             'timestamp': datetime.utcnow().isoformat()
         })
 
@@ -165,6 +649,158 @@ are available across all interfaces."""
             'error': str(e)
         }), 500
 
+def sse(event):
+    """Format one server-sent event"""
+    return f"data: {json.dumps(event)}\n\n"
+
+def stream_process(system_prompt, messages, history_length):
+    """
+    Same flow as /process, streamed as server-sent events.
+
+    Text is sent as the model generates it. After each round of tool calls
+    a tool_round event reports its timing, then the next response streams.
+    """
+    try:
+        tools = get_tool_definitions()
+        deadline = time.monotonic() + TOOL_LOOP_BUDGET
+        rounds = []
+        usage = {}
+        stopped = 'complete'
+
+        while True:
+            final = stopped != 'complete'
+            started = time.perf_counter()
+            with anthropic_client.messages.stream(**model_request(system_prompt, messages, tools, history_length, final)) as stream:
+                for text in stream.text_stream:
+                    yield sse({'type': 'text', 'content': text})
+                response = stream.get_final_message()
+            rounds.append({'round': len(rounds) + 1, 'model_ms': elapsed_ms(started), **add_usage(usage, response)})
+            if final or not any(block.type == 'tool_use' for block in response.content):
+                break
+            rounds[-1].update(run_tool_round(response, messages, deadline))
+            yield sse({'type': 'tool_round', **rounds[-1]})
+            stopped = tool_loop_limit(len(rounds), deadline)
+
+        yield sse({
+            'type': 'done',
+            'tool_rounds': rounds,
+            'tool_loop_stopped': stopped,
+            'usage': usage,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+
+    except Exception as e:
+        yield sse({'type': 'error', 'error': str(e)})
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def model_request(system_prompt, messages, tools, history_length, final=False):
+    """Arguments for a messages.create/stream call; a final call may not use tools"""
+    kwargs = {
+        'model': CLAUDE_MODEL,
+        'max_tokens': 8192,
+        'system': system_prompt,
+        'messages': cache_breakpoints(messages, history_length)
+    }
+    if tools:
+        # Tools stay defined on the final call since the history holds tool_use blocks
+        kwargs['tools'] = tools
+        if final:
+            kwargs['tool_choice'] = {'type': 'none'}
+    return kwargs
+
+def cache_breakpoints(messages, history_length):
+    """
+    Copy of messages with cache breakpoints at the end of the earlier history,
+    which the next request reads back, and on the latest tool results, which
+    the next round of this request reads back. With the two system blocks
+    that is four, the most a request may have.
+    """
+    marked = list(messages)
+    positions = {history_length - 1}
+    if len(messages) > history_length + 1:
+        positions.add(len(messages) - 1)
+    for i in positions:
+        if i >= 0:
+            marked[i] = with_breakpoint(marked[i])
+    return marked
+
+def with_breakpoint(message):
+    content = message['content']
+    if isinstance(content, str):
+        if not content:
+            return message
+        blocks = [{'type': 'text', 'text': content}]
+    else:
+        blocks = [block if isinstance(block, dict) else block.model_dump(exclude_none=True) for block in content]
+    blocks[-1] = {**blocks[-1], 'cache_control': CACHE_BREAKPOINT}
+    return {**message, 'content': blocks}
+
+def add_usage(totals, response):
+    """Add a response's token usage to totals and return it"""
+    usage = {
+        field: getattr(response.usage, field, None) or 0
+        for field in ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+    } if getattr(response, 'usage', None) else {}
+    for field, tokens in usage.items():
+        totals[field] = totals.get(field, 0) + tokens
+    return usage
+
+def tool_loop_limit(rounds_done, deadline):
+    """Why the tool loop has to stop now, or 'complete' if it may go on"""
+    if rounds_done >= TOOL_MAX_ROUNDS:
+        return 'max_rounds'
+    if time.monotonic() >= deadline:
+        return 'budget'
+    return 'complete'
+
+def run_tool_round(response, messages, deadline):
+    """
+    Run every tool call in the response concurrently and append the
+    assistant turn and its tool results to messages. Returns the round's timing.
+    """
+    started = time.perf_counter()
+    tool_uses = [block for block in response.content if block.type == 'tool_use']
+    timeout = max(min(TOOL_CALL_TIMEOUT, deadline - time.monotonic()), 1)
+    futures = [tool_executor.submit(timed_tool, block.name, block.input, timeout) for block in tool_uses]
+
+    # One deadline for the whole round, however many calls hang
+    wait(futures, timeout=timeout + 1)
+
+    tool_result_blocks = []
+    tool_timings = []
+    for block, future in zip(tool_uses, futures):
+        if future.done():
+            result, ms = future.result()
+        else:
+            future.cancel()
+            result, ms = {'error': f'{block.name} timed out after {timeout:.0f}s', 'success': False}, timeout * 1000
+        # execute_tool reports its own failures with success: False, MCP servers with isError
+        failed = isinstance(result, dict) and (result.get('success') is False or bool(result.get('isError')))
+        tool_result_blocks.append({
+            'type': 'tool_result',
+            'tool_use_id': block.id,
+            'content': json.dumps(result, default=str),
+            'is_error': failed
+        })
+        tool_timings.append({'name': block.name, 'ms': round(ms, 1), 'ok': not failed})
+
+    messages.append({
+        'role': 'assistant',
+        'content': response.content
+    })
+    messages.append({
+        'role': 'user',
+        'content': tool_result_blocks
+    })
+    return {'tools_ms': elapsed_ms(started), 'tools': tool_timings}
+
+def timed_tool(tool_name, parameters, timeout):
+    started = time.perf_counter()
+    result = execute_tool(tool_name, parameters, timeout)
+    return result, (time.perf_counter() - started) * 1000
+
 def get_tool_definitions():
     """
     Get tool definitions from available MCP servers
@@ -251,48 +887,18 @@ def get_tool_definitions():
 
     return tools
 
-def execute_tool(tool_name, parameters):
+def execute_tool(tool_name, parameters, timeout=MCP_CALL_TIMEOUT):
     """
-    Execute a tool by calling the appropriate MCP server
+    Execute a tool in-process or by calling the appropriate MCP server
     """
     try:
-        # For now, we'll call the memory MCP server directly
-        # This uses the index.js MCP server
-        mcp_server_path = "/Users/saady/development/mcp-servers/memory-unified/index.js"
-
-        # Build MCP request
-        mcp_request = {
-            "jsonrpc": "2.0",
-            "id": 1,
-            "method": "tools/call",
-            "params": {
-                "name": tool_name,
-                "arguments": parameters
-            }
-        }
-
-        # Call MCP server via node
-        result = subprocess.run(
-            ['node', mcp_server_path],
-            input=json.dumps(mcp_request),
-            capture_output=True,
-            text=True,
-            timeout=30,
-            env={
-                **os.environ,
-                'GOOGLE_CLOUD_PROJECT': 'new-fps-gpt'
-            }
-        )
+        if (dispatch_mode(tool_name) == 'inprocess'
+                and tool_name in InProcessMemoryTools.IMPLEMENTATIONS
+                and inprocess_memory_tools.available()):
+            return inprocess_memory_tools.call_tool(tool_name, parameters, timeout)
 
-        if result.returncode != 0:
-            return {
-                'error': f'MCP server error: {result.stderr}',
-                'success': False
-            }
-
-        # Parse response
-        response = json.loads(result.stdout)
-        return response.get('result', {})
+        # Otherwise the tool is served by the index.js MCP server
+        return memory_mcp_pool().call_tool(tool_name, parameters, timeout)
 
     except Exception as e:
         return {
@@ -300,6 +906,10 @@ def execute_tool(tool_name, parameters):
             'success': False
         }
 
+# waitress is a production WSGI server with a fixed thread pool. It runs in
+# this one process, so every request shares the MCP pools and event loop.
+SERVER_MODE = os.environ.get('SERVER_MODE', 'waitress')
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5002))
     print("=" * 60)
@@ -308,9 +918,18 @@ if __name__ == '__main__':
     print(f"Port: {port}")
     print(f"Health: http://localhost:{port}/health")
     print(f"Process: POST http://localhost:{port}/process")
+    print(f"Server: {SERVER_MODE}, {SERVICE_CONCURRENCY} concurrent, {SERVICE_QUEUE_DEPTH} queued")
     print("=" * 60)
     print("This service handles ALL Claude processing across interfaces")
     print("The cloud Allspark routes requests here")
     print("=" * 60)
 
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if SERVER_MODE == 'waitress':
+        from waitress import serve
+        # Enough threads that requests queue in the gate, where they are
+        # counted and shed, with spare ones for /health and /metrics.
+        # send_bytes=1 flushes each server-sent event as it is written.
+        serve(app, host='0.0.0.0', port=port,
+              threads=SERVICE_CONCURRENCY + SERVICE_QUEUE_DEPTH + 4, send_bytes=1)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
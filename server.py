@@ -11,10 +11,25 @@ This creates ONE Claude entity, not multiple clones.
 """
 
 import asyncio
+import base64
+import copy
+import fcntl
+import hashlib
+import heapq
 import json
 import logging
-from datetime import datetime, timedelta
+import math
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Optional
+import numpy as np
 from google.cloud import firestore
 from google.api_core import retry
 
@@ -26,8 +41,13 @@ from mcp.types import Tool, TextContent
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("memory-unified")
 
-# Initialize Firestore
-db = firestore.Client(project="new-fps-gpt")
+# Initialize Firestore. The async client keeps Firestore I/O off the event
+# loop that stdio_server runs on, so overlapping tool calls are not serialized.
+FIRESTORE_PROJECT = "new-fps-gpt"
+db = firestore.AsyncClient(project=FIRESTORE_PROJECT)
+
+# Firestore caps a WriteBatch at 500 operations
+MAX_BATCH_SIZE = 500
 
 # Server instance
 app = Server("memory-unified")
@@ -143,9 +163,9 @@ async def list_tools() -> list[Tool]:
                     },
                     "search_type": {
                         "type": "string",
-                        "enum": ["entities", "conversations", "messages", "all"],
+                        "enum": ["entities", "conversations", "messages", "all", "semantic"],
                         "default": "all",
-                        "description": "What to search"
+                        "description": "What to search ('semantic' matches by meaning across entities and messages)"
                     },
                     "interface_filter": {
                         "type": "string",
@@ -157,6 +177,21 @@ async def list_tools() -> list[Tool]:
                         "type": "integer",
                         "default": 10,
                         "description": "Maximum results to return"
+                    },
+                    "min_score": {
+                        "type": "number",
+                        "default": 0,
+                        "description": "Drop results whose relevance score is below this threshold"
+                    },
+                    "order": {
+                        "type": "string",
+                        "enum": ["relevance", "recent"],
+                        "default": "relevance",
+                        "description": "Rank messages by relevance, or list them newest first ('recent') a page at a time"
+                    },
+                    "page_token": {
+                        "type": "string",
+                        "description": "page_token from a previous 'recent' search, to continue where it stopped"
                     }
                 },
                 "required": ["user_id", "query"]
@@ -190,6 +225,10 @@ async def list_tools() -> list[Tool]:
                         "type": "integer",
                         "default": 20,
                         "description": "Maximum recent messages to include"
+                    },
+                    "latency_budget_ms": {
+                        "type": "integer",
+                        "description": "Return whatever sections have loaded after this many milliseconds; late sections are listed in partial_sections"
                     }
                 },
                 "required": ["user_id", "current_interface"]
@@ -234,10 +273,22 @@ async def list_tools() -> list[Tool]:
                     "context_summary": {
                         "type": "string",
                         "description": "Summary of current context"
+                    },
+                    "context_window_size": {
+                        "type": "integer",
+                        "description": "How many recent messages this user's context window keeps (default: 50)"
                     }
                 },
                 "required": ["user_id", "interface", "conversation_id"]
             }
+        ),
+        Tool(
+            name="get_cache_stats",
+            description="Report hit/miss counters and memory use of the server's knowledge graph cache",
+            inputSchema={
+                "type": "object",
+                "properties": {}
+            }
         )
     ]
 
@@ -246,6 +297,10 @@ async def list_tools() -> list[Tool]:
 async def call_tool(name: str, arguments: Any) -> list[TextContent]:
     """Handle tool calls"""
     try:
+        if isinstance(arguments, dict) and arguments.get("user_id"):
+            # Email and phone aliases share one memory
+            arguments = {**arguments, "user_id": await user_resolver.resolve(arguments["user_id"])}
+
         if name == "create_entities":
             result = await create_entities(arguments)
         elif name == "add_observations":
@@ -256,10 +311,12 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
             result = await get_unified_context(arguments)
         elif name == "sync_conversation_state":
             result = await sync_conversation_state(arguments)
+        elif name == "get_cache_stats":
+            result = {"success": True, "cache": document_cache.stats(), "user_mappings": user_resolver.stats()}
         else:
             raise ValueError(f"Unknown tool: {name}")
 
-        return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        return [TextContent(type="text", text=json.dumps(result, indent=2, default=str))]
 
     except Exception as e:
         logger.error(f"Error executing {name}: {e}")
@@ -278,40 +335,50 @@ async def create_entities(params: Dict[str, Any]) -> Dict[str, Any]:
     entities = params["entities"]
 
     created = []
+    index_entries = []
     timestamp = datetime.utcnow()
 
-    for entity in entities:
+    # One batched read for every entity in the call. Entities are read live,
+    # since whether one exists decides what is written
+    entity_refs = [entity_document(user_id, entity["name"]) for entity in entities]
+    snapshot_ref = context_snapshot_ref(user_id)
+    snapshots, (snapshot_doc,) = await asyncio.gather(fresh_get_all(entity_refs), cached_get_all([snapshot_ref]))
+    context_snapshot = snapshot_doc.to_dict()
+    stored = {snapshot.reference.path: snapshot.to_dict() for snapshot in snapshots if snapshot.exists}
+    current = dict(stored)
+    appended: Dict[str, List[Dict[str, Any]]] = {}
+    growth: Dict[str, int] = {}
+    pending: Dict[str, Any] = {}
+
+    for entity, entity_ref in zip(entities, entity_refs):
         entity_name = entity["name"]
         entity_type = entity["entityType"]
         observations = entity["observations"]
+        entity_id = entity_ref.id
 
-        # Create entity ID from name (sanitized)
-        entity_id = f"entity_{entity_name.lower().replace(' ', '_').replace('-', '_')}"
-
-        # Reference to entity document
-        entity_ref = db.collection("users").document(user_id).collection("knowledge_graph").collection("entities").document(entity_id)
+        new_observations = [
+            {
+                "observation_id": uuid.uuid4().hex,
+                "content": obs,
+                "learned_at": timestamp,
+                "learned_from_interface": interface,
+                "conversation_id": conversation_id
+            }
+            for obs in observations
+        ]
 
-        # Check if entity exists
-        entity_doc = entity_ref.get()
+        # Entities named twice in one call see the earlier occurrence
+        existing_data = current.get(entity_ref.path)
 
-        if entity_doc.exists:
+        if existing_data is not None:
             # Entity exists, add observations to it
-            existing_data = entity_doc.to_dict()
-            existing_observations = existing_data.get("observations", [])
-
-            # Add new observations
-            for obs in observations:
-                existing_observations.append({
-                    "content": obs,
-                    "learned_at": timestamp,
-                    "learned_from_interface": interface,
-                    "conversation_id": conversation_id
-                })
-
-            entity_ref.update({
-                "observations": existing_observations,
-                "updated_at": timestamp
-            })
+            indexed_text = " ".join(observations)
+            indexed_length = len(tokenize(indexed_text))
+
+            current[entity_ref.path] = with_observations(existing_data, new_observations, indexed_length, timestamp)
+            appended.setdefault(entity_ref.path, []).extend(new_observations)
+            growth[entity_ref.path] = growth.get(entity_ref.path, 0) + indexed_length
+            search_length = current[entity_ref.path]["search_length"]
 
             created.append({
                 "entity_id": entity_id,
@@ -321,27 +388,25 @@ async def create_entities(params: Dict[str, Any]) -> Dict[str, Any]:
             })
         else:
             # Create new entity
-            observations_data = []
-            for obs in observations:
-                observations_data.append({
-                    "content": obs,
-                    "learned_at": timestamp,
-                    "learned_from_interface": interface,
-                    "conversation_id": conversation_id
-                })
-
-            entity_ref.set({
+            indexed_text = " ".join([entity_name] + observations)
+            search_length = len(tokenize(indexed_text))
+
+            current[entity_ref.path] = {
                 "entity_id": entity_id,
                 "name": entity_name,
                 "entity_type": entity_type,
-                "observations": observations_data,
+                "observations": new_observations,
+                "observation_count": len(new_observations),
+                "latest_observation": new_observations[-1] if new_observations else None,
                 "relations": [],
+                "search_length": search_length,
+                "updated_at": timestamp,
                 "metadata": {
                     "created_at": timestamp,
                     "updated_at": timestamp,
                     "confidence": 0.95
                 }
-            })
+            }
 
             created.append({
                 "entity_id": entity_id,
@@ -350,6 +415,32 @@ async def create_entities(params: Dict[str, Any]) -> Dict[str, Any]:
                 "observations_count": len(observations)
             })
 
+        pending[entity_ref.path] = entity_ref
+
+        # Only the newly written text is indexed; existing postings are kept
+        index_entries.append(entity_posting(entity_ref, indexed_text, interface, search_length, new=existing_data is None))
+
+    writes = []
+    for path, entity_ref in pending.items():
+        if path in stored:
+            writes.extend(append_observation_writes(entity_ref, stored[path], appended[path], growth[path], timestamp))
+        else:
+            writes.append(("merge", entity_ref, new_entity_data(current[path])))
+    snapshot_changes, snapshot_view = snapshot_entity_changes(context_snapshot, {path: current[path] for path in pending}, timestamp)
+    writes.append(("merge", snapshot_ref, snapshot_changes))
+    await commit_batched(writes + posting_writes(user_id, index_entries))
+
+    document_cache.put(snapshot_ref.path, snapshot_view)
+    for path in pending:
+        document_cache.put(path, current[path])
+    if context_snapshot is None:
+        # First write since snapshots were introduced: backfill the rest
+        await rebuild_context_snapshot(user_id)
+    await asyncio.gather(
+        *(overflow_if_needed(entity_ref, current[path]) for path, entity_ref in pending.items()),
+        add_vectors(user_id, index_entries)
+    )
+
     return {
         "success": True,
         "created_entities": created,
@@ -365,20 +456,27 @@ async def add_observations(params: Dict[str, Any]) -> Dict[str, Any]:
     observations = params["observations"]
 
     updated = []
+    index_entries = []
     timestamp = datetime.utcnow()
 
-    for obs_group in observations:
+    # One batched read for every entity in the call, live as in create_entities
+    entity_refs = [entity_document(user_id, obs_group["entityName"]) for obs_group in observations]
+    snapshot_ref = context_snapshot_ref(user_id)
+    snapshots, (snapshot_doc,) = await asyncio.gather(fresh_get_all(entity_refs), cached_get_all([snapshot_ref]))
+    context_snapshot = snapshot_doc.to_dict()
+    stored = {snapshot.reference.path: snapshot.to_dict() for snapshot in snapshots if snapshot.exists}
+    current = dict(stored)
+    appended: Dict[str, List[Dict[str, Any]]] = {}
+    growth: Dict[str, int] = {}
+    pending: Dict[str, Any] = {}
+
+    for obs_group, entity_ref in zip(observations, entity_refs):
         entity_name = obs_group["entityName"]
         contents = obs_group["contents"]
 
-        # Generate entity ID
-        entity_id = f"entity_{entity_name.lower().replace(' ', '_').replace('-', '_')}"
-
-        entity_ref = db.collection("users").document(user_id).collection("knowledge_graph").collection("entities").document(entity_id)
-
-        entity_doc = entity_ref.get()
+        existing_data = current.get(entity_ref.path)
 
-        if not entity_doc.exists:
+        if existing_data is None:
             updated.append({
                 "entity_name": entity_name,
                 "status": "not_found",
@@ -387,27 +485,49 @@ async def add_observations(params: Dict[str, Any]) -> Dict[str, Any]:
             continue
 
         # Add observations
-        existing_data = entity_doc.to_dict()
-        existing_observations = existing_data.get("observations", [])
-
-        for content in contents:
-            existing_observations.append({
+        new_observations = [
+            {
+                "observation_id": uuid.uuid4().hex,
                 "content": content,
                 "learned_at": timestamp,
                 "learned_from_interface": interface,
                 "conversation_id": conversation_id
-            })
+            }
+            for content in contents
+        ]
 
-        entity_ref.update({
-            "observations": existing_observations,
-            "updated_at": timestamp
-        })
+        indexed_text = " ".join(contents)
+        indexed_length = len(tokenize(indexed_text))
+
+        current[entity_ref.path] = with_observations(existing_data, new_observations, indexed_length, timestamp)
+        appended.setdefault(entity_ref.path, []).extend(new_observations)
+        growth[entity_ref.path] = growth.get(entity_ref.path, 0) + indexed_length
+        pending[entity_ref.path] = entity_ref
 
         updated.append({
             "entity_name": entity_name,
             "status": "updated",
             "new_observations": len(contents)
         })
+        index_entries.append(entity_posting(entity_ref, indexed_text, interface, current[entity_ref.path]["search_length"]))
+
+    writes = []
+    for path, entity_ref in pending.items():
+        writes.extend(append_observation_writes(entity_ref, stored[path], appended[path], growth[path], timestamp))
+    snapshot_changes, snapshot_view = snapshot_entity_changes(context_snapshot, {path: current[path] for path in pending}, timestamp)
+    writes.append(("merge", snapshot_ref, snapshot_changes))
+    await commit_batched(writes + posting_writes(user_id, index_entries))
+
+    document_cache.put(snapshot_ref.path, snapshot_view)
+    for path in pending:
+        document_cache.put(path, current[path])
+    if context_snapshot is None:
+        # First write since snapshots were introduced: backfill the rest
+        await rebuild_context_snapshot(user_id)
+    await asyncio.gather(
+        *(overflow_if_needed(entity_ref, current[path]) for path, entity_ref in pending.items()),
+        add_vectors(user_id, index_entries)
+    )
 
     return {
         "success": True,
@@ -416,13 +536,206 @@ async def add_observations(params: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+def entity_document(user_id: str, entity_name: str):
+    """Reference to an entity document, keyed by its name sanitized as index.js does"""
+    entity_id = f"entity_{re.sub(r'[^a-z0-9]', '_', entity_name.lower())}"
+    return db.collection("users").document(user_id).collection("entities").document(entity_id)
+
+
+async def commit_batched(writes: List[tuple]) -> int:
+    """
+    Commit ("set" | "merge" | "update" | "delete", ref, data) writes.
+
+    Writes are grouped into WriteBatches of at most MAX_BATCH_SIZE
+    operations, so calls up to that size are atomic. Larger calls commit
+    their chunks concurrently. Returns the number of commits made.
+    """
+    batches = []
+    for start in range(0, len(writes), MAX_BATCH_SIZE):
+        batch = db.batch()
+        for op, ref, data in writes[start:start + MAX_BATCH_SIZE]:
+            if op == "set":
+                batch.set(ref, data)
+            elif op == "merge":
+                batch.set(ref, data, merge=True)
+            elif op == "update":
+                batch.update(ref, data)
+            elif op == "delete":
+                batch.delete(ref)
+            else:
+                raise ValueError(f"Unknown write operation: {op}")
+        batches.append(batch)
+    await asyncio.gather(*(batch.commit() for batch in batches))
+    return len(batches)
+
+
+# ============================================================================
+# OBSERVATION STORAGE
+# ============================================================================
+#
+# Observations are only ever appended. Small entities keep them inline in the
+# "observations" array, extended with ArrayUnion. Once an entity holds more
+# than OBSERVATION_INLINE_LIMIT observations they move to an "observations"
+# subcollection and the parent keeps a compact summary: observation_count,
+# latest_observation and observations_overflow=True. Use load_observations()
+# to read either layout.
+#
+# Every observation carries a random observation_id, so identical text
+# learned twice in the same instant stays two observations in both layouts.
+# A writer whose view predates the overflow can still ArrayUnion into the
+# parent; load_observations() reads such stray entries too, and the next
+# overflow_if_needed() call moves them into the subcollection.
+
+OBSERVATION_INLINE_LIMIT = int(os.environ.get("MEMORY_OBSERVATION_INLINE_LIMIT", "100"))
+
+
+def observation_count(entity: Dict[str, Any]) -> int:
+    """Observation count, falling back to the inline array for older entities"""
+    if "observation_count" in entity:
+        return entity["observation_count"]
+    return len(entity.get("observations", []))
+
+
+def with_observations(entity: Dict[str, Any], new_observations: List[Dict[str, Any]], indexed_length: int, timestamp: datetime) -> Dict[str, Any]:
+    """Local view of an entity after appending observations, used for caching"""
+    updated = {
+        **entity,
+        "observation_count": observation_count(entity) + len(new_observations),
+        "search_length": entity.get("search_length", 0) + indexed_length,
+        "updated_at": timestamp
+    }
+    if new_observations:
+        updated["latest_observation"] = new_observations[-1]
+    if not entity.get("observations_overflow"):
+        updated["observations"] = entity.get("observations", []) + new_observations
+    return updated
+
+
+def observation_document(entity_ref, observation: Dict[str, Any]):
+    """Subcollection document for an observation, keyed by its observation_id"""
+    observation_id = observation.get("observation_id")
+    if not observation_id:
+        # Observations written before ids existed are keyed by their content
+        observation_id = hashlib.sha1(json.dumps(observation, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:20]
+    return entity_ref.collection("observations").document(f"obs_{observation_id}")
+
+
+def new_entity_data(entity: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Merge-set payload creating an entity without clobbering a concurrent writer.
+
+    If another interface created the entity since it was read, its
+    observations and counters are extended rather than overwritten.
+    """
+    return {
+        **entity,
+        "observations": firestore.ArrayUnion(entity["observations"]),
+        "observation_count": firestore.Increment(entity["observation_count"]),
+        "search_length": firestore.Increment(entity["search_length"])
+    }
+
+
+def append_observation_writes(entity_ref, stored: Dict[str, Any], new_observations: List[Dict[str, Any]], indexed_length: int, timestamp: datetime) -> List[tuple]:
+    """
+    Writes appending observations to a stored entity without rewriting it.
+
+    Concurrent appends from other interfaces cannot overwrite each other:
+    the array only grows through ArrayUnion and the counters through
+    Increment.
+    """
+    changes = {
+        "search_length": firestore.Increment(indexed_length),
+        "updated_at": timestamp
+    }
+    if "observation_count" in stored:
+        changes["observation_count"] = firestore.Increment(len(new_observations))
+    else:
+        changes["observation_count"] = observation_count(stored) + len(new_observations)
+    if new_observations:
+        changes["latest_observation"] = new_observations[-1]
+
+    writes = [("update", entity_ref, changes)]
+    if stored.get("observations_overflow"):
+        writes.extend(("set", observation_document(entity_ref, obs), obs) for obs in new_observations)
+    elif new_observations:
+        changes["observations"] = firestore.ArrayUnion(new_observations)
+    return writes
+
+
+async def overflow_if_needed(entity_ref, entity: Dict[str, Any]):
+    """
+    Move an entity's inline observations to its subcollection once it passes
+    OBSERVATION_INLINE_LIMIT.
+
+    Observations are copied first with idempotent ids; a transaction then
+    copies anything appended in the meantime, drops the inline array and sets
+    observations_overflow. For an entity that has already overflowed, the
+    same steps sweep stray inline entries into the subcollection.
+    """
+    if entity.get("observations_overflow"):
+        if not entity.get("observations"):
+            return
+    elif observation_count(entity) <= OBSERVATION_INLINE_LIMIT:
+        return
+
+    snapshot = await entity_ref.get()
+    if not snapshot.exists:
+        return
+    observations = snapshot.to_dict().get("observations", [])
+    await commit_batched([("set", observation_document(entity_ref, obs), obs) for obs in observations])
+    copied = {observation_document(entity_ref, obs).id for obs in observations}
+
+    @firestore.async_transactional
+    async def finish(transaction):
+        fresh = (await entity_ref.get(transaction=transaction)).to_dict() or {}
+        inline = fresh.get("observations", [])
+        if fresh.get("observations_overflow") and not inline:
+            return
+        for obs in inline:
+            obs_ref = observation_document(entity_ref, obs)
+            if obs_ref.id not in copied:
+                transaction.set(obs_ref, obs)
+        changes = {"observations": firestore.DELETE_FIELD}
+        if not fresh.get("observations_overflow"):
+            # Strays were already counted by their writer's Increment
+            changes.update(observations_overflow=True, observation_count=len(inline))
+        transaction.update(entity_ref, changes)
+
+    await finish(db.transaction())
+    document_cache.invalidate(entity_ref.path)
+
+
+async def load_observations(entity_ref, entity: Dict[str, Any], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """An entity's observations, oldest first, from whichever layout it uses"""
+    if not entity.get("observations_overflow"):
+        observations = entity.get("observations", [])
+        return observations[-limit:] if limit else observations
+
+    query = entity_ref.collection("observations").order_by("learned_at", direction=firestore.Query.DESCENDING)
+    if limit:
+        query = query.limit(limit)
+    observations = list(reversed([doc.to_dict() async for doc in query.stream()]))
+
+    strays = entity.get("observations")
+    if strays:
+        stored = {observation_document(entity_ref, obs).id for obs in observations}
+        observations.extend(obs for obs in strays if observation_document(entity_ref, obs).id not in stored)
+        observations.sort(key=lambda obs: epoch(obs.get("learned_at")))
+        if limit:
+            observations = observations[-limit:]
+    return observations
+
+
 async def search_memory(params: Dict[str, Any]) -> Dict[str, Any]:
-    """Search across all stored knowledge"""
+    """Search across all stored knowledge, ranked by relevance"""
     user_id = params["user_id"]
     query = params["query"].lower()
     search_type = params.get("search_type", "all")
     interface_filter = params.get("interface_filter", "all")
     max_results = params.get("max_results", 10)
+    min_score = params.get("min_score", 0.0)
+    order = params.get("order", "relevance")
+    page_token = None
 
     results = {
         "entities": [],
@@ -430,65 +743,170 @@ async def search_memory(params: Dict[str, Any]) -> Dict[str, Any]:
         "conversations": []
     }
 
-    # Search entities
-    if search_type in ["entities", "all"]:
-        entities_ref = db.collection("users").document(user_id).collection("knowledge_graph").collection("entities")
-        entities_docs = entities_ref.stream()
-
-        for doc in entities_docs:
-            entity = doc.to_dict()
-            # Simple text search in name and observations
-            if query in entity.get("name", "").lower() or any(query in obs.get("content", "").lower() for obs in entity.get("observations", [])):
-                # Filter by interface if specified
-                if interface_filter != "all":
-                    # Only include observations from specified interface
-                    filtered_obs = [obs for obs in entity.get("observations", []) if obs.get("learned_from_interface") == interface_filter]
-                    if filtered_obs:
-                        entity["observations"] = filtered_obs
-                        results["entities"].append(entity)
-                else:
-                    results["entities"].append(entity)
-
-            if len(results["entities"]) >= max_results:
-                break
+    async def search_semantic():
+        # Opening the index can load the embedding model, so it happens off the loop too
+        hits = await asyncio.to_thread(lambda: vector_index(user_id).search(query, max_results, interface_filter, min_score))
+        async for hit, doc in read_candidates(hits, max_results):
+            if hit["kind"] == "entity":
+                doc["observations"] = await load_observations(db.document(hit["path"]), doc, OBSERVATION_INLINE_LIMIT)
+                doc["score"] = hit["score"]
+                results["entities"].append(doc)
+            else:
+                results["messages"].append(message_result(hit, doc))
+
+    def accepts(kind):
+        return lambda posting: posting["kind"] == kind and (
+            interface_filter == "all" or interface_filter in posting.get("interfaces", [])
+        )
 
-    # Search messages
-    if search_type in ["messages", "all"]:
-        # Get all conversations
-        convs_ref = db.collection("users").document(user_id).collection("conversations")
-        convs_docs = convs_ref.stream()
-
-        for conv_doc in convs_docs:
-            messages_ref = conv_doc.reference.collection("messages")
-            messages_docs = messages_ref.stream()
-
-            for msg_doc in messages_docs:
-                msg = msg_doc.to_dict()
-                if query in msg.get("content", "").lower():
-                    # Filter by interface if specified
-                    if interface_filter == "all" or msg.get("interface") == interface_filter:
-                        results["messages"].append({
-                            "conversation_id": conv_doc.id,
-                            "message_id": msg_doc.id,
-                            "role": msg.get("role"),
-                            "content": msg.get("content"),
-                            "interface": msg.get("interface"),
-                            "timestamp": msg.get("timestamp")
-                        })
-
-                if len(results["messages"]) >= max_results:
+    async def add_entity(path, entity, score):
+        entity["observations"] = await load_observations(db.document(path), entity, OBSERVATION_INLINE_LIMIT)
+        # Filter by interface if specified
+        if interface_filter != "all":
+            # Only include observations from specified interface
+            filtered_obs = [obs for obs in entity.get("observations", []) if obs.get("learned_from_interface") == interface_filter]
+            if not filtered_obs:
+                return
+            entity["observations"] = filtered_obs
+        entity["score"] = score
+        results["entities"].append(entity)
+
+    async def search_entities(postings_by_token, stats):
+        entity_hits = bm25_top_k(postings_by_token, stats, max_results, accepts("entity"), min_score)
+
+        found = set()
+        async for hit, entity in read_candidates(entity_hits, max_results):
+            found.add(hit["path"])
+            await add_entity(hit["path"], entity, hit["score"])
+
+        # Entities index.js wrote have no postings until rebuild-index runs
+        if len(results["entities"]) < max_results and min_score <= 0:
+            async for path, entity in unindexed_entities(user_id, tokenize(query), found):
+                await add_entity(path, entity, None)
+                if len(results["entities"]) >= max_results:
                     break
 
-            if len(results["messages"]) >= max_results:
-                break
+    async def search_messages(postings_by_token, stats):
+        message_hits = bm25_top_k(postings_by_token, stats, max_results, accepts("message"), min_score)
 
-    return {
+        async for hit, msg in read_candidates(message_hits, max_results):
+            results["messages"].append(message_result(hit, msg))
+
+    async def search_recent_messages():
+        nonlocal page_token
+        page_token = await recent_messages_page(user_id, query, interface_filter, max_results, params.get("page_token"), results["messages"])
+
+    if search_type == "semantic":
+        await search_semantic()
+    else:
+        kinds = []
+        if search_type in ["entities", "all"]:
+            kinds.append("entity")
+        if search_type in ["messages", "all"] and order != "recent":
+            kinds.append("message")
+        postings_by_kind, stats = await load_postings(user_id, tokenize(query), kinds, interface_filter)
+        searches = []
+        # Search entities
+        if search_type in ["entities", "all"]:
+            searches.append(search_entities(postings_by_kind["entity"], stats))
+        # Search messages
+        if search_type in ["messages", "all"]:
+            searches.append(search_recent_messages() if order == "recent" else search_messages(postings_by_kind["message"], stats))
+        await asyncio.gather(*searches)
+
+    response = {
         "success": True,
         "query": query,
         "results": results,
         "total_entities": len(results["entities"]),
         "total_messages": len(results["messages"])
     }
+    if order == "recent":
+        response["page_token"] = page_token
+    return response
+
+
+# A "recent" search scans at most this many pages of max_results messages
+# before handing back a page_token, so a rare query cannot walk all history
+RECENT_SCAN_PAGES = 10
+
+
+async def recent_messages_page(user_id: str, query: str, interface_filter: str, max_results: int,
+                               page_token: Optional[str], results: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Append the user's newest messages containing every query term to results.
+
+    Uses one collection-group query over "messages" ordered by sent_at, so its
+    cost follows the page size rather than the number of conversations.
+    Returns the page_token to resume after the last message looked at, or
+    None once history is exhausted.
+    """
+    query_tokens = set(tokenize(query))
+    messages_query = db.collection_group("messages").where("user_id", "==", user_id)
+    if interface_filter != "all":
+        messages_query = messages_query.where("interface", "==", interface_filter)
+    messages_query = messages_query.order_by("sent_at", direction=firestore.Query.DESCENDING)
+
+    last = None
+    if page_token:
+        try:
+            path = base64.urlsafe_b64decode(page_token.encode("ascii")).decode("utf-8")
+        except ValueError:
+            raise ValueError("Invalid page_token")
+        if not path.startswith(f"users/{user_id}/conversations/"):
+            raise ValueError("Invalid page_token")
+        last = await db.document(path).get()
+        if not last.exists:
+            raise ValueError("page_token refers to a message that no longer exists; start a new search")
+
+    page_size = max(max_results, 1)
+    scanned = 0
+    while scanned < page_size * RECENT_SCAN_PAGES:
+        page = messages_query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        docs = [doc async for doc in page.stream()]
+        for doc in docs:
+            last = doc
+            scanned += 1
+            msg = doc.to_dict()
+            if query_tokens.issubset(tokenize(msg.get("content") or "")):
+                path = doc.reference.path.split("/")
+                results.append(message_result({"conversation_id": path[-3], "message_id": doc.id, "score": None}, msg))
+                if len(results) >= max_results:
+                    break
+        if len(results) >= max_results:
+            break
+        if len(docs) < page_size:
+            return None
+    return base64.urlsafe_b64encode(last.reference.path.encode("utf-8")).decode("ascii")
+
+
+def message_sent_at(value: Any, fallback: datetime) -> datetime:
+    """Naive-UTC send time of a message, from its datetime or ISO 8601 timestamp"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return fallback
+    if not isinstance(value, datetime):
+        return fallback
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def message_result(hit: Dict[str, Any], msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a scored message hit for search_memory output"""
+    return {
+        "conversation_id": hit.get("conversation_id"),
+        "message_id": hit.get("message_id"),
+        "role": msg.get("role"),
+        "content": msg.get("content"),
+        "interface": msg.get("interface"),
+        "timestamp": msg.get("timestamp"),
+        "score": hit["score"]
+    }
 
 
 async def get_unified_context(params: Dict[str, Any]) -> Dict[str, Any]:
@@ -498,12 +916,67 @@ async def get_unified_context(params: Dict[str, Any]) -> Dict[str, Any]:
     conversation_id = params.get("conversation_id")
     include_history = params.get("include_history", True)
     max_messages = params.get("max_messages", 20)
+    latency_budget_ms = params.get("latency_budget_ms")
+    started = time.monotonic()
+    timeout = latency_budget_ms / 1000 if latency_budget_ms is not None else None
 
-    # Get user preferences
     user_ref = db.collection("users").document(user_id)
-    user_doc = user_ref.get()
+    context_ref = user_ref.collection("context_windows").document("window_latest")
+
+    # Fast path: the precomputed snapshot, the context window and the user
+    # document answer in a single batched read. The recently updated
+    # entities are read alongside, since index.js does not write the snapshot
+    snapshot_read = asyncio.ensure_future(cached_get_all([context_snapshot_ref(user_id), context_ref, user_ref]))
+    entities_read = asyncio.ensure_future(recent_entities(user_id))
+    await asyncio.wait([snapshot_read], timeout=timeout)
+    if snapshot_read.done() and snapshot_read.exception() is None and snapshot_read.result()[0].exists:
+        snapshot_doc, window_doc, user_doc = snapshot_read.result()
+        remaining = max(timeout - (time.monotonic() - started), 0) if timeout is not None else None
+        return await context_from_snapshot(snapshot_doc.to_dict(), window_doc.to_dict(), user_doc.to_dict(), params, remaining, entities_read)
+    snapshot_read.cancel()
+    entities_read.cancel()
+    if timeout is not None:
+        timeout = max(timeout - (time.monotonic() - started), 0)
+
+    conv_ref = user_ref.collection("conversations").document(conversation_id) if conversation_id else None
+    entities_ref = user_ref.collection("entities")
+    entities_query = entities_ref.order_by("metadata.updated_at", direction=firestore.Query.DESCENDING).limit(10)
+
+    async def top_entities():
+        return [doc async for doc in entities_query.stream()]
+
+    # The reads are independent, so issue them together
+    reads = {
+        "user_profile": asyncio.ensure_future(user_ref.get()),
+        "entities": asyncio.ensure_future(top_entities())
+    }
+    if include_history:
+        reads["recent_messages"] = asyncio.ensure_future(cached_get(context_ref))
+    if conv_ref:
+        reads["active_todos"] = asyncio.ensure_future(conv_ref.get())
+
+    # Past the budget, answer with what has arrived rather than hold up the reply
+    await asyncio.wait(reads.values(), timeout=timeout)
+
+    sections = {}
+    partial_sections = []
+    for section, task in reads.items():
+        if not task.done():
+            task.cancel()
+            partial_sections.append(section)
+        elif task.exception() is not None:
+            logger.warning(f"get_unified_context could not load {section}: {task.exception()}")
+            partial_sections.append(section)
+        else:
+            sections[section] = task.result()
+
+    user_doc = sections.get("user_profile")
+    context_doc = sections.get("recent_messages")
+    conv_doc = sections.get("active_todos")
+    entities_docs = sections.get("entities", [])
 
-    if user_doc.exists:
+    # Get user preferences
+    if user_doc is not None and user_doc.exists:
         user_data = user_doc.to_dict()
         preferences = user_data.get("preferences", {})
         context_summary = user_data.get("context_summary", "")
@@ -515,34 +988,25 @@ async def get_unified_context(params: Dict[str, Any]) -> Dict[str, Any]:
 
     # Get recent messages from context window
     recent_messages = []
-    if include_history:
-        context_ref = db.collection("users").document(user_id).collection("context_windows").document("window_latest")
-        context_doc = context_ref.get()
-
-        if context_doc.exists:
-            context_data = context_doc.to_dict()
-            recent_messages = context_data.get("recent_messages", [])[-max_messages:]
+    if context_doc is not None and context_doc.exists:
+        context_data = context_doc.to_dict()
+        recent_messages = window_messages(context_data)[-max_messages:]
 
     # Get active todos from latest conversation
     active_todos = []
-    if conversation_id:
-        conv_ref = db.collection("users").document(user_id).collection("conversations").document(conversation_id)
-        conv_doc = conv_ref.get()
-        if conv_doc.exists:
-            conv_data = conv_doc.to_dict()
-            active_todos = conv_data.get("active_todos", [])
+    if conv_doc is not None and conv_doc.exists:
+        conv_data = conv_doc.to_dict()
+        active_todos = conv_data.get("active_todos", [])
 
     # Get relevant entities (top recent ones)
-    entities_ref = db.collection("users").document(user_id).collection("knowledge_graph").collection("entities")
-    entities_docs = entities_ref.order_by("metadata.updated_at", direction=firestore.Query.DESCENDING).limit(10).stream()
-
     relevant_entities = []
     for doc in entities_docs:
         entity = doc.to_dict()
+        document_cache.put(doc.reference.path, entity)
         relevant_entities.append({
             "name": entity.get("name"),
             "type": entity.get("entity_type"),
-            "recent_observation": entity.get("observations", [])[-1] if entity.get("observations") else None
+            "recent_observation": entity.get("latest_observation") or (entity.get("observations") or [None])[-1]
         })
 
     return {
@@ -554,6 +1018,7 @@ async def get_unified_context(params: Dict[str, Any]) -> Dict[str, Any]:
         "recent_messages": recent_messages,
         "user_preferences": preferences,
         "relevant_entities": relevant_entities,
+        "partial_sections": partial_sections,
         "message": f"Unified context retrieved - includes data from ALL interfaces (terminal + WhatsApp)"
     }
 
@@ -569,25 +1034,48 @@ async def sync_conversation_state(params: Dict[str, Any]) -> Dict[str, Any]:
 
     timestamp = datetime.utcnow()
 
-    # Update or create conversation document
     conv_ref = db.collection("users").document(user_id).collection("conversations").document(conversation_id)
-    conv_doc = conv_ref.get()
+    context_ref = db.collection("users").document(user_id).collection("context_windows").document("window_latest")
+    snapshot_ref = context_snapshot_ref(user_id)
+
+    # Content-addressed ids make a resend of the same messages a no-op
+    message_ids = message_document_ids(conversation_id, messages)
+    msg_refs = [conv_ref.collection("messages").document(msg_id) for msg_id in message_ids]
+
+    async def existing_message_paths():
+        return {snapshot.reference.path async for snapshot in db.get_all(msg_refs) if snapshot.exists}
+
+    conv_doc, snapshot_doc, already_stored = await asyncio.gather(
+        conv_ref.get(), cached_get(snapshot_ref), existing_message_paths()
+    )
 
+    new_messages = []
+    for msg, msg_id, msg_ref in zip(messages, message_ids, msg_refs):
+        if msg_ref.path not in already_stored:
+            already_stored.add(msg_ref.path)
+            new_messages.append((msg, msg_id, msg_ref))
+    messages_deduplicated = len(messages) - len(new_messages)
+
+    # Everything is written through WriteBatches, so a sync costs one
+    # round trip per MAX_BATCH_SIZE writes
+    writes = []
+
+    # Update or create conversation document
     if conv_doc.exists:
         conv_data = conv_doc.to_dict()
         interfaces_used = conv_data.get("interfaces_used", [])
         if interface not in interfaces_used:
             interfaces_used.append(interface)
 
-        conv_ref.update({
+        writes.append(("update", conv_ref, {
             "updated_at": timestamp,
             "interfaces_used": interfaces_used,
             "active_todos": todos,
             "context_summary": context_summary if context_summary else conv_data.get("context_summary", ""),
-            "metadata.total_messages": firestore.Increment(len(messages))
-        })
+            "metadata.total_messages": firestore.Increment(len(new_messages))
+        }))
     else:
-        conv_ref.set({
+        writes.append(("set", conv_ref, {
             "conversation_id": conversation_id,
             "created_at": timestamp,
             "updated_at": timestamp,
@@ -595,92 +1083,1412 @@ async def sync_conversation_state(params: Dict[str, Any]) -> Dict[str, Any]:
             "context_summary": context_summary,
             "active_todos": todos,
             "metadata": {
-                "total_messages": len(messages),
+                "total_messages": len(new_messages),
                 "tool_calls": 0
             }
-        })
+        }))
 
     # Save messages
     messages_saved = 0
-    for msg in messages:
-        msg_id = f"msg_{timestamp.timestamp()}_{messages_saved}"
-        msg_ref = conv_ref.collection("messages").document(msg_id)
-
-        msg_ref.set({
+    index_entries = []
+    snapshot_messages = {}
+    for msg, msg_id, msg_ref in new_messages:
+        writes.append(("set", msg_ref, {
             "message_id": msg_id,
+            "user_id": user_id,
             "role": msg.get("role"),
             "content": msg.get("content"),
             "timestamp": msg.get("timestamp", timestamp),
+            "sent_at": message_sent_at(msg.get("timestamp"), timestamp + timedelta(microseconds=messages_saved)),
             "interface": interface
-        })
+        }))
+        snapshot_messages[snapshot_key(msg_ref.path)] = {
+            "role": msg.get("role"),
+            "content": msg.get("content"),
+            "interface": interface,
+            "timestamp": msg.get("timestamp", timestamp).isoformat() if isinstance(msg.get("timestamp"), datetime) else str(msg.get("timestamp", timestamp)),
+            "rank": epoch(timestamp) + messages_saved * 1e-6
+        }
         messages_saved += 1
+        index_entries.append(message_posting(msg_ref, conversation_id, msg_id, interface, msg.get("content")))
 
-    # Update context window
-    context_ref = db.collection("users").document(user_id).collection("context_windows").document("window_latest")
-    context_doc = context_ref.get()
+    writes.extend(posting_writes(user_id, index_entries))
 
-    if context_doc.exists:
-        context_data = context_doc.to_dict()
-        recent_messages = context_data.get("recent_messages", [])
-
-        # Add new messages
-        for msg in messages:
-            recent_messages.append({
-                "role": msg.get("role"),
-                "content": msg.get("content"),
-                "interface": interface,
-                "timestamp": msg.get("timestamp", timestamp).isoformat() if isinstance(msg.get("timestamp"), datetime) else str(msg.get("timestamp", timestamp))
-            })
-
-        # Keep only last 50 messages
-        recent_messages = recent_messages[-50:]
-
-        context_ref.update({
-            "updated_at": timestamp,
-            "summary": context_summary if context_summary else context_data.get("summary", ""),
-            "active_tasks": [todo.get("content") for todo in todos] if todos else context_data.get("active_tasks", []),
-            "recent_messages": recent_messages
-        })
-    else:
-        # Create new context window
-        context_ref.set({
-            "window_id": "window_latest",
-            "created_at": timestamp,
-            "updated_at": timestamp,
-            "expires_at": timestamp + timedelta(days=7),
-            "summary": context_summary,
-            "active_tasks": [todo.get("content") for todo in todos] if todos else [],
-            "recent_messages": [
-                {
-                    "role": msg.get("role"),
-                    "content": msg.get("content"),
-                    "interface": interface,
-                    "timestamp": msg.get("timestamp", timestamp).isoformat() if isinstance(msg.get("timestamp"), datetime) else str(msg.get("timestamp", timestamp))
-                }
-                for msg in messages
-            ]
-        })
+    window_entries = [
+        {
+            "role": msg.get("role"),
+            "content": msg.get("content"),
+            "interface": interface,
+            "timestamp": msg.get("timestamp", timestamp).isoformat() if isinstance(msg.get("timestamp"), datetime) else str(msg.get("timestamp", timestamp))
+        }
+        for msg, _, _ in new_messages
+    ]
 
     # Update user's last interaction
     user_ref = db.collection("users").document(user_id)
-    user_ref.set({
+    writes.append(("merge", user_ref, {
         "user_id": user_id,
         "last_interaction": {
             "interface": interface,
             "timestamp": timestamp
-        },
-        "context_summary": context_summary if context_summary else firestore.firestore.SERVER_TIMESTAMP
-    }, merge=True)
+        }
+    }))
+    if context_summary:
+        writes[-1][2]["context_summary"] = context_summary
+
+    snapshot_changes, snapshot_view = snapshot_conversation_changes(
+        snapshot_doc.to_dict(), conversation_id, todos, context_summary, snapshot_messages, timestamp
+    )
+    writes.append(("merge", snapshot_ref, snapshot_changes))
+
+    _, _, context_view = await asyncio.gather(
+        commit_batched(writes),
+        add_vectors(user_id, index_entries),
+        append_context_window(
+            context_ref, window_entries, timestamp,
+            summary=context_summary or None,
+            active_tasks=[todo.get("content") for todo in todos] if todos else None,
+            capacity=params.get("context_window_size")
+        )
+    )
+    document_cache.put(context_ref.path, context_view)
+    document_cache.put(snapshot_ref.path, snapshot_view)
+    document_cache.invalidate(user_ref.path)
+    if not snapshot_doc.exists:
+        # First write since snapshots were introduced: backfill the rest
+        await rebuild_context_snapshot(user_id)
 
     return {
         "success": True,
         "conversation_id": conversation_id,
         "messages_saved": messages_saved,
+        "messages_deduplicated": messages_deduplicated,
         "interface": interface,
         "message": f"Conversation state synced - now accessible from ALL interfaces"
     }
 
 
+def message_document_ids(conversation_id: str, messages: List[Dict[str, Any]]) -> List[str]:
+    """
+    Deterministic message ids from conversation, role, timestamp and content.
+
+    Identical messages repeated within one call (e.g. two "ok" replies with no
+    timestamp) are told apart by their occurrence number, so they are kept
+    while a resend of the whole call is still recognised.
+    """
+    occurrences: Counter = Counter()
+    ids = []
+    for msg in messages:
+        identity = json.dumps(
+            [conversation_id, msg.get("role"), str(msg.get("timestamp", "")), msg.get("content")],
+            ensure_ascii=False
+        )
+        occurrences[identity] += 1
+        digest = hashlib.sha256(f"{identity}#{occurrences[identity]}".encode("utf-8")).hexdigest()
+        ids.append(f"msg_{digest[:24]}")
+    return ids
+
+
+# ============================================================================
+# CONTEXT WINDOW
+# ============================================================================
+#
+# users/{user_id}/context_windows/window_latest keeps a user's most recent
+# messages as a ring buffer:
+#
+#   capacity  number of slots, MEMORY_CONTEXT_WINDOW_SIZE unless set per user
+#   head      sequence number the next message gets
+#   slots     map of str(seq % capacity) -> message, each carrying its "seq"
+#
+# An append is a transaction that reads the header and updates only the slots
+# it overwrites, so it writes O(new messages) bytes and concurrent syncs from
+# different interfaces cannot drop each other's messages. Older documents,
+# and messages other writers append to the legacy "recent_messages" array,
+# are folded into the ring on the next append.
+
+CONTEXT_WINDOW_SIZE = int(os.environ.get("MEMORY_CONTEXT_WINDOW_SIZE", "50"))
+
+
+def window_messages(window: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Messages of a context window, oldest first, without their sequence numbers"""
+    window = window or {}
+    ring = sorted((window.get("slots") or {}).values(), key=lambda msg: msg.get("seq", 0))
+    messages = [{key: value for key, value in msg.items() if key != "seq"} for msg in ring]
+    messages.extend(window.get("recent_messages") or [])
+    return messages[-(window.get("capacity") or CONTEXT_WINDOW_SIZE):]
+
+
+async def append_context_window(context_ref, messages: List[Dict[str, Any]], timestamp: datetime,
+                                summary: Optional[str] = None, active_tasks: Optional[List[Any]] = None,
+                                capacity: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Append messages to a context window ring buffer and return the window as it now stands.
+
+    summary and active_tasks are kept when None. Passing a capacity different
+    from the stored one resizes the ring, which rewrites it once.
+    """
+
+    @firestore.async_transactional
+    async def append(transaction):
+        snapshot = await context_ref.get(transaction=transaction)
+        window = snapshot.to_dict() if snapshot.exists else {}
+        size = max(int(capacity or window.get("capacity") or CONTEXT_WINDOW_SIZE), 1)
+        legacy = window.get("recent_messages") or []
+        head = window.get("head", 0)
+        incoming = legacy + messages
+
+        header = {
+            "updated_at": timestamp,
+            "summary": summary if summary is not None else window.get("summary", ""),
+            "active_tasks": active_tasks if active_tasks is not None else window.get("active_tasks", []),
+            "capacity": size
+        }
+
+        if not snapshot.exists or "slots" not in window or size != window.get("capacity"):
+            # New, pre-ring-buffer or resized window: lay the ring out afresh
+            kept = (window_messages({"slots": window.get("slots"), "capacity": size}) + incoming)[-size:]
+            head += len(incoming)
+            slots = {
+                str(seq % size): dict(msg, seq=seq)
+                for seq, msg in enumerate(kept, start=head - len(kept))
+            }
+            view = {
+                "window_id": "window_latest",
+                "created_at": window.get("created_at", timestamp),
+                "expires_at": window.get("expires_at", timestamp + timedelta(days=7)),
+                **header,
+                "head": head,
+                "slots": slots
+            }
+            transaction.set(context_ref, view)
+            return view
+
+        changes = dict(header)
+        slots = dict(window["slots"])
+        for seq, msg in enumerate(incoming, start=head):
+            if seq >= head + len(incoming) - size:
+                changes[f"slots.{seq % size}"] = slots[str(seq % size)] = dict(msg, seq=seq)
+        changes["head"] = head + len(incoming)
+        if legacy:
+            changes["recent_messages"] = firestore.DELETE_FIELD
+        transaction.update(context_ref, changes)
+
+        view = {key: value for key, value in window.items() if key != "recent_messages"}
+        view.update(header, head=head + len(incoming), slots=slots)
+        return view
+
+    return await append(db.transaction())
+
+
+# ============================================================================
+# CONTEXT SNAPSHOT
+# ============================================================================
+#
+# users/{user_id}/context_windows/context_snapshot is a denormalized copy of
+# what get_unified_context returns, so the hot path is one batched read of the
+# snapshot, window_latest and the user document. The last two are read live
+# because index.js and profile edits write them without touching the
+# snapshot; their copies in the snapshot are only a fallback. Writers merge
+# only what changed into its maps, keyed by a short hash of the source
+# document path:
+#
+#   recent_messages  last SNAPSHOT_MESSAGES messages      (ordered by "rank")
+#   entities         SNAPSHOT_ENTITIES most recent entities (ordered by "rank")
+#   conversations    active todos of the SNAPSHOT_CONVERSATIONS latest conversations
+#
+# Entries pushed out of a section are deleted using the cached view of the
+# snapshot. If that view is stale the map briefly holds a few extra entries,
+# which readers ignore. "python3 server.py rebuild-snapshot" regenerates it.
+
+SNAPSHOT_MESSAGES = 50
+SNAPSHOT_ENTITIES = 10
+SNAPSHOT_CONVERSATIONS = 5
+
+
+def context_snapshot_ref(user_id: str):
+    return db.collection("users").document(user_id).collection("context_windows").document("context_snapshot")
+
+
+def snapshot_key(path: str) -> str:
+    """Map key for a source document, safe to use in a field path"""
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+
+
+def epoch(value: Any) -> float:
+    """Seconds since the epoch for naive-UTC or aware datetimes"""
+    if not isinstance(value, datetime):
+        return 0.0
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def merge_snapshot_section(snapshot: Dict[str, Any], section: str, additions: Dict[str, Any], keep: int):
+    """
+    Merge entries into a snapshot section, keeping the `keep` highest ranked.
+
+    Returns (changes, view): the merge-set payload for the section, with
+    DELETE_FIELD for entries pushed out, and the section as it now stands.
+    """
+    existing = snapshot.get(section, {})
+    view = {**existing, **additions}
+    ranked = sorted(view, key=lambda key: view[key].get("rank", 0), reverse=True)
+    changes = {key: value for key, value in additions.items() if key in ranked[:keep]}
+    for key in ranked[keep:]:
+        view.pop(key)
+        if key in existing:
+            changes[key] = firestore.DELETE_FIELD
+    return changes, view
+
+
+def snapshot_entity_changes(snapshot: Optional[Dict[str, Any]], entities: Dict[str, Dict[str, Any]], timestamp: datetime):
+    """Snapshot update for entities written at timestamp; returns (changes, view)"""
+    snapshot = snapshot or {}
+    additions = {
+        snapshot_key(path): {
+            "name": entity.get("name"),
+            "type": entity.get("entity_type"),
+            "recent_observation": entity.get("latest_observation"),
+            "rank": epoch(timestamp)
+        }
+        for path, entity in entities.items()
+    }
+    changes, section = merge_snapshot_section(snapshot, "entities", additions, SNAPSHOT_ENTITIES)
+    return {"entities": changes, "updated_at": timestamp}, {**snapshot, "entities": section, "updated_at": timestamp}
+
+
+def snapshot_conversation_changes(snapshot: Optional[Dict[str, Any]], conversation_id: str, todos: List[Any], context_summary: str, messages: Dict[str, Any], timestamp: datetime):
+    """Snapshot update for a conversation sync; returns (changes, view)"""
+    snapshot = snapshot or {}
+    conversation = {snapshot_key(conversation_id): {"conversation_id": conversation_id, "active_todos": todos, "rank": epoch(timestamp)}}
+    message_changes, message_section = merge_snapshot_section(snapshot, "recent_messages", messages, SNAPSHOT_MESSAGES)
+    conversation_changes, conversation_section = merge_snapshot_section(snapshot, "conversations", conversation, SNAPSHOT_CONVERSATIONS)
+
+    changes = {
+        "recent_messages": message_changes,
+        "conversations": conversation_changes,
+        "updated_at": timestamp
+    }
+    view = {**snapshot, "recent_messages": message_section, "conversations": conversation_section, "updated_at": timestamp}
+    if context_summary:
+        changes["context_summary"] = view["context_summary"] = context_summary
+    return changes, view
+
+
+def ranked_entries(section: Dict[str, Any], limit: int, newest_first: bool) -> List[Dict[str, Any]]:
+    """The `limit` newest entries of a snapshot section, without their rank"""
+    entries = sorted(section.values(), key=lambda entry: entry.get("rank", 0), reverse=True)[:limit]
+    if not newest_first:
+        entries.reverse()
+    return [{key: value for key, value in entry.items() if key != "rank"} for entry in entries]
+
+
+async def recent_entities(user_id: str) -> Dict[str, Dict[str, Any]]:
+    """
+    The SNAPSHOT_ENTITIES most recently updated entities, as snapshot entries.
+
+    The query result is cached under the entities collection path; entity
+    listener events drop it, and without listeners it lives for the cache TTL.
+    """
+    path = f"users/{user_id}/entities"
+    watch_user(user_id)
+    hit, entries = document_cache.get(path)
+    if hit:
+        return entries
+
+    query = db.collection(path).order_by(
+        "metadata.updated_at", direction=firestore.Query.DESCENDING
+    ).limit(SNAPSHOT_ENTITIES)
+    entries = {}
+    async for doc in query.stream():
+        entity = doc.to_dict()
+        document_cache.put(doc.reference.path, entity)
+        entries[snapshot_key(doc.reference.path)] = {
+            "name": entity.get("name"),
+            "type": entity.get("entity_type"),
+            "recent_observation": entity.get("latest_observation") or (entity.get("observations") or [None])[-1],
+            "rank": epoch(entity.get("metadata", {}).get("updated_at"))
+        }
+    document_cache.put(path, entries)
+    return entries
+
+
+async def context_from_snapshot(snapshot: Dict[str, Any], window: Optional[Dict[str, Any]], user: Optional[Dict[str, Any]], params: Dict[str, Any], timeout: Optional[float], entities_read: "asyncio.Future") -> Dict[str, Any]:
+    """
+    Build the get_unified_context response from a context snapshot.
+
+    Recent messages come from the context window and the profile fields from
+    the user document when they exist, and the snapshot's entities are merged
+    with the most recently updated ones, since other writers (index.js,
+    profile edits) update those without touching the snapshot.
+    """
+    user_id = params["user_id"]
+    conversation_id = params.get("conversation_id")
+    include_history = params.get("include_history", True)
+    max_messages = params.get("max_messages", 20)
+
+    active_todos = []
+    partial_sections = []
+    if conversation_id:
+        conversation = snapshot.get("conversations", {}).get(snapshot_key(conversation_id))
+        if conversation is not None:
+            active_todos = conversation.get("active_todos", [])
+        else:
+            # Older conversation, not kept in the snapshot
+            conv_ref = db.collection("users").document(user_id).collection("conversations").document(conversation_id)
+            try:
+                conv_doc = await asyncio.wait_for(conv_ref.get(), timeout)
+                if conv_doc.exists:
+                    active_todos = conv_doc.to_dict().get("active_todos", [])
+            except asyncio.TimeoutError:
+                partial_sections.append("active_todos")
+
+    recent_messages = []
+    if include_history:
+        if window is not None:
+            recent_messages = window_messages(window)[-max_messages:]
+        else:
+            recent_messages = ranked_entries(snapshot.get("recent_messages", {}), max_messages, newest_first=False)
+    profile = user if user is not None else snapshot
+
+    entities = dict(snapshot.get("entities", {}))
+    try:
+        recent = await asyncio.wait_for(entities_read, timeout)
+    except asyncio.TimeoutError:
+        partial_sections.append("relevant_entities")
+        recent = {}
+    except Exception as e:
+        logger.warning(f"get_unified_context could not load recent entities: {e}")
+        partial_sections.append("relevant_entities")
+        recent = {}
+    for key, entry in recent.items():
+        if entry.get("rank", 0) >= entities.get(key, {}).get("rank", 0):
+            entities[key] = entry
+
+    return {
+        "success": True,
+        "current_interface": params["current_interface"],
+        "context_summary": profile.get("context_summary", ""),
+        "active_projects": profile.get("active_projects", []),
+        "active_todos": active_todos,
+        "recent_messages": recent_messages,
+        "user_preferences": profile.get("preferences", {}),
+        "relevant_entities": ranked_entries(entities, SNAPSHOT_ENTITIES, newest_first=True),
+        "partial_sections": partial_sections,
+        "message": f"Unified context retrieved - includes data from ALL interfaces (terminal + WhatsApp)"
+    }
+
+
+async def rebuild_context_snapshot(user_id: str) -> Dict[str, Any]:
+    """Regenerate a user's context snapshot from the source collections"""
+    user_ref = db.collection("users").document(user_id)
+    entities_query = user_ref.collection("entities").order_by(
+        "metadata.updated_at", direction=firestore.Query.DESCENDING
+    ).limit(SNAPSHOT_ENTITIES)
+    conversations_query = user_ref.collection("conversations").order_by(
+        "updated_at", direction=firestore.Query.DESCENDING
+    ).limit(SNAPSHOT_CONVERSATIONS)
+
+    async def collect(query):
+        return [doc async for doc in query.stream()]
+
+    user_doc, window_doc, entity_docs, conversation_docs = await asyncio.gather(
+        user_ref.get(),
+        user_ref.collection("context_windows").document("window_latest").get(),
+        collect(entities_query),
+        collect(conversations_query)
+    )
+    user_data = user_doc.to_dict() if user_doc.exists else {}
+    window = window_doc.to_dict() if window_doc.exists else {}
+
+    recent_messages = {}
+    for position, msg in enumerate(window_messages(window)[-SNAPSHOT_MESSAGES:]):
+        recent_messages[snapshot_key(f"window_latest/{position}/{msg.get('timestamp')}")] = dict(msg, rank=float(position))
+
+    entities = {}
+    for position, doc in enumerate(entity_docs):
+        entity = doc.to_dict()
+        entities[snapshot_key(doc.reference.path)] = {
+            "name": entity.get("name"),
+            "type": entity.get("entity_type"),
+            "recent_observation": entity.get("latest_observation") or (entity.get("observations") or [None])[-1],
+            "rank": epoch((entity.get("metadata") or {}).get("updated_at")) or -float(position)
+        }
+
+    conversations = {}
+    for doc in conversation_docs:
+        conversation = doc.to_dict()
+        conversations[snapshot_key(doc.id)] = {
+            "conversation_id": doc.id,
+            "active_todos": conversation.get("active_todos", []),
+            "rank": epoch(conversation.get("updated_at"))
+        }
+
+    snapshot = {
+        "user_id": user_id,
+        "preferences": user_data.get("preferences", {}),
+        "context_summary": user_data.get("context_summary", "") if isinstance(user_data.get("context_summary"), str) else "",
+        "active_projects": user_data.get("active_projects", []),
+        "recent_messages": recent_messages,
+        "entities": entities,
+        "conversations": conversations,
+        "updated_at": datetime.utcnow()
+    }
+    snapshot_ref = context_snapshot_ref(user_id)
+    await snapshot_ref.set(snapshot)
+    document_cache.put(snapshot_ref.path, snapshot)
+
+    return {"user_id": user_id, "messages": len(recent_messages), "entities": len(entities), "conversations": len(conversations)}
+
+
+# ============================================================================
+# SEARCH INDEX
+# ============================================================================
+#
+# Every posting is its own document,
+# users/{user_id}/search_index/{token}/postings/{posting_id}, so no token
+# document grows with the number of documents that use the word:
+#
+#   {"token": ..., "kind": "entity" | "message", "path": ..., "tf": <term
+#    frequency>, "dl": <document length in tokens>, "interfaces": [...]}
+#
+# posting_id is a hash of the indexed document's path. "interfaces" lists the
+# interfaces whose text contributed the token, so interface filters apply
+# without reading the document. Message postings also carry conversation_id
+# and message_id. A query reads at most SEARCH_MAX_POSTINGS postings per
+# token and kind, highest tf first, plus a count of the token's postings for
+# its document frequency. The postings queries need composite indexes on the
+# "postings" collection: (kind, tf desc) and (kind, interfaces
+# array-contains, tf desc). Corpus statistics used for BM25 live in search_index/_stats,
+# which can never collide with a token.
+
+SEARCH_INDEX_COLLECTION = "search_index"
+SEARCH_STATS_DOC = "_stats"
+SEARCH_POSTINGS_COLLECTION = "postings"
+SEARCH_MAX_POSTINGS = int(os.environ.get("MEMORY_SEARCH_MAX_POSTINGS", "200"))
+# index.js writes entities without postings; keyword searches also scan this
+# many of the most recently updated entities for matches
+SEARCH_UNINDEXED_ENTITIES = int(os.environ.get("MEMORY_SEARCH_UNINDEXED_ENTITIES", "50"))
+
+# Standard BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "with"
+})
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split text into lowercase index tokens, dropping stopwords"""
+    if not text:
+        return []
+    return [token for token in TOKEN_PATTERN.findall(str(text).lower()) if token not in STOPWORDS]
+
+
+def search_index_ref(user_id: str):
+    """Collection holding a user's postings lists"""
+    return db.collection("users").document(user_id).collection(SEARCH_INDEX_COLLECTION)
+
+
+def postings_ref(index_ref, token: str):
+    """Collection holding one token's postings"""
+    return index_ref.document(token).collection(SEARCH_POSTINGS_COLLECTION)
+
+
+def posting_id(path: str) -> str:
+    """Document id of the posting for the document at path"""
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:20]
+
+
+def entity_posting(entity_ref, text: str, interface: str, doc_length: int, new: bool = False) -> Dict[str, Any]:
+    """
+    Build an index entry for text added to an entity.
+
+    doc_length is the entity's total indexed length after this write. Postings
+    for tokens not in text keep the length recorded when they were written, an
+    approximation that only affects BM25 length normalisation.
+    """
+    return {
+        "path": entity_ref.path,
+        "text": text,
+        "new": new,
+        "posting": {"kind": "entity", "path": entity_ref.path, "dl": doc_length, "interfaces": [interface]}
+    }
+
+
+def message_posting(msg_ref, conversation_id: str, message_id: str, interface: str, content: Optional[str]) -> Dict[str, Any]:
+    """Build an index entry for a conversation message"""
+    return {
+        "path": msg_ref.path,
+        "text": content or "",
+        "new": True,
+        "posting": {
+            "kind": "message",
+            "path": msg_ref.path,
+            "dl": len(tokenize(content)),
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "interfaces": [interface]
+        }
+    }
+
+
+def posting_writes(user_id: str, entries: List[Dict[str, Any]], increment: bool = True) -> List[tuple]:
+    """
+    Build the batched writes that merge index entries into the postings lists.
+
+    Entries are grouped by token and document so each posting is written
+    once. Postings of documents created by these entries are written as plain
+    values. Otherwise, with increment=True, term frequencies, interfaces and
+    corpus statistics are added to what is stored, so text appended to an
+    existing document extends its postings; with increment=False they
+    overwrite it (used by rebuilds).
+    """
+    by_token: Dict[str, Dict[str, Any]] = {}
+    new_paths = set()
+    new_documents = 0
+    total_length = 0
+    for entry in entries:
+        tokens = tokenize(entry["text"])
+        if entry["new"]:
+            new_documents += 1
+            new_paths.add(entry["path"])
+        total_length += len(tokens)
+        for token, tf in Counter(tokens).items():
+            postings = by_token.setdefault(token, {})
+            posting = postings.get(entry["path"])
+            if posting is None:
+                postings[entry["path"]] = dict(entry["posting"], tf=tf)
+            else:
+                # Several entries for one document in the same call
+                posting["tf"] += tf
+                posting["dl"] = max(posting["dl"], entry["posting"]["dl"])
+                posting["interfaces"] = list(dict.fromkeys(posting["interfaces"] + entry["posting"]["interfaces"]))
+
+    if not by_token:
+        return []
+
+    index_ref = search_index_ref(user_id)
+    writes = []
+    for token, postings in by_token.items():
+        for path, posting in postings.items():
+            ref = postings_ref(index_ref, token).document(posting_id(path))
+            if increment and path not in new_paths:
+                posting["tf"] = firestore.Increment(posting["tf"])
+                posting["interfaces"] = firestore.ArrayUnion(posting["interfaces"])
+                writes.append(("merge", ref, dict(posting, token=token)))
+            else:
+                # Postings of documents created by this write are plain values
+                writes.append(("set", ref, dict(posting, token=token)))
+
+    if increment:
+        writes.append(("merge", index_ref.document(SEARCH_STATS_DOC), {
+            "documents": firestore.Increment(new_documents),
+            "total_length": firestore.Increment(total_length)
+        }))
+    else:
+        writes.append(("merge", index_ref.document(SEARCH_STATS_DOC), {
+            "documents": new_documents,
+            "total_length": total_length
+        }))
+
+    return writes
+
+
+async def write_postings(user_id: str, entries: List[Dict[str, Any]], increment: bool = True) -> List[tuple]:
+    """Merge index entries into the user's postings lists; returns the writes made"""
+    writes = posting_writes(user_id, entries, increment)
+    await commit_batched(writes)
+    return writes
+
+
+async def load_postings(user_id: str, tokens: List[str], kinds: List[str] = ("entity", "message"), interface_filter: str = "all"):
+    """
+    Fetch the postings lists for the query tokens plus corpus statistics.
+
+    Each token's postings of each kind are read highest tf first, at most
+    SEARCH_MAX_POSTINGS of them, with the interface filter applied in the
+    query, so common messages cannot crowd entities out of the limit. A count
+    aggregation gives the token's full document frequency; every read runs
+    concurrently. Returns (postings_by_kind, stats): postings_by_kind maps
+    each kind to {token: {path: posting}}, omitting tokens with no postings
+    of that kind, and stats["df"] maps token to document frequency.
+    """
+    unique_tokens = list(dict.fromkeys(tokens))
+    postings_by_kind = {kind: {} for kind in kinds}
+    if not unique_tokens or not kinds:
+        return postings_by_kind, {}
+
+    index_ref = search_index_ref(user_id)
+
+    async def read_postings(token, kind):
+        query = postings_ref(index_ref, token).where("kind", "==", kind)
+        if interface_filter != "all":
+            query = query.where("interfaces", "array_contains", interface_filter)
+        snapshots = await query.order_by("tf", direction=firestore.Query.DESCENDING).limit(SEARCH_MAX_POSTINGS).get()
+        return token, kind, {snapshot.get("path"): snapshot.to_dict() for snapshot in snapshots}
+
+    async def count_postings(token):
+        counts = await postings_ref(index_ref, token).count().get()
+        return token, counts[0][0].value
+
+    stats_snapshot, counts, postings_reads = await asyncio.gather(
+        index_ref.document(SEARCH_STATS_DOC).get(),
+        asyncio.gather(*(count_postings(token) for token in unique_tokens)),
+        asyncio.gather(*(read_postings(token, kind) for token in unique_tokens for kind in kinds))
+    )
+
+    stats = stats_snapshot.to_dict() if stats_snapshot.exists else {}
+    stats["df"] = {}
+    for token, kind, postings in postings_reads:
+        if postings:
+            postings_by_kind[kind][token] = postings
+            stats["df"][token] = max(stats["df"].get(token, 0), len(postings))
+    for token, df in counts:
+        if token in stats["df"]:
+            stats["df"][token] = max(stats["df"][token], df)
+
+    return postings_by_kind, stats
+
+
+async def unindexed_entities(user_id: str, query_tokens: List[str], skip: set):
+    """
+    Yield (path, entity) for recently updated entities containing every query
+    token, other than those at the paths in skip.
+
+    index.js writes entities without postings, so keyword searches also scan
+    the SEARCH_UNINDEXED_ENTITIES most recently updated entities. Older
+    entities written by index.js are only found after rebuild-index.
+    """
+    query_tokens = set(query_tokens)
+    if not query_tokens or SEARCH_UNINDEXED_ENTITIES <= 0:
+        return
+    query = db.collection("users").document(user_id).collection("entities").order_by(
+        "metadata.updated_at", direction=firestore.Query.DESCENDING
+    ).limit(SEARCH_UNINDEXED_ENTITIES)
+    async for doc in query.stream():
+        path = doc.reference.path
+        if path in skip:
+            continue
+        entity = doc.to_dict()
+        document_cache.put(path, entity)
+        text = " ".join([entity.get("name") or ""] + [obs.get("content") or "" for obs in entity.get("observations", [])])
+        if query_tokens.issubset(tokenize(text)):
+            yield path, entity
+
+
+def bm25_top_k(postings_by_token: Dict[str, Dict[str, Any]], stats: Dict[str, Any], k: int, accept=None, min_score: float = 0.0) -> List[Dict[str, Any]]:
+    """
+    Return the k best postings by BM25 score, highest first.
+
+    Terms are scored term-at-a-time in decreasing order of their maximum
+    possible contribution (MaxScore). Once the k-th best partial score beats
+    the combined maximum of the terms still to be scored, no unseen document
+    can reach the top k, so later terms only refine existing candidates.
+    Postings rejected by accept, or scoring below min_score, are dropped.
+    """
+    if k <= 0 or not postings_by_token:
+        return []
+
+    # Postings lists may be truncated, so df comes from stats["df"] when known
+    dfs = {token: stats.get("df", {}).get(token, len(postings)) for token, postings in postings_by_token.items()}
+    # Corpus statistics can lag behind the postings, so never let N < df
+    num_docs = max(stats.get("documents", 0), max(dfs.values()))
+    avg_length = (stats.get("total_length", 0) / num_docs) or 1.0
+
+    terms = []
+    for token, postings in postings_by_token.items():
+        df = dfs[token]
+        idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+        terms.append((idf * (BM25_K1 + 1), idf, postings))
+    terms.sort(key=lambda term: term[0], reverse=True)
+
+    remaining_bound = sum(term[0] for term in terms)
+    scores: Dict[str, float] = {}
+    best: Dict[str, Dict[str, Any]] = {}
+
+    for upper_bound, idf, postings in terms:
+        remaining_bound -= upper_bound
+        threshold = min_score
+        if len(scores) >= k:
+            threshold = max(threshold, heapq.nlargest(k, scores.values())[-1])
+        admit_new = upper_bound + remaining_bound >= threshold
+
+        for path, posting in postings.items():
+            if path not in scores:
+                if not admit_new or (accept is not None and not accept(posting)):
+                    continue
+                scores[path] = 0.0
+                best[path] = posting
+            tf = posting.get("tf", 0)
+            norm = 1 - BM25_B + BM25_B * posting.get("dl", avg_length) / avg_length
+            scores[path] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+    top = heapq.nlargest(k, ((score, path) for path, score in scores.items() if score >= min_score))
+    return [dict(best[path], score=round(score, 4)) for score, path in top]
+
+
+async def read_candidates(candidates: List[Dict[str, Any]], page_size: int):
+    """
+    Yield (posting, document) pairs for candidates in rank order.
+
+    Documents are fetched with batched get_all calls of page_size so only the
+    hits the caller actually consumes are read. Postings whose document no
+    longer exists are skipped.
+    """
+    page_size = max(page_size, 1)
+    for start in range(0, len(candidates), page_size):
+        page = candidates[start:start + page_size]
+        snapshots = {
+            snapshot.reference.path: snapshot
+            async for snapshot in db.get_all([db.document(c["path"]) for c in page])
+        }
+        for candidate in page:
+            snapshot = snapshots.get(candidate["path"])
+            if snapshot is not None and snapshot.exists:
+                yield candidate, snapshot.to_dict()
+
+
+async def rebuild_search_index(user_id: str) -> Dict[str, Any]:
+    """
+    Regenerate a user's search index from the source collections.
+
+    Fresh postings overwrite the stored ones first and only postings that
+    are no longer produced are deleted afterwards, so searches keep working
+    while the rebuild runs.
+    """
+    entries = []
+    entities_ref = db.collection("users").document(user_id).collection("entities")
+    async for doc in entities_ref.stream():
+        entity = doc.to_dict()
+        observations = await load_observations(doc.reference, entity)
+        doc_length = len(tokenize(entity.get("name", ""))) + sum(len(tokenize(obs.get("content", ""))) for obs in observations)
+        creator = observations[0].get("learned_from_interface") if observations else None
+        entries.append(entity_posting(doc.reference, entity.get("name", ""), creator, doc_length, new=True))
+        for obs in observations:
+            entries.append(entity_posting(doc.reference, obs.get("content", ""), obs.get("learned_from_interface"), doc_length))
+
+    # Older messages also get the fields "recent" searches filter and sort on
+    backfill = []
+    convs_ref = db.collection("users").document(user_id).collection("conversations")
+    async for conv_doc in convs_ref.stream():
+        async for msg_doc in conv_doc.reference.collection("messages").stream():
+            msg = msg_doc.to_dict()
+            entries.append(message_posting(msg_doc.reference, conv_doc.id, msg_doc.id, msg.get("interface"), msg.get("content")))
+            if "user_id" not in msg or "sent_at" not in msg:
+                fallback = conv_doc.to_dict().get("created_at") or datetime.utcnow()
+                backfill.append(("update", msg_doc.reference, {
+                    "user_id": user_id,
+                    "sent_at": message_sent_at(msg.get("timestamp"), fallback)
+                }))
+
+    writes, _ = await asyncio.gather(write_postings(user_id, entries, increment=False), commit_batched(backfill))
+
+    written = {ref.path for _, ref, _ in writes}
+    stale = []
+    index_ref = search_index_ref(user_id)
+    async for token_ref in index_ref.list_documents():
+        async for posting_ref in token_ref.collection(SEARCH_POSTINGS_COLLECTION).list_documents():
+            if posting_ref.path not in written:
+                stale.append(("delete", posting_ref, None))
+    # Token documents only exist in the older layout, which held postings inline
+    async for token_doc in index_ref.stream():
+        if token_doc.id != SEARCH_STATS_DOC:
+            stale.append(("delete", token_doc.reference, None))
+    await commit_batched(stale)
+
+    def reindex_vectors():
+        vectors = vector_index(user_id)
+        vectors.reset()
+        vectors.add(entries)
+        return len(vectors)
+
+    vector_count = await asyncio.to_thread(reindex_vectors)
+
+    return {
+        "user_id": user_id,
+        "documents_indexed": sum(1 for e in entries if e["new"]),
+        "tokens": len({data["token"] for _, _, data in writes if "token" in data}),
+        "postings_deleted": sum(1 for _, ref, _ in stale if ref.parent.id == SEARCH_POSTINGS_COLLECTION),
+        "vectors": vector_count,
+        "messages_backfilled": len(backfill)
+    }
+
+
+# ============================================================================
+# SEMANTIC INDEX
+# ============================================================================
+#
+# Each user has an append-only vector store on local disk:
+#
+#   {MEMORY_VECTOR_DIR}/{user}/{embedder}/vectors.f32  float32 rows, memory-mapped
+#   {MEMORY_VECTOR_DIR}/{user}/{embedder}/rows.jsonl   one posting per row
+#
+# A row is written for every index entry, so an entity gets one row per
+# batch of observations and is scored by its best row. Vectors are unit
+# length, so a single matrix-vector product gives cosine similarity for every
+# row. Appends take an exclusive flock so several MCP server processes can
+# share a store; readers re-map the file when it grows.
+#
+# The store is a derived cache of Firestore: "python3 server.py rebuild-index"
+# regenerates it.
+
+VECTOR_DIR = os.path.expanduser(os.environ.get("MEMORY_VECTOR_DIR", "~/.memory-unified/vectors"))
+
+# Optional sentence-transformers model name; the hashing embedder is used
+# when unset or when the package is not installed
+EMBEDDING_MODEL = os.environ.get("MEMORY_EMBEDDING_MODEL", "")
+
+EMBEDDING_DIM = 384
+
+
+class HashingEmbedder:
+    """
+    Dependency-free embedder using signed feature hashing.
+
+    Features are word tokens plus character 4-grams of each word, so
+    inflections such as "deploy" / "deployed" land close together.
+    """
+
+    name = "hashing-v1"
+    dim = EMBEDDING_DIM
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self._features(text)).items():
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                vectors[row, h % self.dim] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @staticmethod
+    def _features(text: str) -> List[str]:
+        features = []
+        for token in tokenize(text):
+            features.append(token)
+            padded = f"<{token}>"
+            features.extend(f"#{padded[i:i + 4]}" for i in range(max(len(padded) - 3, 1)))
+        return features
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedding model from the sentence-transformers package"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.name = model_name.replace("/", "_")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def load_embedder():
+    """Use the configured embedding model, falling back to feature hashing"""
+    if EMBEDDING_MODEL:
+        try:
+            return SentenceTransformerEmbedder(EMBEDDING_MODEL)
+        except Exception as e:
+            logger.warning(f"Embedding model {EMBEDDING_MODEL} unavailable ({e}), using hashing embedder")
+    return HashingEmbedder()
+
+
+class VectorIndex:
+    """
+    Append-only, memory-mapped vector store for one user.
+
+    Searches run in worker threads, so the in-memory view (rows, rows_offset,
+    matrix, interface_masks) is only changed under _lock, and always replaced
+    rather than mutated so a search can keep using the view it captured.
+    """
+
+    def __init__(self, user_id: str, embedder):
+        self.embedder = embedder
+        safe_user = re.sub(r"[^A-Za-z0-9@._+-]", "_", user_id)
+        self.directory = os.path.join(VECTOR_DIR, safe_user, embedder.name)
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.rows_path = os.path.join(self.directory, "rows.jsonl")
+        self.lock_path = os.path.join(self.directory, ".lock")
+        self.row_bytes = embedder.dim * 4
+        self.matrix = np.zeros((0, embedder.dim), dtype=np.float32)
+        self.rows: List[Dict[str, Any]] = []
+        self.rows_offset = 0
+        self.interface_masks: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self.rows)
+
+    def refresh(self):
+        """Pick up rows appended since the last read, by this or another process"""
+        with self._lock:
+            if not os.path.exists(self.rows_path):
+                return
+            with open(self.rows_path, "rb") as f:
+                f.seek(self.rows_offset)
+                data = f.read()
+            # Ignore a trailing line another process is still writing
+            complete = data[:data.rfind(b"\n") + 1]
+            if not complete:
+                return
+
+            rows = self.rows + [json.loads(line) for line in complete.splitlines()]
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(rows), self.embedder.dim))
+            self.rows = rows
+            self.rows_offset += len(complete)
+            self.interface_masks = {}
+
+    def add(self, entries: List[Dict[str, Any]]) -> int:
+        """Embed index entries and append them to the store"""
+        entries = [entry for entry in entries if entry["text"].strip()]
+        if not entries:
+            return 0
+
+        vectors = self.embedder.embed([entry["text"] for entry in entries])
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Vectors are written first so a reader never sees a row without one
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self.rows_path, "a", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry["posting"]) + "\n")
+        return len(entries)
+
+    def reset(self):
+        """Remove every stored vector"""
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self._lock:
+                for path in (self.vectors_path, self.rows_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+                self.rows = []
+                self.rows_offset = 0
+                self.interface_masks = {}
+
+    def search(self, query: str, k: int, interface_filter: str = "all", min_score: float = 0.0) -> List[Dict[str, Any]]:
+        """Return up to k postings most similar to query, one per document, best first"""
+        self.refresh()
+        with self._lock:
+            rows, matrix = self.rows, self.matrix
+            mask = self._interface_mask(interface_filter) if interface_filter != "all" else None
+        if not rows or k <= 0:
+            return []
+
+        query_vector = self.embedder.embed([query])[0]
+        scores = matrix @ query_vector
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+
+        # Entities can own several rows, so over-fetch before de-duplicating
+        fetch = min(len(scores), k * 4)
+        top = np.argpartition(-scores, fetch - 1)[:fetch]
+        top = top[np.argsort(-scores[top])]
+
+        hits = []
+        seen = set()
+        for i in top:
+            score = float(scores[i])
+            if score < min_score or score == -np.inf:
+                break
+            row = rows[i]
+            if row["path"] in seen:
+                continue
+            seen.add(row["path"])
+            hits.append(dict(row, score=round(score, 4)))
+            if len(hits) >= k:
+                break
+        return hits
+
+
+    def _interface_mask(self, interface: str) -> np.ndarray:
+        """Rows carrying text from interface, cached until the next refresh; call with _lock held"""
+        if interface not in self.interface_masks:
+            self.interface_masks[interface] = np.fromiter(
+                (interface in row.get("interfaces", []) for row in self.rows), dtype=bool, count=len(self.rows)
+            )
+        return self.interface_masks[interface]
+
+
+_embedder = None
+_vector_indexes: Dict[str, VectorIndex] = {}
+_vector_indexes_lock = threading.Lock()
+
+
+def vector_index(user_id: str) -> VectorIndex:
+    """Shared per-user vector store"""
+    global _embedder
+    with _vector_indexes_lock:
+        if _embedder is None:
+            _embedder = load_embedder()
+        if user_id not in _vector_indexes:
+            _vector_indexes[user_id] = VectorIndex(user_id, _embedder)
+        return _vector_indexes[user_id]
+
+
+async def add_vectors(user_id: str, entries: List[Dict[str, Any]]):
+    """Embed freshly written entries; Firestore stays the source of truth on failure"""
+    try:
+        # Loading the embedder, embedding and file appends are blocking, keep
+        # them off the event loop
+        await asyncio.to_thread(lambda: vector_index(user_id).add(entries))
+    except Exception as e:
+        logger.warning(f"Vector index update failed for {user_id}: {e}")
+
+
+# ============================================================================
+# DOCUMENT CACHE
+# ============================================================================
+#
+# Entity documents and context windows are cached in-process so repeated
+# reads within a session skip the Firestore round trip. Tool writes go
+# through the cache. Writes made by other processes (e.g. the WhatsApp
+# service) are picked up by per-user on_snapshot listeners; TTL expiry bounds
+# staleness if a listener misses something.
+
+CACHE_MAX_ENTRIES = int(os.environ.get("MEMORY_CACHE_MAX_ENTRIES", "4096"))
+CACHE_MAX_BYTES = int(os.environ.get("MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_SECONDS = float(os.environ.get("MEMORY_CACHE_TTL_SECONDS", "300"))
+CACHE_LISTENERS = os.environ.get("MEMORY_CACHE_LISTENERS", "1") != "0"
+CACHE_MAX_WATCHED_USERS = int(os.environ.get("MEMORY_CACHE_MAX_WATCHED_USERS", "32"))
+
+
+class CachedSnapshot:
+    """Minimal stand-in for a DocumentSnapshot served from the cache"""
+
+    def __init__(self, reference, data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        # Callers mutate what they get back, so never hand out cached objects
+        return copy.deepcopy(self._data)
+
+
+class DocumentCache:
+    """
+    Thread-safe LRU of document data keyed by path, bounded by entry count
+    and approximate size, with per-entry TTL.
+
+    None is cached as "document does not exist".
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, path: str):
+        """Return (hit, data) for path"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            data, size, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(path)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return True, data
+
+    def put(self, path: str, data: Optional[Dict[str, Any]]):
+        """Store a copy of data for path, evicting least recently used entries"""
+        data = copy.deepcopy(data)
+        size = len(path) + len(json.dumps(data, default=str))
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            if size > self.max_bytes:
+                return
+            self._entries[path] = (data, size, time.monotonic() + self.ttl_seconds)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path: str):
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+                self.invalidations += 1
+
+    def invalidate_prefix(self, prefix: str):
+        """Drop every entry under a path prefix, e.g. all of one user's documents"""
+        with self._lock:
+            for path in [p for p in self._entries if p.startswith(prefix)]:
+                self._remove(path)
+                self.invalidations += 1
+
+    def _remove(self, path: str):
+        _, size, _ = self._entries.pop(path)
+        self._bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "watched_users": len(_cache_watches)
+            }
+
+
+document_cache = DocumentCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL_SECONDS)
+
+# user_id -> snapshot watches keeping that user's cache entries fresh
+_cache_watches: "OrderedDict[str, list]" = OrderedDict()
+_cache_watches_lock = threading.Lock()
+
+# The async client has no on_snapshot, so listeners use a synchronous client
+_listener_db = None
+
+
+async def cached_get(ref) -> Any:
+    """Read a document through the cache"""
+    return (await cached_get_all([ref]))[0]
+
+
+async def fresh_get_all(refs: List[Any]) -> List[CachedSnapshot]:
+    """Read documents from Firestore in one get_all, refreshing the cache"""
+    found: Dict[str, Optional[Dict[str, Any]]] = {}
+    if refs:
+        watch_user(refs[0].path.split("/")[1])
+        async for snapshot in db.get_all(refs):
+            data = snapshot.to_dict() if snapshot.exists else None
+            found[snapshot.reference.path] = data
+            document_cache.put(snapshot.reference.path, data)
+    return [CachedSnapshot(ref, found.get(ref.path)) for ref in refs]
+
+
+async def cached_get_all(refs: List[Any]) -> List[CachedSnapshot]:
+    """Read documents through the cache, fetching all misses in one get_all"""
+    found: Dict[str, Optional[Dict[str, Any]]] = {}
+    missing = {}
+    for ref in refs:
+        watch_user(ref.path.split("/")[1])
+        hit, data = document_cache.get(ref.path)
+        if hit:
+            found[ref.path] = data
+        else:
+            missing[ref.path] = ref
+
+    if missing:
+        async for snapshot in db.get_all(list(missing.values())):
+            data = snapshot.to_dict() if snapshot.exists else None
+            found[snapshot.reference.path] = data
+            document_cache.put(snapshot.reference.path, data)
+
+    return [CachedSnapshot(ref, found.get(ref.path)) for ref in refs]
+
+
+def _on_cache_snapshot(docs, changes, read_time):
+    """Apply changes seen by a snapshot listener to the cache"""
+    for change in changes:
+        path = change.document.reference.path
+        if change.type.name == "REMOVED":
+            document_cache.invalidate(path)
+        else:
+            document_cache.put(path, change.document.to_dict())
+        if path.rsplit("/", 2)[-2] == "entities":
+            # The cached recent_entities query result
+            document_cache.invalidate(path.rsplit("/", 1)[0])
+
+
+def watch_user(user_id: str):
+    """
+    Start snapshot listeners for a user's document, entities, context window
+    and context snapshot.
+
+    The entity listeners only cover documents updated after they start, so
+    they do not stream the whole collection. There is one on updated_at,
+    which this server sets, and one on metadata.updated_at, the only
+    timestamp index.js writes. At most CACHE_MAX_WATCHED_USERS
+    users are watched; when one is dropped its cache entries are dropped too.
+    """
+    if not CACHE_LISTENERS:
+        return
+
+    with _cache_watches_lock:
+        if user_id in _cache_watches:
+            _cache_watches.move_to_end(user_id)
+            return
+
+        global _listener_db
+        watches = []
+        try:
+            if _listener_db is None:
+                _listener_db = firestore.Client(project=FIRESTORE_PROJECT)
+            user_ref = _listener_db.collection("users").document(user_id)
+            entities_ref = user_ref.collection("entities")
+            context_ref = user_ref.collection("context_windows").document("window_latest")
+            since = datetime.utcnow()
+            watches.append(entities_ref.where("updated_at", ">=", since).on_snapshot(_on_cache_snapshot))
+            watches.append(entities_ref.where("metadata.updated_at", ">=", since).on_snapshot(_on_cache_snapshot))
+            watches.append(context_ref.on_snapshot(_on_cache_snapshot))
+            watches.append(user_ref.on_snapshot(_on_cache_snapshot))
+            watches.append(user_ref.collection("context_windows").document("context_snapshot").on_snapshot(_on_cache_snapshot))
+        except Exception as e:
+            # Entries for this user now rely on TTL expiry alone
+            logger.warning(f"Cache listener for {user_id} failed to start: {e}")
+            for watch in watches:
+                watch.unsubscribe()
+            watches = []
+        _cache_watches[user_id] = watches
+
+        while len(_cache_watches) > CACHE_MAX_WATCHED_USERS:
+            stale_user, watches = _cache_watches.popitem(last=False)
+            for watch in watches:
+                watch.unsubscribe()
+            document_cache.invalidate_prefix(f"users/{stale_user}/")
+
+
+# ============================================================================
+# USER RESOLUTION
+# ============================================================================
+#
+# A person can reach us by email or phone. user_mappings/{alias} holds the
+# primary_id their memory is stored under, and every tool call is resolved
+# to it first. Mappings are preloaded at startup and kept current by a
+# snapshot listener, so resolution normally costs no reads. Ids without a
+# mapping are cached too. Entries expire after MEMORY_USER_MAPPING_TTL_SECONDS
+# even while the listener runs, in case it silently stops delivering; every
+# listener event brings the whole collection, so it renews them all.
+
+USER_MAPPING_TTL_SECONDS = float(os.environ.get("MEMORY_USER_MAPPING_TTL_SECONDS", "600"))
+
+
+class UserResolver:
+    """Thread-safe alias -> primary id cache over the user_mappings collection"""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, tuple] = {}
+        # Until this time every mapping is known, so unknown ids need no read
+        self._complete_until = 0.0
+        self._listening = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def resolve(self, user_id: str) -> str:
+        """Primary id for user_id, or user_id itself when it has no mapping"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0] or user_id
+            if entry is None and self._complete_until > now:
+                self.hits += 1
+                return user_id
+            self.misses += 1
+
+        mapping = await db.collection("user_mappings").document(user_id).get()
+        primary_id = (mapping.to_dict() or {}).get("primary_id") if mapping.exists else None
+        self.set(user_id, primary_id)
+        return primary_id or user_id
+
+    async def preload(self):
+        """Load every mapping in one query"""
+        started = time.monotonic()
+        mappings = {doc.id: doc.to_dict().get("primary_id") async for doc in db.collection("user_mappings").stream()}
+        with self._lock:
+            expires_at = started + self.ttl_seconds
+            self._entries = {alias: (primary_id, expires_at) for alias, primary_id in mappings.items()}
+            self._complete_until = expires_at
+        logger.info(f"Preloaded {len(mappings)} user mappings")
+
+    def set(self, alias: str, primary_id: Optional[str]):
+        """Cache a mapping; None records that alias has none"""
+        with self._lock:
+            self._entries[alias] = (primary_id, time.monotonic() + self.ttl_seconds)
+
+    def invalidate(self, alias: Optional[str] = None):
+        """Forget one alias, or every mapping when alias is None"""
+        with self._lock:
+            if alias is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._complete_until = 0.0
+            elif self._entries.pop(alias, None) is not None:
+                self.invalidations += 1
+
+    def watch(self):
+        """Keep the cache current with a snapshot listener on user_mappings"""
+        global _listener_db
+        if not CACHE_LISTENERS or self._listening:
+            return
+        try:
+            if _listener_db is None:
+                _listener_db = firestore.Client(project=FIRESTORE_PROJECT)
+            _listener_db.collection("user_mappings").on_snapshot(self._on_snapshot)
+        except Exception as e:
+            logger.warning(f"user_mappings listener failed to start, relying on TTL: {e}")
+            return
+        with self._lock:
+            self._listening = True
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # docs holds every mapping, so the whole cache is current again
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl_seconds
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    self._entries[change.document.id] = (None, expires_at)
+            for doc in docs:
+                self._entries[doc.id] = ((doc.to_dict() or {}).get("primary_id"), expires_at)
+            self._complete_until = expires_at
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "mapped": sum(1 for primary_id, _ in self._entries.values() if primary_id),
+                "listening": self._listening,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations
+            }
+
+
+user_resolver = UserResolver(USER_MAPPING_TTL_SECONDS)
+
+
 # ============================================================================
 # MAIN
 # ============================================================================
@@ -690,6 +2498,12 @@ async def main():
     logger.info("Starting Memory Unified MCP Server")
     logger.info("This server creates ONE Claude entity across all interfaces")
 
+    try:
+        await user_resolver.preload()
+    except Exception as e:
+        logger.warning(f"Could not preload user mappings, resolving on demand: {e}")
+    user_resolver.watch()
+
     async with stdio_server() as (read_stream, write_stream):
         await app.run(
             read_stream,
@@ -698,5 +2512,47 @@ async def main():
         )
 
 
+async def bench_concurrency(user_id: str, calls: int = 10) -> Dict[str, Any]:
+    """
+    Time get_unified_context calls run one after another and all at once.
+
+    With non-blocking I/O the concurrent wall time stays close to a single
+    call; a speedup near 1.0 means the calls were serialized.
+    """
+    params = {"user_id": user_id, "current_interface": "terminal", "conversation_id": "bench"}
+
+    async def timed_call():
+        started = time.perf_counter()
+        await call_tool("get_unified_context", params)
+        return time.perf_counter() - started
+
+    await timed_call()  # warm up connections
+
+    started = time.perf_counter()
+    sequential = [await timed_call() for _ in range(calls)]
+    sequential_wall = time.perf_counter() - started
+
+    started = time.perf_counter()
+    concurrent = await asyncio.gather(*(timed_call() for _ in range(calls)))
+    concurrent_wall = time.perf_counter() - started
+
+    return {
+        "calls": calls,
+        "sequential_wall_ms": round(sequential_wall * 1000, 1),
+        "concurrent_wall_ms": round(concurrent_wall * 1000, 1),
+        "mean_call_ms": round(sum(sequential) / calls * 1000, 1),
+        "max_concurrent_call_ms": round(max(concurrent) * 1000, 1),
+        "speedup": round(sequential_wall / concurrent_wall, 2) if concurrent_wall else None
+    }
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if len(sys.argv) == 3 and sys.argv[1] == "rebuild-index":
+        print(json.dumps(asyncio.run(rebuild_search_index(sys.argv[2])), indent=2))
+    elif len(sys.argv) == 3 and sys.argv[1] == "rebuild-snapshot":
+        print(json.dumps(asyncio.run(rebuild_context_snapshot(sys.argv[2])), indent=2))
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "bench-concurrency":
+        calls = int(sys.argv[3]) if len(sys.argv) == 4 else 10
+        print(json.dumps(asyncio.run(bench_concurrency(sys.argv[2], calls)), indent=2))
+    else:
+        asyncio.run(main())
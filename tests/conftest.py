@@ -0,0 +1,60 @@
+"""
+Fixtures for the memory server tests.
+
+Tests run against tests/fake_firestore.py by default. With
+FIRESTORE_EMULATOR_HOST set they run against the Firestore emulator instead;
+every test uses its own user id, so the emulator needs no clearing between
+tests, but the fake-only assertions on read and commit counts are skipped.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+USE_EMULATOR = bool(os.environ.get("FIRESTORE_EMULATOR_HOST"))
+
+# Listeners need a live backend, and the client needs no credentials when it
+# believes it is talking to an emulator; the fake replaces it before any call
+os.environ.setdefault("MEMORY_CACHE_LISTENERS", "0")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "new-fps-gpt")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+@pytest.fixture
+def memory(tmp_path, monkeypatch):
+    """The server module with a fresh database, cache and vector store"""
+    if USE_EMULATOR:
+        monkeypatch.setattr(server, "db", server.firestore.AsyncClient(project=server.FIRESTORE_PROJECT))
+    else:
+        monkeypatch.setattr(server, "db", FakeFirestore())
+    monkeypatch.setattr(server, "VECTOR_DIR", str(tmp_path / "vectors"))
+    monkeypatch.setattr(server, "_vector_indexes", {})
+    monkeypatch.setattr(server, "document_cache", server.DocumentCache(
+        server.CACHE_MAX_ENTRIES, server.CACHE_MAX_BYTES, server.CACHE_TTL_SECONDS
+    ))
+    monkeypatch.setattr(server, "user_resolver", server.UserResolver(server.USER_MAPPING_TTL_SECONDS))
+    return server
+
+
+@pytest.fixture
+def user_id():
+    return f"test-{uuid.uuid4().hex[:12]}@example.com"
+
+
+@pytest.fixture
+def fake_only():
+    if USE_EMULATOR:
+        pytest.skip("inspects the in-process fake")
+
+
+def run(coro):
+    return asyncio.run(coro)
@@ -0,0 +1,100 @@
+"""
+Scripted stand-in for anthropic.Anthropic, for the cloud and local service tests.
+
+Each messages.create or messages.stream call takes the next entry of the
+script: a Message to return, an exception to raise, or a callable that gets
+the request's keyword arguments and returns either. Requests are recorded in
+.calls. Replies are real anthropic.types objects, so code that dumps or
+inspects blocks sees what the SDK would give it.
+"""
+
+import threading
+import time
+
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+
+
+def reply(text="", tool_uses=(), usage=None):
+    """A Message with optional text followed by (id, name, input) tool calls"""
+    content = [TextBlock(type="text", text=text)] if text else []
+    content += [ToolUseBlock(type="tool_use", id=tool_id, name=name, input=tool_input) for tool_id, name, tool_input in tool_uses]
+    return Message(
+        id="msg_test",
+        type="message",
+        role="assistant",
+        model="claude-test",
+        content=content,
+        stop_reason="tool_use" if tool_uses else "end_turn",
+        stop_sequence=None,
+        usage=Usage(**(usage or {"input_tokens": 10, "output_tokens": 5}))
+    )
+
+
+def slow(seconds, result):
+    """Script entry that answers after a delay"""
+    def answer(kwargs):
+        time.sleep(seconds)
+        return result
+    return answer
+
+
+class FakeAnthropic:
+    def __init__(self, *script):
+        self.messages = _Messages(list(script))
+
+    @property
+    def calls(self):
+        return self.messages.calls
+
+
+class _Messages:
+    def __init__(self, script):
+        self._script = script
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def _next(self, kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            if not self._script:
+                raise AssertionError("unexpected Anthropic call")
+            entry = self._script.pop(0)
+        if callable(entry) and not isinstance(entry, type):
+            entry = entry(kwargs)
+        if isinstance(entry, BaseException):
+            raise entry
+        return entry
+
+    def create(self, **kwargs):
+        return self._next(kwargs)
+
+    def stream(self, **kwargs):
+        return _Stream(self, kwargs)
+
+
+class _Stream:
+    """Context manager shaped like the SDK's MessageStreamManager"""
+
+    def __init__(self, messages, kwargs):
+        self._messages = messages
+        self._kwargs = kwargs
+        self._message = None
+
+    def __enter__(self):
+        self._message = self._messages._next(self._kwargs)
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        for block in self._message.content:
+            if block.type == "text":
+                # Word by word, as a model would stream it
+                words = block.text.split(" ")
+                for i, word in enumerate(words):
+                    yield word if i == len(words) - 1 else word + " "
+
+    def get_final_message(self):
+        return self._message
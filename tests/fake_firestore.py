@@ -0,0 +1,499 @@
+"""
+In-process stand-in for the parts of firestore.AsyncClient that server.py uses.
+
+Writes go through the real client's sentinels (Increment, ArrayUnion,
+DELETE_FIELD, SERVER_TIMESTAMP) and the real async_transactional decorator,
+and the documented per-request limits are enforced, so code that would be
+rejected by Firestore fails here too:
+
+- at most 500 writes per batch or transaction
+- at most 500 field transforms per document per commit
+- at most 20,000 fields and 1 MiB per document
+
+Reference paths mirror Firestore's: collections and documents alternate, so
+a CollectionReference has no .collection().
+
+BlockingFirestore wraps a FakeFirestore for code written against the
+synchronous firestore.Client, such as the cloud service.
+"""
+
+import asyncio
+import copy
+import inspect
+import itertools
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+
+MAX_WRITES_PER_COMMIT = 500
+MAX_TRANSFORMS_PER_DOCUMENT = 500
+MAX_FIELDS_PER_DOCUMENT = 20000
+MAX_DOCUMENT_BYTES = 1024 * 1024
+
+_auto_ids = itertools.count(1)
+
+
+def _normalize(value):
+    """Firestore hands back timestamps as aware UTC datetimes"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def _is_transform(value) -> bool:
+    return isinstance(value, (transforms.Increment, transforms.ArrayUnion, transforms.ArrayRemove)) or value is transforms.SERVER_TIMESTAMP
+
+
+def _transform(current, value):
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        for item in _normalize(list(value.values)):
+            if item not in result:
+                result.append(item)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        removed = _normalize(list(value.values))
+        return [item for item in (current if isinstance(current, list) else []) if item not in removed]
+    raise TypeError(value)
+
+
+def _count_transforms(data) -> int:
+    if _is_transform(data):
+        return 1
+    if isinstance(data, dict):
+        return sum(_count_transforms(value) for value in data.values())
+    return 0
+
+
+def _count_fields(data) -> int:
+    count = 0
+    for value in data.values():
+        count += 1
+        if isinstance(value, dict):
+            count += _count_fields(value)
+    return count
+
+
+def _merge(target: dict, data: dict):
+    """set(merge=True): nested maps are merged field by field"""
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif _is_transform(value):
+            target[key] = _transform(target.get(key), value)
+        elif isinstance(value, dict):
+            existing = target.get(key)
+            target[key] = existing if isinstance(existing, dict) else {}
+            _merge(target[key], value)
+        else:
+            target[key] = _normalize(copy.deepcopy(value))
+
+
+def _resolve(data: dict) -> dict:
+    """Plain set(): transforms apply to nothing, DELETE_FIELD is not allowed"""
+    result = {}
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            raise ValueError("DELETE_FIELD is not allowed in set() without merge")
+        if _is_transform(value):
+            result[key] = _transform(None, value)
+        elif isinstance(value, dict):
+            result[key] = _resolve(value)
+        else:
+            result[key] = _normalize(copy.deepcopy(value))
+    return result
+
+
+def _update(target: dict, data: dict):
+    """update(): keys are dotted field paths and maps are replaced whole"""
+    for field_path, value in data.items():
+        parts = field_path.split(".")
+        node = target
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is transforms.DELETE_FIELD:
+            node.pop(parts[-1], None)
+        elif _is_transform(value):
+            node[parts[-1]] = _transform(node.get(parts[-1]), value)
+        elif isinstance(value, dict):
+            node[parts[-1]] = _resolve(value)
+        else:
+            node[parts[-1]] = _normalize(copy.deepcopy(value))
+
+
+def _field(data: dict, field_path: str):
+    node = data
+    for part in field_path.split("."):
+        if not isinstance(node, dict) or part not in node:
+            raise KeyError(field_path)
+        node = node[part]
+    return node
+
+
+def _sort_key(value):
+    """Firestore's cross-type ordering, enough for the types server.py stores"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, _normalize(value))
+    if isinstance(value, str):
+        return (4, value)
+    return (5, json.dumps(value, sort_keys=True, default=str))
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return copy.deepcopy(_field(self._data, field_path))
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id: str):
+        return FakeCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def _snapshot(self):
+        return FakeSnapshot(self, self._client.documents.get(self.path))
+
+    async def get(self, transaction=None):
+        self._client.reads += 1
+        return self._snapshot()
+
+    async def set(self, data, merge=False):
+        batch = self._client.batch()
+        batch.set(self, data, merge=merge)
+        await batch.commit()
+
+    async def update(self, data):
+        batch = self._client.batch()
+        batch.update(self, data)
+        await batch.commit()
+
+    async def delete(self):
+        batch = self._client.batch()
+        batch.delete(self)
+        await batch.commit()
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeQuery:
+    def __init__(self, client, parent_path=None, group=None, filters=(), orders=(), limit_to=None, after=None):
+        self._client = client
+        self._parent_path = parent_path
+        self._group = group
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit_to
+        self._after = after
+
+    def _copy(self, **changes):
+        fields = dict(
+            parent_path=self._parent_path, group=self._group, filters=self._filters,
+            orders=self._orders, limit_to=self._limit, after=self._after
+        )
+        fields.update(changes)
+        return FakeQuery(self._client, **fields)
+
+    def where(self, field_path, op, value):
+        return self._copy(filters=self._filters + ((field_path, op, _normalize(value)),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_to=count)
+
+    def start_after(self, snapshot):
+        return self._copy(after=snapshot)
+
+    def _in_scope(self, path: str) -> bool:
+        parent, _ = path.rsplit("/", 1)
+        if self._group is not None:
+            return parent.rsplit("/", 1)[-1] == self._group
+        return parent == self._parent_path
+
+    def _matches(self, data) -> bool:
+        for field_path, op, expected in self._filters:
+            try:
+                actual = _field(data, field_path)
+            except KeyError:
+                return False
+            if op == "==" and not actual == expected:
+                return False
+            if op == "array_contains" and not (isinstance(actual, list) and expected in actual):
+                return False
+            if op == "in" and actual not in expected:
+                return False
+            if op in ("<", "<=", ">", ">="):
+                a, b = _sort_key(actual), _sort_key(expected)
+                if a[0] != b[0] or not {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op]:
+                    return False
+        return True
+
+    def _key(self, path, data):
+        key = []
+        for field_path, direction in self._orders:
+            value = _sort_key(_field(data, field_path))
+            key.append(_Reversed(value) if direction == "DESCENDING" else value)
+        key.append(path)
+        return key
+
+    def _results(self):
+        rows = []
+        for path, data in self._client.documents.items():
+            if not self._in_scope(path) or not self._matches(data):
+                continue
+            try:
+                # Documents without an order_by field are left out, as in Firestore
+                rows.append((self._key(path, data), path, data))
+            except KeyError:
+                continue
+        rows.sort(key=lambda row: row[0])
+        if self._after is not None:
+            cursor = self._key(self._after.reference.path, self._after.to_dict())
+            rows = [row for row in rows if row[0] > cursor]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return [FakeSnapshot(FakeDocumentReference(self._client, path), copy.deepcopy(data)) for _, path, data in rows]
+
+    async def stream(self, transaction=None):
+        for snapshot in self._results():
+            self._client.reads += 1
+            yield snapshot
+
+    async def get(self, transaction=None):
+        return [snapshot async for snapshot in self.stream()]
+
+    def count(self, alias=None):
+        return _FakeCount(self)
+
+
+class _Reversed:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class _FakeCount:
+    def __init__(self, query):
+        self._query = query
+
+    async def get(self, transaction=None):
+        self._query._client.reads += 1
+        return [[SimpleNamespace(alias="count", value=len(self._query._results()))]]
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path: str):
+        super().__init__(client, parent_path=path)
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = f"auto{next(_auto_ids):016d}"
+        return FakeDocumentReference(self._client, f"{self.path}/{document_id}")
+
+    async def list_documents(self, page_size=None):
+        """Every document id in the collection, including ones that only hold subcollections"""
+        prefix = self.path + "/"
+        seen = set()
+        for path in list(self._client.documents):
+            if path.startswith(prefix):
+                document_id = path[len(prefix):].split("/", 1)[0]
+                if document_id not in seen:
+                    seen.add(document_id)
+                    yield self.document(document_id)
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("merge" if merge else "set", reference.path, document_data))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference.path, field_updates))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None))
+
+    def __len__(self):
+        return len(self._writes)
+
+    async def commit(self):
+        return self._client._commit(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Runs under the real async_transactional decorator; reads see the latest data"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._id = None
+        self._read_only = False
+        self._max_attempts = 5
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    async def _begin(self, retry_id=None):
+        self._id = b"fake-transaction"
+
+    async def _commit(self):
+        result = self._client._commit(self._writes)
+        self._clean_up()
+        return result
+
+    async def _rollback(self):
+        self._clean_up()
+
+
+class FakeFirestore:
+    """An empty database; inspect .documents (path -> data) and .commits in tests"""
+
+    def __init__(self):
+        self.documents = {}
+        self.commits = 0
+        self.reads = 0
+
+    def collection(self, collection_id: str):
+        return FakeCollectionReference(self, collection_id)
+
+    def document(self, path: str):
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, collection_id: str):
+        return FakeQuery(self, group=collection_id)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    async def get_all(self, references, field_paths=None, transaction=None):
+        for reference in references:
+            self.reads += 1
+            yield reference._snapshot()
+
+    def _commit(self, writes):
+        """Apply writes atomically, rejecting what Firestore would reject"""
+        if len(writes) > MAX_WRITES_PER_COMMIT:
+            raise exceptions.InvalidArgument(f"maximum {MAX_WRITES_PER_COMMIT} writes allowed per request")
+
+        transforms_by_path = {}
+        for _, path, data in writes:
+            if data is not None:
+                transforms_by_path[path] = transforms_by_path.get(path, 0) + _count_transforms(data)
+        for path, count in transforms_by_path.items():
+            if count > MAX_TRANSFORMS_PER_DOCUMENT:
+                raise exceptions.InvalidArgument(f"{path}: {count} field transforms in one commit exceeds {MAX_TRANSFORMS_PER_DOCUMENT}")
+
+        staged = dict(self.documents)
+        for op, path, data in writes:
+            if op == "delete":
+                staged.pop(path, None)
+                continue
+            if op == "set":
+                document = _resolve(data)
+            elif op == "merge":
+                document = copy.deepcopy(staged.get(path, {}))
+                _merge(document, data)
+            else:
+                if path not in staged:
+                    raise exceptions.NotFound(f"No document to update: {path}")
+                document = copy.deepcopy(staged[path])
+                _update(document, data)
+            if _count_fields(document) > MAX_FIELDS_PER_DOCUMENT:
+                raise exceptions.InvalidArgument(f"{path} has more than {MAX_FIELDS_PER_DOCUMENT} fields")
+            if len(json.dumps(document, default=str)) > MAX_DOCUMENT_BYTES:
+                raise exceptions.InvalidArgument(f"{path} exceeds the maximum document size")
+            staged[path] = document
+
+        self.documents = staged
+        self.commits += 1
+        return [SimpleNamespace(update_time=datetime.now(timezone.utc)) for _ in writes]
+
+
+class BlockingFirestore:
+    """
+    Synchronous view of a FakeFirestore: coroutines are run to completion,
+    async iterators collected into lists and fake objects wrapped in turn.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return _blocking(value)
+
+        def call(*args, **kwargs):
+            args = [arg._target if isinstance(arg, BlockingFirestore) else arg for arg in args]
+            return _blocking(value(*args, **kwargs))
+        return call
+
+
+def _blocking(value):
+    if inspect.iscoroutine(value):
+        return _blocking(asyncio.run(value))
+    if inspect.isasyncgen(value):
+        async def collect():
+            return [item async for item in value]
+        return _blocking(asyncio.run(collect()))
+    if isinstance(value, list):
+        return [_blocking(item) for item in value]
+    if isinstance(value, (FakeFirestore, FakeDocumentReference, FakeQuery, FakeWriteBatch, _FakeCount, FakeSnapshot)):
+        return BlockingFirestore(value)
+    return value
@@ -0,0 +1,70 @@
+"""
+Minimal MCP server over stdio for the local service tests.
+
+Requests are answered on their own threads, so several can be in flight and
+responses come back in completion order. Tools:
+
+  echo      returns its arguments as JSON text
+  sleep     echo after sleeping arguments["seconds"]
+  fail      answers with a JSON-RPC error
+  is_error  returns a tool result flagged isError, as index.js does on errors
+  exit      ends the process without answering
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+_write_lock = threading.Lock()
+
+
+def send(message):
+    with _write_lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+
+def text_result(arguments):
+    return {"content": [{"type": "text", "text": json.dumps(arguments)}]}
+
+
+def handle(request):
+    method = request.get("method")
+    params = request.get("params") or {}
+    if method == "initialize":
+        result = {"protocolVersion": params.get("protocolVersion"), "capabilities": {"tools": {}},
+                  "serverInfo": {"name": "fake-mcp", "version": "1.0.0"}}
+    elif method == "ping":
+        result = {}
+    elif method == "tools/call":
+        name, arguments = params.get("name"), params.get("arguments") or {}
+        if name == "sleep":
+            time.sleep(arguments.get("seconds", 0))
+            result = text_result(arguments)
+        elif name == "fail":
+            send({"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32000, "message": "tool failed"}})
+            return
+        elif name == "is_error":
+            result = {"content": [{"type": "text", "text": "Error: not found"}], "isError": True}
+        elif name == "exit":
+            os._exit(1)
+        else:
+            result = text_result(arguments)
+    else:
+        send({"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32601, "message": f"unknown method {method}"}})
+        return
+    send({"jsonrpc": "2.0", "id": request["id"], "result": result})
+
+
+def main():
+    for line in sys.stdin:
+        request = json.loads(line)
+        if "id" not in request:
+            continue  # notification
+        threading.Thread(target=handle, args=(request,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,866 @@
+"""
+Cloud service tests: /chat routing, streaming, health, breaker, conversation
+store, compaction and the write-behind queue.
+
+The local Claude service is a small HTTP server on a thread, Firestore is
+tests/fake_firestore.py behind its synchronous wrapper and the Anthropic
+fallback is tests/fake_anthropic.py.
+"""
+
+import importlib.util
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from fake_anthropic import FakeAnthropic, reply, slow
+from fake_firestore import BlockingFirestore, FakeFirestore
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "test-key")
+
+_spec = importlib.util.spec_from_file_location(
+    "cloud_service", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cloud-claude-service", "server.py")
+)
+cloud_service = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cloud_service)
+
+
+class LocalStub:
+    """
+    The local Claude service. respond(body) returns (status, payload): a dict
+    is sent as JSON, a list as server-sent events, where a number in the list
+    pauses for that many seconds and the stream ends wherever the list does.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.health_status = 200
+        self.health_delay = 0
+        self.respond = lambda body: (200, {"response": "local reply"})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _LocalHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.stub.health_delay)
+        self._send_json(self.server.stub.health_status, {"status": "healthy"})
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        stub.requests.append(body)
+        status, payload = stub.respond(body)
+        if isinstance(payload, dict):
+            self._send_json(status, payload)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for event in payload:
+            if isinstance(event, (int, float)):
+                time.sleep(event)
+                continue
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+            self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietHealth(cloud_service.LocalHealth):
+    """Health tracker without the background prober; tests call probe() themselves"""
+
+    def ensure_started(self):
+        pass
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    """The cloud service module with fresh state, no local service and no fallback replies"""
+    monkeypatch.setattr(cloud_service, "db", BlockingFirestore(FakeFirestore()))
+    monkeypatch.setattr(cloud_service, "LOCAL_CLAUDE_URL", "")
+    monkeypatch.setattr(cloud_service, "LOCAL_CLAUDE_API_KEY", "")
+    monkeypatch.setattr(cloud_service, "local_health", QuietHealth(cloud_service.LOCAL_HEALTH_INTERVAL, cloud_service.LOCAL_HEALTH_TIMEOUT))
+    monkeypatch.setattr(cloud_service, "local_breaker", cloud_service.CircuitBreaker())
+    monkeypatch.setattr(cloud_service, "conversation_store", cloud_service.ConversationStore())
+    monkeypatch.setattr(cloud_service, "anthropic_fallback", FakeAnthropic())
+    monkeypatch.setattr(cloud_service, "WRITE_BEHIND_FLUSH_SECONDS", 0.05)
+    writer = cloud_service.MessageWriter()
+    monkeypatch.setattr(cloud_service, "message_writer", writer)
+    yield cloud_service
+    writer.drain(timeout=5)
+
+
+@pytest.fixture
+def local(cloud, monkeypatch):
+    """A running local service stub the cloud service routes to"""
+    stub = LocalStub()
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_URL", stub.url)
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_API_KEY", "local-key")
+    yield stub
+    stub.close()
+
+
+def unused_url():
+    """URL of a port nothing listens on"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _LocalHandler)
+    port = server.server_address[1]
+    server.server_close()
+    return f"http://127.0.0.1:{port}"
+
+
+def chat(cloud, message="hello", **fields):
+    return cloud.app.test_client().post("/chat", json={"user_id": "alice", "message": message, **fields})
+
+
+def stream_events(response):
+    return [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).split("\n\n") if line]
+
+
+def stored_messages(cloud):
+    """Messages the write-behind queue committed, oldest first"""
+    cloud.message_writer.drain(timeout=5)
+    docs = cloud.db.collection("conversations").document("alice").collection("messages").order_by("timestamp").stream()
+    return [(doc.get("role"), doc.get("content")) for doc in docs]
+
+
+# ============================================================================
+# STREAMING
+# ============================================================================
+
+def test_stream_relays_local_events(cloud, local):
+    local.respond = lambda body: (200, [{"type": "text", "content": "Hel"}, {"type": "text", "content": "lo"}, {"type": "done"}])
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert local.requests[0]["stream"] is True
+    assert events[:2] == [{"type": "text", "content": "Hel"}, {"type": "text", "content": "lo"}]
+    assert events[-1]["type"] == "done"
+    assert events[-1]["mode"] == "unified_entity"
+    assert events[-1]["full_response"] == "Hello"
+    assert stored_messages(cloud) == [("user", "hello"), ("assistant", "Hello")]
+    assert cloud.local_breaker.snapshot()["failures"] == 0
+
+
+def test_stream_relays_plain_json_reply_as_one_chunk(cloud, local):
+    local.respond = lambda body: (200, {"response": "all at once"})
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert events[0] == {"type": "text", "content": "all at once"}
+    assert events[-1]["mode"] == "unified_entity"
+
+
+def test_stream_falls_back_when_local_fails_before_any_text(cloud, local):
+    local.respond = lambda body: (500, {"error": "boom"})
+    cloud.anthropic_fallback = FakeAnthropic(reply("fallback reply"))
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert "".join(event["content"] for event in events if event["type"] == "text") == "fallback reply"
+    assert events[-1]["mode"] == "fallback"
+    assert cloud.local_breaker.snapshot()["failures"] == 1
+    assert cloud.anthropic_fallback.calls[0]["messages"] == [{"role": "user", "content": "hello"}]
+
+
+def test_stream_falls_back_when_local_is_unreachable(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_URL", unused_url())
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_API_KEY", "local-key")
+    cloud.anthropic_fallback = FakeAnthropic(reply("fallback reply"))
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert events[-1]["mode"] == "fallback"
+    assert cloud.local_health.status == "unreachable"
+
+
+def test_stream_error_after_text_ends_without_fallback(cloud, local):
+    local.respond = lambda body: (200, [{"type": "text", "content": "partial"}, {"type": "error", "error": "model overloaded"}])
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert events == [
+        {"type": "text", "content": "partial"},
+        {"type": "error", "error": "Connection to the unified entity was interrupted"}
+    ]
+    assert cloud.anthropic_fallback.calls == []
+    # The interrupted reply is not recorded as the assistant's turn
+    assert stored_messages(cloud) == [("user", "hello")]
+    assert cloud.local_breaker.snapshot()["failures"] == 1
+
+
+def test_stream_closed_before_done_is_an_error(cloud, local):
+    local.respond = lambda body: (200, [{"type": "text", "content": "partial"}])
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert events[-1]["type"] == "error"
+    assert cloud.anthropic_fallback.calls == []
+
+
+def test_stream_reports_fallback_failure(cloud):
+    cloud.anthropic_fallback = FakeAnthropic(RuntimeError("overloaded"))
+
+    events = stream_events(chat(cloud, stream=True))
+
+    assert events == [{"type": "error", "error": "overloaded"}]
+
+
+# ============================================================================
+# CONNECTION POOL
+# ============================================================================
+
+def fresh_pool(cloud, monkeypatch, maxsize):
+    """Give the cloud service a new local session, pooling maxsize connections"""
+    adapter = cloud.BoundedWaitAdapter(pool_connections=1, pool_maxsize=maxsize, pool_block=True)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    monkeypatch.setattr(cloud, "local_adapter", adapter)
+    monkeypatch.setattr(cloud, "local_session", session)
+
+
+def test_pool_reuses_kept_alive_connection(cloud, local, monkeypatch):
+    fresh_pool(cloud, monkeypatch, maxsize=4)
+
+    assert chat(cloud, "one").json["mode"] == "unified_entity"
+    assert chat(cloud, "two").json["response"] == "local reply"
+
+    stats = cloud.local_pool_stats()
+    assert stats["requests"] == 2
+    assert stats["connections_opened"] == 1
+    assert stats["reuse_ratio"] == 0.5
+
+
+def test_pool_wait_is_bounded_then_falls_back(cloud, local, monkeypatch):
+    fresh_pool(cloud, monkeypatch, maxsize=1)
+    monkeypatch.setattr(cloud, "LOCAL_POOL_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def respond(body):
+        if body["message"] == "slow":
+            release.wait(5)
+        return 200, {"response": "local reply"}
+    local.respond = respond
+    cloud.anthropic_fallback = FakeAnthropic(reply("fallback reply"))
+
+    # The only connection is busy with a slow request
+    busy = threading.Thread(target=chat, args=(cloud, "slow"), kwargs={"conversation_id": "busy"})
+    busy.start()
+    while not local.requests:
+        time.sleep(0.01)
+
+    started = time.monotonic()
+    response = chat(cloud, "waiting", conversation_id="waiting")
+    waited = time.monotonic() - started
+    release.set()
+    busy.join(5)
+
+    assert response.json["mode"] == "fallback"
+    assert waited < 1
+    assert cloud.local_breaker.snapshot()["failures"] == 1
+
+
+def test_health_probe_has_its_own_connection(cloud, local, monkeypatch):
+    fresh_pool(cloud, monkeypatch, maxsize=1)
+    monkeypatch.setattr(cloud, "LOCAL_POOL_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def respond(body):
+        release.wait(5)
+        return 200, {"response": "local reply"}
+    local.respond = respond
+
+    busy = threading.Thread(target=chat, args=(cloud, "slow"))
+    busy.start()
+    while not local.requests:
+        time.sleep(0.01)
+    cloud.local_health.probe()
+    release.set()
+    busy.join(5)
+
+    assert cloud.local_health.status == "connected"
+
+
+# ============================================================================
+# HEALTH
+# ============================================================================
+
+def test_probe_records_connected_and_latency(cloud, local):
+    cloud.local_health.probe()
+    cloud.local_health.probe()
+
+    health = cloud.app.test_client().get("/health").json
+    assert health["local_claude_status"] == "connected"
+    assert health["mode"] == "unified"
+    assert health["local_claude"]["last_seen"] is not None
+    assert health["local_claude"]["rtt_ema_ms"] is not None
+    assert health["local_claude"]["consecutive_failures"] == 0
+
+
+def test_probe_error_status_stops_routing(cloud, local):
+    local.health_status = 503
+    cloud.anthropic_fallback = FakeAnthropic(reply("fallback reply"))
+
+    cloud.local_health.probe()
+    response = chat(cloud)
+
+    assert cloud.local_health.snapshot()["status"] == "error"
+    assert not cloud.local_health.should_route()
+    assert response.json["mode"] == "fallback"
+    assert local.requests == []
+
+
+def test_probe_timeout_is_unreachable(cloud, local):
+    local.health_delay = 1
+    health = QuietHealth(interval=10, timeout=0.2)
+
+    started = time.monotonic()
+    health.probe()
+    health.probe()
+
+    assert time.monotonic() - started < 1.5
+    assert health.status == "unreachable"
+    assert health.consecutive_failures == 2
+    assert health.last_seen is None
+
+
+def test_probe_unreachable_then_recovers(cloud, local, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_URL", unused_url())
+    cloud.local_health.probe()
+    assert cloud.local_health.status == "unreachable"
+
+    monkeypatch.setattr(cloud, "LOCAL_CLAUDE_URL", local.url)
+    cloud.local_health.probe()
+    assert cloud.local_health.status == "connected"
+    assert cloud.local_health.consecutive_failures == 0
+
+
+def test_stale_probe_result_is_unknown_and_routes(cloud, local):
+    local.health_status = 503
+    cloud.local_health.probe()
+    # The prober has not run for longer than three intervals
+    cloud.local_health.checked_at -= 3 * cloud.local_health.interval + 1
+
+    assert cloud.local_health.snapshot()["status"] == "unknown"
+    assert cloud.local_health.should_route()
+    assert chat(cloud).json["mode"] == "unified_entity"
+
+
+# ============================================================================
+# CIRCUIT BREAKER AND HEDGING
+# ============================================================================
+
+def test_breaker_opens_on_error_rate(cloud):
+    breaker = cloud.local_breaker
+    for _ in range(cloud.LOCAL_BREAKER_MIN_CALLS):
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.snapshot()["rejected"] == 1
+    assert breaker.snapshot()["trips"] == 1
+
+
+def test_breaker_opens_on_slow_rate(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_BREAKER_SLOW_SECONDS", 0.1)
+    breaker = cloud.local_breaker
+    for _ in range(cloud.LOCAL_BREAKER_MIN_CALLS):
+        breaker.record(True, 0.5)
+
+    assert breaker.state == "open"
+    assert breaker.snapshot()["slow_calls"] == cloud.LOCAL_BREAKER_MIN_CALLS
+
+
+def test_breaker_half_open_lets_one_probe_through(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_BREAKER_COOLDOWN", 0)
+    breaker = cloud.local_breaker
+    for _ in range(cloud.LOCAL_BREAKER_MIN_CALLS):
+        breaker.record(False, 0.1)
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+    # A failed probe opens it again, a good one closes it
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+    assert breaker.snapshot()["trips"] == 2
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["window_error_rate"] == 0.0
+
+
+def test_open_breaker_sends_chat_to_fallback(cloud, local):
+    local.respond = lambda body: (500, {"error": "boom"})
+    cloud.anthropic_fallback = FakeAnthropic(*[reply("fallback reply")] * (cloud.LOCAL_BREAKER_MIN_CALLS + 1))
+
+    for i in range(cloud.LOCAL_BREAKER_MIN_CALLS):
+        assert chat(cloud, f"message {i}").json["mode"] == "fallback"
+    assert cloud.local_breaker.state == "open"
+
+    assert chat(cloud, "after").json["mode"] == "fallback"
+    assert len(local.requests) == cloud.LOCAL_BREAKER_MIN_CALLS
+
+
+def test_hedge_deadline_follows_recent_latency(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_HEDGE_DEFAULT_SECONDS", 15)
+    assert cloud.hedge_deadline() == 15
+
+    for _ in range(20):
+        cloud.local_breaker.record(True, 2.0)
+    assert cloud.hedge_deadline() == 2.0
+
+    monkeypatch.setattr(cloud, "local_breaker", cloud.CircuitBreaker())
+    for _ in range(20):
+        cloud.local_breaker.record(True, 0.01)
+    assert cloud.hedge_deadline() == cloud.LOCAL_HEDGE_MIN_SECONDS
+
+
+@pytest.fixture
+def hedging(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "LOCAL_HEDGE", True)
+    monkeypatch.setattr(cloud, "LOCAL_HEDGE_DEFAULT_SECONDS", 0.2)
+    monkeypatch.setattr(cloud, "hedge_stats", {"requests": 0, "hedged": 0, "local_wins": 0, "fallback_wins": 0})
+    # Lets slow local replies finish once the test is done
+    release = threading.Event()
+    yield release
+    release.set()
+
+
+def test_hedge_not_started_when_local_is_fast(cloud, local, hedging):
+    assert chat(cloud).json["mode"] == "unified_entity"
+
+    assert cloud.hedge_snapshot()["hedged"] == 0
+    assert cloud.anthropic_fallback.calls == []
+
+
+def test_hedge_fallback_wins_over_slow_local(cloud, local, hedging):
+    def respond(body):
+        hedging.wait(5)
+        return 200, {"response": "late local reply"}
+    local.respond = respond
+    cloud.anthropic_fallback = FakeAnthropic(reply("fallback reply"))
+
+    response = chat(cloud)
+
+    assert response.json["mode"] == "fallback"
+    assert response.json["response"] == "fallback reply"
+    stats = cloud.hedge_snapshot()
+    assert stats["hedged"] == 1
+    assert stats["fallback_wins"] == 1
+
+
+def test_hedge_local_wins_over_slow_fallback(cloud, local, hedging):
+    def respond(body):
+        time.sleep(0.4)
+        return 200, {"response": "local reply"}
+    local.respond = respond
+    cloud.anthropic_fallback = FakeAnthropic(slow(2, reply("fallback reply")))
+
+    response = chat(cloud)
+
+    assert response.json["mode"] == "unified_entity"
+    assert cloud.hedge_snapshot()["local_wins"] == 1
+
+
+def test_hedge_runs_fallback_once_when_both_fail(cloud, local, hedging):
+    def respond(body):
+        time.sleep(0.4)
+        return 500, {"error": "boom"}
+    local.respond = respond
+    cloud.anthropic_fallback = FakeAnthropic(RuntimeError("overloaded"), reply("second fallback"))
+
+    response = chat(cloud)
+
+    assert response.status_code == 500
+    assert response.json["error"] == "overloaded"
+    assert len(cloud.anthropic_fallback.calls) == 1
+    assert cloud.local_breaker.snapshot()["failures"] == 1
+
+
+# ============================================================================
+# CONVERSATION STORE
+# ============================================================================
+
+def store_with(cloud, conversation_id, *messages):
+    """Load a conversation into the store and append (role, content) messages"""
+    conversation = cloud.conversation_store.get("alice", conversation_id, "terminal")
+    for role, content in messages:
+        cloud.conversation_store.append(conversation, role, content)
+    return conversation
+
+
+def test_store_evicts_least_recently_used(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "CONVERSATION_MAX_ACTIVE", 2)
+    store = cloud.conversation_store
+    store_with(cloud, "a")
+    store_with(cloud, "b")
+    store.get("alice", "a", "terminal")
+    store_with(cloud, "c")
+
+    assert [key for key, _ in store.items()] == ["alice:a", "alice:c"]
+    assert store.stats()["evictions"]["lru"] == 1
+
+
+def test_store_evicts_over_memory_budget(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "CONVERSATION_MAX_BYTES", 1000)
+    store = cloud.conversation_store
+    store_with(cloud, "a", ("user", "x" * 600))
+    store_with(cloud, "b", ("user", "y" * 600))
+
+    assert [key for key, _ in store.items()] == ["alice:b"]
+    assert store.stats()["evictions"]["memory"] == 1
+    assert store.stats()["bytes"] == 600 + 64
+
+
+def test_store_drops_idle_conversations(cloud):
+    store = cloud.conversation_store
+    idle = store_with(cloud, "a")
+    idle["last_active"] -= cloud.CONVERSATION_IDLE_TTL + 1
+    store_with(cloud, "b")
+
+    assert [key for key, _ in store.items()] == ["alice:b"]
+    assert store.stats()["evictions"]["idle"] == 1
+
+
+def test_store_trims_to_message_limit_from_a_user_turn(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "CONVERSATION_MAX_MESSAGES", 4)
+    conversation = store_with(cloud, "a", *[(role, f"{role} {i}") for i in range(3) for role in ("user", "assistant")])
+
+    assert [msg["content"] for msg in conversation["messages"]] == ["user 1", "assistant 1", "user 2", "assistant 2"]
+    assert conversation["start"] == 2
+    assert cloud.conversation_store.stats()["trimmed_messages"] == 2
+
+
+def test_store_trims_to_token_budget_but_keeps_latest_user_turn(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "CONVERSATION_TOKEN_BUDGET", 100)
+    conversation = store_with(cloud, "a", ("user", "short"), ("assistant", "short"), ("user", "z" * 2000))
+
+    assert [msg["role"] for msg in conversation["messages"]] == ["user"]
+    assert conversation["messages"][0]["content"] == "z" * 2000
+
+
+def test_store_rehydrates_evicted_conversation_from_firestore(cloud, local):
+    chat(cloud, "first")
+    chat(cloud, "second")
+    cloud.message_writer.drain(timeout=5)
+    assert cloud.conversation_store.delete("alice:default")
+
+    conversation = cloud.conversation_store.get("alice", None, "terminal")
+
+    assert [msg["content"] for msg in conversation["messages"]] == ["first", "local reply", "second", "local reply"]
+    assert conversation["start"] == 0
+    assert cloud.conversation_store.stats()["rehydrations"] == 1
+
+
+def test_store_starts_empty_when_history_cannot_load(cloud, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("firestore unavailable")
+    monkeypatch.setattr(cloud, "conversation_document", unavailable)
+
+    conversation = cloud.conversation_store.get("alice", "a", "terminal")
+
+    assert conversation["messages"] == []
+    assert conversation["summary"] is None
+    assert cloud.conversation_store.stats()["rehydrations"] == 0
+
+
+# ============================================================================
+# HISTORY COMPACTION
+# ============================================================================
+
+@pytest.fixture
+def compaction(cloud, monkeypatch):
+    """Small history budget, with folds run inline instead of in the background"""
+    monkeypatch.setattr(cloud, "HISTORY_TOKEN_BUDGET", 50)
+    monkeypatch.setattr(cloud, "HISTORY_KEEP_TURNS", 1)
+    monkeypatch.setattr(cloud, "compaction_executor", SimpleNamespace(submit=lambda fn, *args: fn(*args)))
+    monkeypatch.setattr(cloud, "compaction_stats", {key: 0 for key in cloud.compaction_stats})
+
+
+def long_exchanges(turns):
+    return [(role, f"{role} {i} " + "x" * 100) for i in range(turns) for role in ("user", "assistant")]
+
+
+def long_conversation(cloud, turns):
+    """A conversation of turns long exchanges followed by a new user message"""
+    return store_with(cloud, "default", *long_exchanges(turns), ("user", "latest"))
+
+
+def saved_state(cloud):
+    snapshot = cloud.conversation_document("alice", "default").get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def seed_messages(cloud, count):
+    """count alternating user / assistant messages in Firestore, a second apart"""
+    messages = cloud.db.collection("conversations").document("alice").collection("messages")
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        messages.document().set({
+            "user_id": "alice", "conversation_id": "default", "interface": "terminal",
+            "role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}",
+            "timestamp": base + timedelta(seconds=i)
+        })
+
+
+def test_history_under_budget_is_sent_verbatim(cloud, compaction):
+    conversation = store_with(cloud, "default", ("user", "hi"), ("assistant", "hello"), ("user", "latest"))
+
+    history, summary, saved = cloud.compact_history(conversation)
+
+    assert history == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    assert summary is None
+    assert saved == 0
+    assert cloud.anthropic_fallback.calls == []
+
+
+def test_history_over_budget_is_folded_into_saved_summary(cloud, compaction):
+    cloud.anthropic_fallback = FakeAnthropic(reply("the user said things"))
+    conversation = long_conversation(cloud, turns=4)
+
+    history, summary, _ = cloud.compact_history(conversation)
+
+    # This request still carries every turn; the fold applies from the next
+    assert len(history) == 8
+    assert summary is None
+    request = cloud.anthropic_fallback.calls[0]
+    assert request["model"] == cloud.COMPACTION_MODEL
+    assert "USER: user 0" in request["messages"][0]["content"]
+    assert "ASSISTANT: assistant 2" in request["messages"][0]["content"]
+    assert "user 3" not in request["messages"][0]["content"]
+
+    assert conversation["summary"] == "the user said things"
+    assert [msg["content"] for msg in conversation["messages"]][-1] == "latest"
+    assert len(conversation["messages"]) == 3
+    assert conversation["start"] == 6
+    assert not conversation["compacting"]
+    assert saved_state(cloud)["summary"] == "the user said things"
+    assert saved_state(cloud)["summary_turns"] == 6
+
+    history, summary, saved = cloud.compact_history(conversation)
+    assert summary == "the user said things"
+    assert len(history) == 2
+    assert saved > 0
+
+
+def test_summary_reaches_local_service(cloud, local, compaction):
+    cloud.anthropic_fallback = FakeAnthropic(reply("the user said things"))
+    store_with(cloud, "default", *long_exchanges(4))
+
+    # The first request schedules the fold, the second carries the summary
+    chat(cloud, "one more")
+    chat(cloud, "and another")
+
+    assert local.requests[0]["conversation_summary"] is None
+    assert local.requests[1]["conversation_summary"] == "the user said things"
+    assert len(local.requests[0]["conversation_history"]) == 8
+    assert [msg["content"] for msg in local.requests[1]["conversation_history"]][-2:] == ["one more", "local reply"]
+    assert len(local.requests[1]["conversation_history"]) == 4
+
+
+def test_summary_falls_back_to_extract_when_model_fails(cloud, compaction):
+    cloud.anthropic_fallback = FakeAnthropic(RuntimeError("overloaded"))
+    conversation = long_conversation(cloud, turns=4)
+
+    cloud.compact_history(conversation)
+
+    assert conversation["summary"].startswith("user: user 0 ")
+    assert cloud.compaction_snapshot()["summary_failures"] == 1
+    assert cloud.compaction_snapshot()["summaries_written"] == 1
+    assert saved_state(cloud)["summary"] == conversation["summary"]
+
+
+def test_summary_save_failure_is_counted(cloud, compaction, monkeypatch):
+    cloud.anthropic_fallback = FakeAnthropic(reply("the user said things"))
+    conversation = long_conversation(cloud, turns=4)
+
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("firestore unavailable")
+    monkeypatch.setattr(cloud, "conversation_document", unavailable)
+    cloud.compact_history(conversation)
+
+    assert conversation["summary"] == "the user said things"
+    assert cloud.compaction_snapshot()["summary_save_failures"] == 1
+    assert not conversation["compacting"]
+
+
+def test_rehydration_restores_summary_and_skips_covered_turns(cloud):
+    seed_messages(cloud, 8)
+    cloud.conversation_document("alice", "default").set({"summary": "earlier turns", "summary_turns": 6})
+
+    conversation = cloud.conversation_store.get("alice", None, "terminal")
+
+    assert conversation["summary"] == "earlier turns"
+    assert [msg["content"] for msg in conversation["messages"]] == ["message 6", "message 7"]
+    assert conversation["start"] == 6
+
+
+def test_rehydration_counts_messages_older_than_a_full_page(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, "CONVERSATION_MAX_MESSAGES", 4)
+    seed_messages(cloud, 10)
+    cloud.conversation_document("alice", "default").set({"summary": "earlier turns", "summary_turns": 8})
+
+    messages, summary, start = cloud.load_conversation_history("alice", "default")
+
+    assert [msg["content"] for msg in messages] == ["message 8", "message 9"]
+    assert summary == "earlier turns"
+    assert start == 8
+
+
+# ============================================================================
+# WRITE-BEHIND QUEUE
+# ============================================================================
+
+class FlakyDatabase:
+    """Firestore whose batches fail while .failing is set; a .gate holds up the next one"""
+
+    def __init__(self, db):
+        self._db = db
+        self.failing = False
+        self.gate = None
+
+    def batch(self):
+        if self.failing:
+            raise RuntimeError("firestore unavailable")
+        gate, self.gate = self.gate, None
+        if gate is not None:
+            gate.wait(5)
+        return self._db.batch()
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+@pytest.fixture
+def flaky(cloud, monkeypatch):
+    database = FlakyDatabase(cloud.db)
+    monkeypatch.setattr(cloud, "db", database)
+    monkeypatch.setattr(cloud, "WRITE_BEHIND_RETRIES", 1)
+    monkeypatch.setattr(cloud, "WRITE_BEHIND_RETRY_SECONDS", 0.1)
+    return database
+
+
+def new_writer(cloud, monkeypatch, **settings):
+    for name, value in settings.items():
+        monkeypatch.setattr(cloud, name, value)
+    writer = cloud.MessageWriter()
+    monkeypatch.setattr(cloud, "message_writer", writer)
+    return writer
+
+
+def message(cloud, content):
+    doc_ref = cloud.db.collection("conversations").document("alice").collection("messages").document()
+    return doc_ref, {"role": "user", "content": content, "timestamp": datetime.now(timezone.utc)}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_writer_commits_queued_messages_in_one_batch(cloud):
+    for i in range(5):
+        cloud.message_writer.submit(*message(cloud, f"message {i}"))
+
+    assert [content for _, content in stored_messages(cloud)] == [f"message {i}" for i in range(5)]
+    stats = cloud.message_writer.snapshot()
+    assert stats["queued"] == 5
+    assert stats["written"] == 5
+    assert stats["batches"] == 1
+    assert cloud.db.commits == 1
+
+
+def test_writer_holds_failed_batch_and_retries_it(cloud, flaky):
+    flaky.failing = True
+    cloud.message_writer.submit(*message(cloud, "first"))
+    cloud.message_writer.submit(*message(cloud, "second"))
+    wait_for(lambda: cloud.message_writer.snapshot()["held"] == 2)
+    assert cloud.message_writer.snapshot()["failed"] == 2
+
+    flaky.failing = False
+    wait_for(lambda: cloud.message_writer.snapshot()["written"] == 2)
+
+    assert cloud.message_writer.snapshot()["held"] == 0
+    assert cloud.message_writer.snapshot()["dead_lettered"] == 0
+    assert [content for _, content in stored_messages(cloud)] == ["first", "second"]
+
+
+def test_writer_dead_letters_oldest_held_beyond_capacity(cloud, flaky, monkeypatch, capsys):
+    writer = new_writer(cloud, monkeypatch, WRITE_BEHIND_CAPACITY=2)
+    flaky.failing = True
+    oldest = [message(cloud, "a"), message(cloud, "b")]
+
+    writer._write(oldest)
+    writer._write([message(cloud, "c")])
+
+    assert writer.snapshot()["held"] == 1
+    assert writer.snapshot()["dead_lettered"] == 2
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert [line["message_dead_letter"] for line in lines] == [doc_ref.path for doc_ref, _ in oldest]
+    assert [line["data"]["content"] for line in lines] == ["a", "b"]
+
+
+def test_writer_dead_letters_held_messages_on_drain(cloud, flaky):
+    flaky.failing = True
+    cloud.message_writer.submit(*message(cloud, "first"))
+    wait_for(lambda: cloud.message_writer.snapshot()["held"] == 1)
+
+    cloud.message_writer.drain(timeout=5)
+
+    assert cloud.message_writer.snapshot()["held"] == 0
+    assert cloud.message_writer.snapshot()["dead_lettered"] == 1
+
+
+def test_writer_writes_directly_when_queue_is_full(cloud, flaky, monkeypatch):
+    writer = new_writer(cloud, monkeypatch, WRITE_BEHIND_CAPACITY=1, WRITE_BEHIND_PUT_TIMEOUT=0.05)
+    gate = flaky.gate = threading.Event()
+
+    # The writer thread is held up on the first message, the second fills the queue
+    writer.submit(*message(cloud, "first"))
+    wait_for(lambda: flaky.gate is None)
+    writer.submit(*message(cloud, "second"))
+    writer.submit(*message(cloud, "third"))
+    assert writer.snapshot()["direct_writes"] == 1
+    gate.set()
+
+    assert sorted(content for _, content in stored_messages(cloud)) == ["first", "second", "third"]
+    assert writer.snapshot()["written"] == 3
+
+
+def test_writer_writes_directly_after_drain(cloud):
+    cloud.message_writer.drain(timeout=5)
+    cloud.message_writer.submit(*message(cloud, "late"))
+
+    assert cloud.message_writer.snapshot()["direct_writes"] == 1
+    assert stored_messages(cloud) == [("user", "late")]
@@ -0,0 +1,651 @@
+"""
+Local service tests: the MCP client pool, tool dispatch, the tool loop in
+/process, prompt caching and admission control.
+
+MCP servers are tests/fake_mcp_server.py processes and the Anthropic client
+is tests/fake_anthropic.py.
+"""
+
+import asyncio
+import importlib.util
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+
+import pytest
+
+from fake_anthropic import FakeAnthropic, reply
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "test-key")
+os.environ.setdefault("LOCAL_CLAUDE_API_KEY", "test-local-key")
+
+_spec = importlib.util.spec_from_file_location(
+    "local_service", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "local-claude-service", "server.py")
+)
+local_service = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(local_service)
+
+FAKE_MCP_COMMAND = f"{shlex.quote(sys.executable)} {shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_mcp_server.py'))}"
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """The local service module with fake MCP servers and no model replies"""
+    monkeypatch.setattr(local_service, "anthropic_client", FakeAnthropic())
+    monkeypatch.setattr(local_service, "request_gate", local_service.RequestGate(4, 16, 30))
+    monkeypatch.setattr(local_service, "mcp_clients", {})
+    monkeypatch.setattr(local_service, "MEMORY_MCP_COMMAND", FAKE_MCP_COMMAND)
+    monkeypatch.setattr(local_service, "MEMORY_TOOL_DISPATCH", {"*": "stdio"})
+    yield local_service
+    for pool in local_service.mcp_clients.values():
+        pool.close()
+
+
+@pytest.fixture
+def new_pool():
+    """Start MCP client pools, closed when the test ends"""
+    pools = []
+
+    def start(size=1, command=FAKE_MCP_COMMAND):
+        pool = local_service.MCPClientPool(command, size)
+        pools.append(pool)
+        return pool
+    yield start
+    for pool in pools:
+        pool.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+# ============================================================================
+# MCP CLIENT POOL
+# ============================================================================
+
+def test_pool_calls_tool_on_kept_alive_server(new_pool):
+    pool = new_pool()
+
+    first = pool.call_tool("echo", {"n": 1})
+    second = pool.call_tool("echo", {"n": 2})
+
+    assert first == {"content": [{"type": "text", "text": '{"n": 1}'}]}
+    assert second["content"][0]["text"] == '{"n": 2}'
+    stats = pool.stats()
+    assert len(stats["connections"]) == 1
+    # The initialize handshake and the two tool calls
+    assert stats["connections"][0]["calls"] == 3
+    assert stats["restarts"] == 0
+
+
+def test_pool_multiplexes_requests_on_one_server(new_pool):
+    pool = new_pool(size=1)
+    pool.call_tool("echo", {})
+    results = {}
+
+    def call(seconds):
+        results[seconds] = pool.call_tool("sleep", {"seconds": seconds})
+    threads = [threading.Thread(target=call, args=(seconds,)) for seconds in (0.5, 0.4, 0.3)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # Concurrent calls overlap rather than queue behind each other
+    assert time.monotonic() - started < 1.0
+    assert sorted(results) == [0.3, 0.4, 0.5]
+    assert results[0.4]["content"][0]["text"] == '{"seconds": 0.4}'
+    assert len(pool.stats()["connections"]) == 1
+
+
+def test_pool_spreads_requests_over_least_busy_server(new_pool):
+    pool = new_pool(size=2)
+    pool.call_tool("echo", {})
+    slow = threading.Thread(target=pool.call_tool, args=("sleep", {"seconds": 0.5}))
+    slow.start()
+    wait_for(lambda: len(pool.stats()["connections"]) == 2 and any(conn["in_flight"] for conn in pool.stats()["connections"]))
+
+    pool.call_tool("echo", {})
+    slow.join(5)
+
+    # Besides the handshakes, the first echo and the sleep went to one, the second echo to the other
+    assert sorted(conn["calls"] for conn in pool.stats()["connections"]) == [2, 3]
+
+
+def test_pool_raises_tool_errors_and_keeps_server(new_pool):
+    pool = new_pool()
+
+    with pytest.raises(local_service.MCPError, match="tool failed"):
+        pool.call_tool("fail", {})
+
+    assert pool.call_tool("echo", {"ok": True})["content"][0]["text"] == '{"ok": true}'
+    assert pool.stats()["restarts"] == 0
+
+
+def test_pool_request_timeout(new_pool):
+    pool = new_pool()
+
+    started = time.monotonic()
+    with pytest.raises(local_service.MCPError, match="timed out"):
+        pool.call_tool("sleep", {"seconds": 2}, timeout=0.2)
+
+    assert time.monotonic() - started < 1
+    assert pool.stats()["connections"][0]["in_flight"] == 0
+
+
+def test_pool_restarts_server_that_exited(new_pool):
+    pool = new_pool()
+    pool.call_tool("echo", {})
+    first_pid = pool.stats()["connections"][0]["pid"]
+
+    with pytest.raises(local_service.MCPError, match="exited"):
+        pool.call_tool("exit", {})
+    result = pool.call_tool("echo", {"after": "restart"})
+
+    assert result["content"][0]["text"] == '{"after": "restart"}'
+    stats = pool.stats()
+    assert stats["restarts"] == 1
+    assert stats["connections"][0]["pid"] != first_pid
+
+
+def test_pool_health_loop_restarts_killed_server(new_pool, monkeypatch):
+    monkeypatch.setattr(local_service, "MCP_HEALTH_INTERVAL", 0.1)
+    pool = new_pool()
+    pool.call_tool("echo", {})
+    pid = pool.stats()["connections"][0]["pid"]
+
+    pool._connections[0].process.kill()
+    wait_for(lambda: pool.stats()["restarts"] == 1)
+
+    assert pool.stats()["connections"][0]["pid"] != pid
+    assert pool.stats()["connections"][0]["alive"]
+
+
+def test_pool_reports_server_that_cannot_start(new_pool):
+    pool = new_pool(command=f"{shlex.quote(sys.executable)} -c 'import sys; sys.exit(1)'")
+
+    with pytest.raises(local_service.MCPError, match="No MCP server could be started"):
+        pool.call_tool("echo", {})
+    assert pool.stats()["connections"] == []
+
+
+def test_execute_tool_reports_mcp_failures_as_results(service):
+    assert service.execute_tool("fail", {}) == {"error": "tool failed", "success": False}
+    assert service.execute_tool("echo", {"a": 1})["content"][0]["text"] == '{"a": 1}'
+    assert list(service.mcp_clients) == ["memory-unified"]
+
+
+# ============================================================================
+# IN-PROCESS DISPATCH
+# ============================================================================
+
+@pytest.fixture
+def inprocess():
+    """In-process memory tools; tests set .module to the implementation to call"""
+    tools = local_service.InProcessMemoryTools("unused")
+    yield tools
+    tools.loop.call_soon_threadsafe(tools.loop.stop)
+
+
+class FakeMemoryModule:
+    """Memory server module whose tools fail or hang"""
+
+    def __init__(self):
+        self.user_resolver = self
+
+    async def resolve(self, user_id):
+        return user_id.lower()
+
+    async def search_memory(self, params):
+        raise RuntimeError(f"index unavailable for {params['user_id']}")
+
+    async def get_unified_context(self, params):
+        await asyncio.sleep(5)
+
+
+def test_parse_dispatch_modes():
+    assert local_service.parse_dispatch_modes("stdio") == {"*": "stdio"}
+    assert local_service.parse_dispatch_modes("inprocess") == {"*": "inprocess"}
+    assert local_service.parse_dispatch_modes(" get_unified_context=inprocess , *=stdio ") == {
+        "*": "stdio", "get_unified_context": "inprocess"
+    }
+    with pytest.raises(ValueError, match="Unknown dispatch mode"):
+        local_service.parse_dispatch_modes("search_unified_memory=grpc")
+
+
+def test_dispatch_mode_falls_back_to_default(service, monkeypatch):
+    monkeypatch.setattr(service, "MEMORY_TOOL_DISPATCH", service.parse_dispatch_modes("get_unified_context=inprocess"))
+
+    assert service.dispatch_mode("get_unified_context") == "inprocess"
+    assert service.dispatch_mode("search_unified_memory") == "stdio"
+
+
+def test_inprocess_tools_return_structured_results(inprocess, memory, user_id):
+    inprocess.module = memory
+
+    created = inprocess.call_tool("create_unified_entities", {
+        "user_id": user_id, "interface": "terminal",
+        "entities": [{"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]}]
+    })
+    context = inprocess.call_tool("get_unified_context", {"user_id": user_id})
+    found = inprocess.call_tool("search_unified_memory", {"user_id": user_id, "query": "airtable", "search_type": "entities"})
+
+    assert created["success"]
+    assert context["success"]
+    assert [entity["name"] for entity in found["results"]["entities"]] == ["Airtable"]
+    assert inprocess.stats()["calls"] == 3
+    assert inprocess.stats()["errors"] == 0
+
+
+def test_inprocess_tool_error_is_a_failed_result(inprocess):
+    inprocess.module = FakeMemoryModule()
+
+    result = inprocess.call_tool("search_unified_memory", {"user_id": "Alice@Example.com", "query": "x"})
+
+    assert result == {"error": "index unavailable for alice@example.com", "success": False}
+    assert inprocess.stats()["errors"] == 1
+
+
+def test_inprocess_tool_timeout(inprocess):
+    inprocess.module = FakeMemoryModule()
+
+    started = time.monotonic()
+    with pytest.raises(local_service.MCPError, match="timed out"):
+        inprocess.call_tool("get_unified_context", {"user_id": "alice"}, timeout=0.2)
+
+    assert time.monotonic() - started < 1
+    assert inprocess.stats()["errors"] == 1
+    assert inprocess.stats()["calls"] == 1
+
+
+def test_inprocess_unavailable_when_module_cannot_load(inprocess):
+    inprocess.path = "/nonexistent/server.py"
+
+    assert not inprocess.available()
+    assert inprocess.stats()["load_error"]
+
+
+def test_execute_tool_dispatches_per_tool(service, inprocess, monkeypatch):
+    inprocess.module = FakeMemoryModule()
+    monkeypatch.setattr(service, "inprocess_memory_tools", inprocess)
+    monkeypatch.setattr(service, "MEMORY_TOOL_DISPATCH", service.parse_dispatch_modes("search_unified_memory=inprocess,*=stdio"))
+
+    inprocess_result = service.execute_tool("search_unified_memory", {"user_id": "alice", "query": "x"})
+    stdio_result = service.execute_tool("get_unified_context", {"user_id": "alice"})
+
+    assert inprocess_result == {"error": "index unavailable for alice", "success": False}
+    # The fake MCP server echoes the arguments of tools it doesn't know
+    assert stdio_result == {"content": [{"type": "text", "text": '{"user_id": "alice"}'}]}
+
+
+def test_execute_tool_uses_stdio_when_inprocess_cannot_load(service, inprocess, monkeypatch):
+    inprocess.path = "/nonexistent/server.py"
+    monkeypatch.setattr(service, "inprocess_memory_tools", inprocess)
+    monkeypatch.setattr(service, "MEMORY_TOOL_DISPATCH", {"*": "inprocess"})
+
+    result = service.execute_tool("search_unified_memory", {"user_id": "alice", "query": "x"})
+
+    assert result["content"][0]["text"] == '{"user_id": "alice", "query": "x"}'
+
+
+# ============================================================================
+# TOOL LOOP
+# ============================================================================
+
+def process(service, message="hi", **fields):
+    return service.app.test_client().post(
+        "/process",
+        json={"user_id": "alice", "message": message, **fields},
+        headers={"Authorization": f"Bearer {service.API_KEY}"}
+    )
+
+
+def stream_events(response):
+    return [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).split("\n\n") if line]
+
+
+def test_process_runs_tool_round_then_answers(service):
+    service.anthropic_client = FakeAnthropic(
+        reply(tool_uses=[("t1", "get_unified_context", {"user_id": "alice"}), ("t2", "is_error", {})]),
+        reply("Here is what I found")
+    )
+
+    response = process(service)
+
+    assert response.json["success"]
+    assert response.json["response"] == "Here is what I found"
+    assert response.json["tool_loop_stopped"] == "complete"
+    rounds = response.json["tool_rounds"]
+    assert len(rounds) == 2
+    assert [(tool["name"], tool["ok"]) for tool in rounds[0]["tools"]] == [("get_unified_context", True), ("is_error", False)]
+    assert response.json["usage"]["input_tokens"] == 20
+
+    assistant_turn, tool_results = service.anthropic_client.calls[1]["messages"][-2:]
+    assert [block.id for block in assistant_turn["content"]] == ["t1", "t2"]
+    assert [(block["tool_use_id"], block["is_error"]) for block in tool_results["content"]] == [("t1", False), ("t2", True)]
+    assert json.loads(tool_results["content"][0]["content"])["content"][0]["text"] == '{"user_id": "alice"}'
+
+
+def test_process_runs_a_round_of_tool_calls_concurrently(service):
+    service.anthropic_client = FakeAnthropic(
+        reply(tool_uses=[(f"t{i}", "sleep", {"seconds": 0.5}) for i in range(3)]),
+        reply("done")
+    )
+
+    rounds = process(service).json["tool_rounds"]
+
+    assert [tool["ok"] for tool in rounds[0]["tools"]] == [True, True, True]
+    assert rounds[0]["tools_ms"] < 1200
+
+
+def test_process_marks_failed_tool_calls(service):
+    service.anthropic_client = FakeAnthropic(reply(tool_uses=[("t1", "fail", {})]), reply("sorry"))
+
+    response = process(service)
+
+    tool_result = service.anthropic_client.calls[1]["messages"][-1]["content"][0]
+    assert tool_result["is_error"]
+    assert json.loads(tool_result["content"]) == {"error": "tool failed", "success": False}
+    assert not response.json["tool_rounds"][0]["tools"][0]["ok"]
+
+
+def test_process_stops_tool_use_after_max_rounds(service, monkeypatch):
+    monkeypatch.setattr(service, "TOOL_MAX_ROUNDS", 2)
+    service.anthropic_client = FakeAnthropic(
+        reply(tool_uses=[("t1", "echo", {"round": 1})]),
+        reply(tool_uses=[("t2", "echo", {"round": 2})]),
+        reply("Answering with what I have")
+    )
+
+    response = process(service)
+
+    assert response.json["tool_loop_stopped"] == "max_rounds"
+    assert response.json["response"] == "Answering with what I have"
+    calls = service.anthropic_client.calls
+    assert [call.get("tool_choice") for call in calls] == [None, None, {"type": "none"}]
+    # Tools stay defined, since the history holds tool_use blocks
+    assert calls[2]["tools"] == calls[0]["tools"]
+
+
+def test_process_stops_tool_use_when_budget_runs_out(service, monkeypatch):
+    monkeypatch.setattr(service, "TOOL_LOOP_BUDGET", 0)
+    service.anthropic_client = FakeAnthropic(reply(tool_uses=[("t1", "echo", {})]), reply("out of time"))
+
+    response = process(service)
+
+    assert response.json["tool_loop_stopped"] == "budget"
+    assert service.anthropic_client.calls[1]["tool_choice"] == {"type": "none"}
+
+
+def test_tool_round_shares_one_deadline_across_hanging_calls(service, monkeypatch):
+    monkeypatch.setattr(service, "TOOL_CALL_TIMEOUT", 0.1)
+    release = threading.Event()
+
+    def hang(tool_name, parameters, timeout):
+        release.wait(10)
+        return {"content": []}
+    monkeypatch.setattr(service, "execute_tool", hang)
+    response = reply(tool_uses=[(f"t{i}", "get_unified_context", {}) for i in range(3)])
+    messages = []
+
+    started = time.monotonic()
+    timing = service.run_tool_round(response, messages, time.monotonic() + 60)
+    elapsed = time.monotonic() - started
+    release.set()
+
+    # A call gets at least a second, the round one more, however many calls hang
+    assert elapsed < 3
+    assert [tool["ok"] for tool in timing["tools"]] == [False, False, False]
+    results = messages[-1]["content"]
+    assert all(block["is_error"] for block in results)
+    assert json.loads(results[0]["content"]) == {"error": "get_unified_context timed out after 1s", "success": False}
+
+
+def test_process_reports_model_failure(service):
+    service.anthropic_client = FakeAnthropic(RuntimeError("overloaded"))
+
+    response = process(service)
+
+    assert response.status_code == 500
+    assert response.json == {"success": False, "error": "overloaded"}
+
+
+def test_process_streams_text_and_tool_rounds(service):
+    service.anthropic_client = FakeAnthropic(
+        reply("Let me check", tool_uses=[("t1", "echo", {})]),
+        reply("All done")
+    )
+
+    events = stream_events(process(service, stream=True))
+
+    assert [event["type"] for event in events] == ["text", "text", "text", "tool_round", "text", "text", "done"]
+    assert "".join(event["content"] for event in events if event["type"] == "text") == "Let me checkAll done"
+    assert events[3]["tools"][0]["ok"]
+    assert len(events[-1]["tool_rounds"]) == 2
+
+
+def test_process_stream_reports_model_failure(service):
+    service.anthropic_client = FakeAnthropic(RuntimeError("overloaded"))
+
+    assert stream_events(process(service, stream=True)) == [{"type": "error", "error": "overloaded"}]
+
+
+# ============================================================================
+# PROMPT CACHING
+# ============================================================================
+
+def breakpoints(request):
+    """Number of cache breakpoints in a messages.create request"""
+    blocks = list(request["system"])
+    for msg in request["messages"]:
+        if not isinstance(msg["content"], str):
+            blocks += [block for block in msg["content"] if isinstance(block, dict)]
+    return sum(1 for block in blocks if "cache_control" in block)
+
+
+def test_cache_breakpoint_ends_earlier_history():
+    history = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}]
+    latest = {"role": "user", "content": [{"type": "text", "text": "c"}]}
+    messages = history + [latest]
+
+    marked = local_service.cache_breakpoints(messages, len(history))
+
+    assert marked[1]["content"] == [{"type": "text", "text": "b", "cache_control": {"type": "ephemeral"}}]
+    assert marked[0] == history[0]
+    assert marked[2] == latest
+    # The caller's messages are left as they were
+    assert messages[1]["content"] == "b"
+
+
+def test_cache_breakpoint_on_latest_tool_results():
+    tool_use = reply(tool_uses=[("t1", "echo", {"q": 1})]).content
+    messages = [
+        {"role": "user", "content": "question"},
+        {"role": "assistant", "content": tool_use},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "{}"}]}
+    ]
+
+    marked = local_service.cache_breakpoints(messages, 0)
+
+    assert marked[:2] == messages[:2]
+    assert marked[2]["content"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_with_breakpoint_dumps_sdk_blocks_and_skips_empty_text():
+    tool_use = reply("thinking", tool_uses=[("t1", "echo", {"q": 1})]).content
+
+    marked = local_service.with_breakpoint({"role": "assistant", "content": tool_use})
+
+    assert marked["content"][0] == {"type": "text", "text": "thinking"}
+    assert marked["content"][1] == {"type": "tool_use", "id": "t1", "name": "echo", "input": {"q": 1},
+                                    "cache_control": {"type": "ephemeral"}}
+    empty = {"role": "assistant", "content": ""}
+    assert local_service.with_breakpoint(empty) is empty
+
+
+def test_process_stays_within_four_breakpoints(service):
+    service.anthropic_client = FakeAnthropic(
+        reply(tool_uses=[("t1", "echo", {})]),
+        reply(tool_uses=[("t2", "echo", {})]),
+        reply("done")
+    )
+    history = [{"role": "user", "content": "earlier"}, {"role": "assistant", "content": "reply"}]
+
+    process(service, "now", conversation_history=history, conversation_summary="summary")
+
+    calls = service.anthropic_client.calls
+    assert [breakpoints(call) for call in calls] == [3, 4, 4]
+    system = calls[0]["system"]
+    assert system[0]["text"] == service.SYSTEM_INSTRUCTIONS
+    assert "summary" in system[1]["text"]
+    assert all(block["cache_control"] == {"type": "ephemeral"} for block in system)
+    # The timestamp goes last, on the new message, outside every cached prefix
+    latest = calls[0]["messages"][2]["content"]
+    assert latest[1]["text"].startswith("(Sent ")
+    assert "cache_control" not in latest[-1]
+
+
+def test_process_sums_cache_usage_over_rounds(service):
+    usage = {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": 100, "cache_creation_input_tokens": 20}
+    service.anthropic_client = FakeAnthropic(reply(tool_uses=[("t1", "echo", {})], usage=usage), reply("done", usage=usage))
+
+    response = process(service)
+
+    assert response.json["usage"] == {"input_tokens": 20, "output_tokens": 10,
+                                      "cache_read_input_tokens": 200, "cache_creation_input_tokens": 40}
+    assert response.json["tool_rounds"][0]["cache_read_input_tokens"] == 100
+
+
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+
+def in_thread(target, *args):
+    """Start target on a thread; the returned dict gets its result or exception"""
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = target(*args)
+        except Exception as e:
+            outcome["error"] = e
+    outcome["thread"] = threading.Thread(target=run)
+    outcome["thread"].start()
+    return outcome
+
+
+def test_gate_sheds_when_queue_is_full_or_wait_runs_out():
+    gate = local_service.RequestGate(concurrency=1, queue_depth=1, queue_timeout=0.3)
+    gate.acquire()
+    waiting = in_thread(gate.acquire)
+    wait_for(lambda: gate.snapshot()["queued"] == 1)
+
+    with pytest.raises(local_service.Overloaded) as full:
+        gate.acquire()
+    waiting["thread"].join(5)
+
+    assert full.value.status == 429
+    # Nothing has completed yet, so a request is assumed to take 10s
+    assert full.value.retry_after == 20
+    assert waiting["error"].status == 503
+    snapshot = gate.snapshot()
+    assert snapshot["rejected_queue_full"] == 1
+    assert snapshot["rejected_queue_timeout"] == 1
+    assert snapshot["queued"] == 0
+    assert snapshot["in_flight"] == 1
+
+
+def test_gate_hands_slots_to_waiters_in_order():
+    gate = local_service.RequestGate(concurrency=1, queue_depth=2, queue_timeout=5)
+    admitted_at = gate.acquire()
+    first = in_thread(gate.acquire)
+    wait_for(lambda: gate.snapshot()["queued"] == 1)
+    second = in_thread(gate.acquire)
+    wait_for(lambda: gate.snapshot()["queued"] == 2)
+
+    gate.release(admitted_at)
+    first["thread"].join(5)
+    assert "result" in first
+    assert second["thread"].is_alive()
+    assert gate.snapshot()["in_flight"] == 1
+
+    gate.release(first["result"])
+    second["thread"].join(5)
+    gate.release(second["result"])
+    snapshot = gate.snapshot()
+    assert snapshot["in_flight"] == 0
+    assert snapshot["admitted"] == 3
+    assert snapshot["completed"] == 3
+
+
+def slow_process(service, monkeypatch, gate):
+    """Serve /process under gate, with the model holding each request until released"""
+    monkeypatch.setattr(service, "request_gate", gate)
+    release = threading.Event()
+
+    def answer(kwargs):
+        release.wait(5)
+        return reply("done")
+    service.anthropic_client = FakeAnthropic(answer, answer)
+    busy = in_thread(process, service)
+    wait_for(lambda: gate.snapshot()["in_flight"] == 1)
+    return busy, release
+
+
+def test_process_answers_429_when_queue_is_full(service, monkeypatch):
+    gate = local_service.RequestGate(concurrency=1, queue_depth=0, queue_timeout=5)
+    busy, release = slow_process(service, monkeypatch, gate)
+
+    response = process(service)
+    release.set()
+    busy["thread"].join(5)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == str(response.json["retry_after"])
+    assert response.json["success"] is False
+    assert busy["result"].json["response"] == "done"
+    # The server closes the response once it is sent, which frees the slot
+    busy["result"].close()
+    assert gate.snapshot()["in_flight"] == 0
+
+
+def test_process_answers_503_when_queue_wait_runs_out(service, monkeypatch):
+    gate = local_service.RequestGate(concurrency=1, queue_depth=1, queue_timeout=0.2)
+    busy, release = slow_process(service, monkeypatch, gate)
+
+    response = process(service)
+    release.set()
+    busy["thread"].join(5)
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert gate.snapshot()["rejected_queue_timeout"] == 1
+
+
+def test_streamed_process_holds_slot_until_closed(service):
+    service.anthropic_client = FakeAnthropic(reply("streamed"))
+
+    response = process(service, stream=True)
+    assert service.request_gate.snapshot()["in_flight"] == 1
+    assert stream_events(response)[-1]["type"] == "done"
+    response.close()
+
+    assert service.request_gate.snapshot()["in_flight"] == 0
+
+
+def test_process_checks_auth_before_taking_a_slot(service):
+    client = service.app.test_client()
+
+    missing = client.post("/process", json={"user_id": "alice", "message": "hi"})
+    wrong = client.post("/process", json={"user_id": "alice", "message": "hi"}, headers={"Authorization": "Bearer nope"})
+
+    assert missing.status_code == 401
+    assert wrong.status_code == 403
+    assert service.request_gate.snapshot()["admitted"] == 0
@@ -0,0 +1,714 @@
+"""Memory server tool tests, run against the in-process Firestore fake or the emulator"""
+
+import asyncio
+import math
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import run
+
+
+def entity_data(memory, user_id, name):
+    snapshot = run(memory.entity_document(user_id, name).get())
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+# ============================================================================
+# ENTITIES
+# ============================================================================
+
+def test_create_entities_writes_every_entity(memory, user_id):
+    result = run(memory.create_entities({
+        "user_id": user_id,
+        "interface": "terminal",
+        "entities": [
+            {"name": "Dark Mode", "entityType": "preference", "observations": ["prefers dark mode in every editor"]},
+            {"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM", "token rotated"]}
+        ]
+    }))
+
+    assert result["success"]
+    assert [entity["status"] for entity in result["created_entities"]] == ["created", "created"]
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert memory.entity_document(user_id, "Airtable").path == f"users/{user_id}/entities/entity_airtable"
+    assert airtable["entity_type"] == "service"
+    assert airtable["observation_count"] == 2
+    assert [obs["content"] for obs in airtable["observations"]] == ["synced with the CRM", "token rotated"]
+
+
+def test_create_entities_commits_in_one_batch(memory, user_id, fake_only):
+    run(memory.create_entities({
+        "user_id": user_id,
+        "interface": "terminal",
+        "entities": [{"name": f"Project {i}", "entityType": "project", "observations": [f"milestone {i}"]} for i in range(20)]
+    }))
+
+    # Entities, context snapshot and postings go through one WriteBatch
+    # (the snapshot backfill for a first write is a second commit)
+    assert memory.db.commits == 2
+    assert len([path for path in memory.db.documents if path.startswith(f"users/{user_id}/entities/")]) == 20
+
+
+def test_create_entities_appends_to_existing_entity(memory, user_id):
+    params = {"user_id": user_id, "interface": "terminal",
+              "entities": [{"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]}]}
+    run(memory.create_entities(params))
+    result = run(memory.create_entities({**params, "interface": "whatsapp",
+                                         "entities": [{"name": "Airtable", "entityType": "service", "observations": ["webhook added"]}]}))
+
+    assert result["created_entities"][0]["status"] == "updated"
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert airtable["observation_count"] == 2
+    assert [obs["learned_from_interface"] for obs in airtable["observations"]] == ["terminal", "whatsapp"]
+
+
+def test_add_observations(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]}]}))
+    result = run(memory.add_observations({
+        "user_id": user_id,
+        "interface": "whatsapp",
+        "observations": [
+            {"entityName": "Airtable", "contents": ["webhook added", "rate limited at night"]},
+            {"entityName": "Unknown", "contents": ["ignored"]}
+        ]
+    }))
+
+    assert [entity["status"] for entity in result["updated_entities"]] == ["updated", "not_found"]
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert airtable["observation_count"] == 3
+    assert airtable["latest_observation"]["content"] == "rate limited at night"
+    assert entity_data(memory, user_id, "Unknown") is None
+
+
+# ============================================================================
+# SEARCH INDEX
+# ============================================================================
+
+def search(memory, user_id, query, **params):
+    return run(memory.search_memory({"user_id": user_id, "query": query, **params}))["results"]
+
+
+def test_search_finds_created_entities(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal", "entities": [
+        {"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]},
+        {"name": "Dark Mode", "entityType": "preference", "observations": ["prefers dark mode in every editor"]}
+    ]}))
+
+    result = search(memory, user_id, "crm sync", search_type="entities")
+
+    assert [entity["name"] for entity in result["entities"]] == ["Airtable"]
+    assert result["entities"][0]["score"] > 0
+    assert search(memory, user_id, "crm", search_type="entities", interface_filter="whatsapp")["entities"] == []
+
+
+def test_postings_are_one_document_each(memory, user_id, fake_only):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]}]}))
+
+    posting = memory.postings_ref(memory.search_index_ref(user_id), "crm").document(
+        memory.posting_id(memory.entity_document(user_id, "Airtable").path))
+    assert memory.db.documents[posting.path]["tf"] == 1
+    assert f"users/{user_id}/search_index/crm" not in memory.db.documents
+
+
+def test_common_token_outgrows_one_document(memory, user_id, monkeypatch):
+    monkeypatch.setattr(memory, "SEARCH_MAX_POSTINGS", 50)
+    # Enough postings for "shared" to break a single token document's limits
+    for start in range(0, 1200, 400):
+        run(memory.create_entities({"user_id": user_id, "interface": "terminal", "entities": [
+            {"name": f"Project {i}", "entityType": "project", "observations": [f"shared {'unique ' * (i % 7)}milestone {i}"]}
+            for i in range(start, start + 400)
+        ]}))
+
+    postings_by_kind, stats = run(memory.load_postings(user_id, ["shared", "milestone", "absent"], ["entity"]))
+    postings_by_token = postings_by_kind["entity"]
+
+    assert len(postings_by_token["shared"]) == 50
+    assert stats["df"]["shared"] == 1200
+    assert "absent" not in postings_by_token
+    assert len(search(memory, user_id, "shared milestone 7", search_type="entities", max_results=5)["entities"]) == 5
+
+
+def test_common_messages_do_not_crowd_out_entities(memory, user_id, monkeypatch):
+    monkeypatch.setattr(memory, "SEARCH_MAX_POSTINGS", 50)
+    for start in range(0, 1000, 250):
+        sync(memory, user_id, [{"role": "user", "content": f"kubernetes kubernetes rollout {i}"} for i in range(start, start + 250)],
+             conversation_id=f"conv-{start}")
+    run(memory.create_entities({"user_id": user_id, "interface": "whatsapp", "entities": [
+        {"name": "Cluster", "entityType": "service", "observations": ["runs kubernetes"]}
+    ]}))
+
+    assert [entity["name"] for entity in search(memory, user_id, "kubernetes", search_type="entities")["entities"]] == ["Cluster"]
+    result = search(memory, user_id, "kubernetes", interface_filter="whatsapp")
+    assert [entity["name"] for entity in result["entities"]] == ["Cluster"]
+    assert result["messages"] == []
+
+
+def test_search_finds_entities_created_by_index_js(memory, user_id):
+    index_js_create(memory, user_id, "Stripe", ["handles billing for the shop"])
+
+    result = search(memory, user_id, "billing", search_type="entities")
+
+    assert [entity["name"] for entity in result["entities"]] == ["Stripe"]
+    assert result["entities"][0]["score"] is None
+    assert search(memory, user_id, "payroll", search_type="entities")["entities"] == []
+
+
+def test_rebuild_keeps_live_postings_and_drops_stale_ones(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal", "entities": [
+        {"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]},
+        {"name": "Legacy CRM", "entityType": "service", "observations": ["retired last year"]}
+    ]}))
+    run(memory.entity_document(user_id, "Legacy CRM").delete())
+
+    result = run(memory.rebuild_search_index(user_id))
+
+    assert result["documents_indexed"] == 1
+    assert result["postings_deleted"] > 0
+    assert [entity["name"] for entity in search(memory, user_id, "crm", search_type="entities")["entities"]] == ["Airtable"]
+    postings_by_kind, stats = run(memory.load_postings(user_id, ["crm", "retired"], ["entity"]))
+    assert list(postings_by_kind["entity"]) == ["crm"]
+    assert stats["documents"] == 1
+
+
+def test_rebuild_migrates_inline_token_documents(memory, user_id, fake_only):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["synced with the CRM"]}]}))
+    legacy = memory.search_index_ref(user_id).document("crm")
+    run(legacy.set({"token": "crm", "postings": {"users/x/entities/y": {"kind": "entity", "tf": 1}}}))
+
+    run(memory.rebuild_search_index(user_id))
+
+    assert legacy.path not in memory.db.documents
+    assert [entity["name"] for entity in search(memory, user_id, "crm", search_type="entities")["entities"]] == ["Airtable"]
+
+
+def test_long_sync_sharing_a_token(memory, user_id):
+    result = run(memory.sync_conversation_state({
+        "user_id": user_id,
+        "interface": "terminal",
+        "conversation_id": "conv-1",
+        "context_summary": "deploy review",
+        "messages": [{"role": "user", "content": f"deploy step {i}"} for i in range(300)]
+    }))
+
+    assert result["success"]
+    postings_by_kind, stats = run(memory.load_postings(user_id, ["deploy"], ["message"]))
+    assert stats["df"]["deploy"] == 300
+    assert stats["documents"] == 300
+
+
+def test_appended_text_extends_postings(memory, user_id, fake_only):
+    params = {"user_id": user_id, "interface": "terminal",
+              "entities": [{"name": "Airtable", "entityType": "service", "observations": ["crm sync"]}]}
+    run(memory.create_entities(params))
+    run(memory.add_observations({"user_id": user_id, "interface": "whatsapp",
+                                 "observations": [{"entityName": "Airtable", "contents": ["crm webhook"]}]}))
+
+    posting = memory.postings_ref(memory.search_index_ref(user_id), "crm").document(
+        memory.posting_id(memory.entity_document(user_id, "Airtable").path))
+    assert memory.db.documents[posting.path]["tf"] == 2
+    assert memory.db.documents[posting.path]["interfaces"] == ["terminal", "whatsapp"]
+
+
+def exhaustive_bm25(memory, postings_by_token, stats, k):
+    """Score every document against every term, for comparison with MaxScore"""
+    num_docs = max(stats["documents"], max(stats["df"].values()))
+    avg_length = stats["total_length"] / num_docs
+    scores = {}
+    for token, postings in postings_by_token.items():
+        df = stats["df"][token]
+        idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+        for path, posting in postings.items():
+            norm = 1 - memory.BM25_B + memory.BM25_B * posting["dl"] / avg_length
+            scores[path] = scores.get(path, 0.0) + idf * posting["tf"] * (memory.BM25_K1 + 1) / (posting["tf"] + memory.BM25_K1 * norm)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def test_maxscore_matches_exhaustive_top_k(memory):
+    rng = random.Random(7)
+    postings_by_token = {}
+    for token, df in [("rare", 3), ("uncommon", 40), ("common", 400), ("everywhere", 900)]:
+        postings_by_token[token] = {
+            f"doc/{i}": {"path": f"doc/{i}", "tf": rng.randint(1, 6), "dl": rng.randint(5, 80)}
+            for i in rng.sample(range(1000), df)
+        }
+    stats = {"documents": 1000, "total_length": 40000, "df": {token: len(p) for token, p in postings_by_token.items()}}
+
+    for k in (1, 5, 25):
+        top = memory.bm25_top_k(postings_by_token, stats, k)
+        expected = exhaustive_bm25(memory, postings_by_token, stats, k)
+        assert [hit["score"] for hit in top] == [round(score, 4) for _, score in expected]
+        # Documents tied with the k-th score may be picked either way
+        cutoff = round(expected[-1][1], 4)
+        assert [hit["path"] for hit in top if hit["score"] > cutoff] == [path for path, score in expected if round(score, 4) > cutoff]
+
+
+def test_bm25_ranks_rarer_and_denser_matches_first(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal", "entities": [
+        {"name": "Billing", "entityType": "service", "observations": ["invoices invoices invoices every month"]},
+        {"name": "Accounting", "entityType": "service", "observations": ["sends invoices once a quarter with a long note about taxes"]},
+        {"name": "Support", "entityType": "service", "observations": ["answers tickets every month"]}
+    ]}))
+
+    result = search(memory, user_id, "invoices", search_type="entities")["entities"]
+
+    assert [entity["name"] for entity in result] == ["Billing", "Accounting"]
+    assert result[0]["score"] > result[1]["score"] > 0
+    strong = search(memory, user_id, "invoices", search_type="entities", min_score=(result[0]["score"] + result[1]["score"]) / 2)
+    assert [entity["name"] for entity in strong["entities"]] == ["Billing"]
+
+
+# ============================================================================
+# OBSERVATION STORAGE
+# ============================================================================
+
+def test_identical_observations_are_kept_apart(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["retry", "retry"]}]}))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert airtable["observation_count"] == 2
+    assert [obs["content"] for obs in airtable["observations"]] == ["retry", "retry"]
+
+
+def test_overflow_keeps_identical_observations(memory, user_id, monkeypatch):
+    monkeypatch.setattr(memory, "OBSERVATION_INLINE_LIMIT", 3)
+    params = {"user_id": user_id, "interface": "terminal",
+              "entities": [{"name": "Airtable", "entityType": "service", "observations": ["retry"] * 3}]}
+    run(memory.create_entities(params))
+    run(memory.create_entities(params))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    entity_ref = memory.entity_document(user_id, "Airtable")
+    assert airtable["observations_overflow"]
+    assert airtable["observation_count"] == 6
+    assert len(run(memory.load_observations(entity_ref, airtable))) == 6
+
+
+def test_stray_inline_observations_are_read_and_swept(memory, user_id, monkeypatch):
+    monkeypatch.setattr(memory, "OBSERVATION_INLINE_LIMIT", 2)
+    params = {"user_id": user_id, "interface": "terminal",
+              "entities": [{"name": "Airtable", "entityType": "service", "observations": ["first"]}]}
+    run(memory.create_entities(params))
+    entity_ref = memory.entity_document(user_id, "Airtable")
+    stale_view = entity_data(memory, user_id, "Airtable")
+    run(memory.add_observations({"user_id": user_id, "interface": "terminal",
+                                 "observations": [{"entityName": "Airtable", "contents": ["second", "third"]}]}))
+    assert entity_data(memory, user_id, "Airtable")["observations_overflow"]
+
+    # A writer still holding the pre-overflow view appends inline
+    stray = {"observation_id": "stray", "content": "fourth", "learned_at": memory.datetime.utcnow(),
+             "learned_from_interface": "whatsapp", "conversation_id": None}
+    run(memory.commit_batched(memory.append_observation_writes(entity_ref, stale_view, [stray], 1, memory.datetime.utcnow())))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    observations = [obs["content"] for obs in run(memory.load_observations(entity_ref, airtable))]
+    # "second" and "third" share a timestamp, so only their neighbours are ordered
+    assert observations[0] == "first" and observations[-1] == "fourth" and sorted(observations[1:3]) == ["second", "third"]
+
+    run(memory.overflow_if_needed(entity_ref, airtable))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert "observations" not in airtable
+    assert airtable["observation_count"] == 4
+    observations = [obs["content"] for obs in run(memory.load_observations(entity_ref, airtable))]
+    # "second" and "third" share a timestamp, so only their neighbours are ordered
+    assert observations[0] == "first" and observations[-1] == "fourth" and sorted(observations[1:3]) == ["second", "third"]
+
+
+# ============================================================================
+# CONTEXT
+# ============================================================================
+
+def sync(memory, user_id, messages, **params):
+    return run(memory.sync_conversation_state({"user_id": user_id, "interface": "terminal",
+                                               "conversation_id": "conv-1", "messages": messages, **params}))
+
+
+def context(memory, user_id):
+    return run(memory.get_unified_context({"user_id": user_id, "current_interface": "terminal"}))
+
+
+def test_first_sync_builds_the_snapshot(memory, user_id):
+    result = sync(memory, user_id, [{"role": "user", "content": "hello"}])
+
+    assert result["success"]
+    assert run(memory.context_snapshot_ref(user_id).get()).exists
+    assert [msg["content"] for msg in context(memory, user_id)["recent_messages"]] == ["hello"]
+
+
+def test_context_sees_messages_appended_by_index_js(memory, user_id):
+    sync(memory, user_id, [{"role": "user", "content": "hello"}])
+    window_ref = memory.db.collection("users").document(user_id).collection("context_windows").document("window_latest")
+    run(window_ref.set({"recent_messages": memory.firestore.ArrayUnion([
+        {"role": "assistant", "content": "from whatsapp", "interface": "whatsapp", "timestamp": "2026-01-01T00:00:00"}
+    ])}, merge=True))
+    # The listener would do this when the window changes
+    memory.document_cache.invalidate(window_ref.path)
+
+    assert [msg["content"] for msg in context(memory, user_id)["recent_messages"]] == ["hello", "from whatsapp"]
+
+
+def test_context_sees_profile_edits(memory, user_id):
+    sync(memory, user_id, [{"role": "user", "content": "hello"}], context_summary="onboarding")
+    assert context(memory, user_id)["context_summary"] == "onboarding"
+    user_ref = memory.db.collection("users").document(user_id)
+    run(user_ref.set({"preferences": {"theme": "dark"}, "active_projects": ["memory"]}, merge=True))
+    memory.document_cache.invalidate(user_ref.path)
+
+    result = context(memory, user_id)
+
+    assert result["user_preferences"] == {"theme": "dark"}
+    assert result["active_projects"] == ["memory"]
+    assert result["context_summary"] == "onboarding"
+
+
+def test_context_sees_entities_created_by_index_js(memory, user_id):
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["x"]}]}))
+    assert [entity["name"] for entity in context(memory, user_id)["relevant_entities"]] == ["Airtable"]
+    index_js_create(memory, user_id, "Stripe", ["handles billing"])
+    # The listener would do this when the entity is written
+    memory.document_cache.invalidate(f"users/{user_id}/entities")
+
+    entities = context(memory, user_id)["relevant_entities"]
+
+    assert [entity["name"] for entity in entities] == ["Stripe", "Airtable"]
+    assert entities[0]["recent_observation"]["content"] == "handles billing"
+
+
+def stored_messages(memory, user_id, conversation_id="conv-1"):
+    messages_ref = memory.db.collection("users").document(user_id).collection("conversations").document(conversation_id).collection("messages")
+    return run(messages_ref.get())
+
+
+def test_resent_messages_are_deduplicated(memory, user_id):
+    first = [{"role": "user", "content": "hi", "timestamp": "2026-01-01T00:00:00"},
+             {"role": "assistant", "content": "ok"},
+             {"role": "assistant", "content": "ok"}]
+
+    result = sync(memory, user_id, first)
+    assert (result["messages_saved"], result["messages_deduplicated"]) == (3, 0)
+
+    result = sync(memory, user_id, first + [{"role": "user", "content": "thanks"}])
+    assert (result["messages_saved"], result["messages_deduplicated"]) == (1, 3)
+
+    assert len(stored_messages(memory, user_id)) == 4
+    conversation = run(memory.db.collection("users").document(user_id).collection("conversations").document("conv-1").get())
+    assert conversation.to_dict()["metadata"]["total_messages"] == 4
+    assert [msg["content"] for msg in context(memory, user_id)["recent_messages"]] == ["hi", "ok", "ok", "thanks"]
+
+
+def window_contents(memory, window_ref):
+    window = run(window_ref.get()).to_dict()
+    return [msg["content"] for msg in memory.window_messages(window)], window
+
+
+def test_ring_buffer_wraps_and_resizes(memory, user_id):
+    window_ref = memory.db.collection("users").document(user_id).collection("context_windows").document("window_latest")
+    now = memory.datetime.utcnow()
+
+    def append(contents, capacity=None):
+        messages = [{"role": "user", "content": content} for content in contents]
+        view = run(memory.append_context_window(window_ref, messages, now, capacity=capacity))
+        contents, window = window_contents(memory, window_ref)
+        assert [msg["content"] for msg in memory.window_messages(view)] == contents
+        return contents, window
+
+    append(["m0", "m1"], capacity=3)
+    contents, window = append(["m2", "m3", "m4"])
+    assert contents == ["m2", "m3", "m4"]
+    assert (window["head"], len(window["slots"])) == (5, 3)
+    assert window["slots"]["0"]["content"] == "m3"
+
+    # Growing keeps what is there and makes room for more
+    contents, window = append(["m5"], capacity=5)
+    assert contents == ["m2", "m3", "m4", "m5"]
+    contents, window = append(["m6", "m7"])
+    assert contents == ["m3", "m4", "m5", "m6", "m7"]
+
+    # Shrinking keeps the newest
+    contents, window = append(["m8"], capacity=2)
+    assert contents == ["m7", "m8"]
+    assert (window["capacity"], len(window["slots"]), window["head"]) == (2, 2, 9)
+
+
+def test_legacy_recent_messages_fold_into_the_ring(memory, user_id):
+    window_ref = memory.db.collection("users").document(user_id).collection("context_windows").document("window_latest")
+    run(window_ref.set({"recent_messages": [{"role": "user", "content": f"old {i}"} for i in range(3)]}))
+
+    run(memory.append_context_window(window_ref, [{"role": "user", "content": "new"}], memory.datetime.utcnow(), capacity=3))
+
+    contents, window = window_contents(memory, window_ref)
+    assert contents == ["old 1", "old 2", "new"]
+    assert "recent_messages" not in window
+
+
+def test_recent_search_pages_with_page_token(memory, user_id):
+    for conversation in ("conv-a", "conv-b"):
+        sync(memory, user_id, [{"role": "user", "content": f"{conversation} deploy {i}" if i % 2 else f"{conversation} chat {i}"}
+                               for i in range(12)], conversation_id=conversation)
+    expected = [f"{conversation} deploy {i}" for conversation in ("conv-b", "conv-a") for i in (11, 9, 7, 5, 3, 1)]
+
+    pages = []
+    page_token = None
+    while True:
+        response = run(memory.search_memory({"user_id": user_id, "query": "deploy", "search_type": "messages",
+                                             "order": "recent", "max_results": 5, "page_token": page_token}))
+        pages.append([msg["content"] for msg in response["results"]["messages"]])
+        page_token = response["page_token"]
+        if page_token is None:
+            break
+
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert [content for page in pages for content in page] == expected
+
+
+def test_recent_search_stops_scanning_a_rare_query(memory, user_id, monkeypatch):
+    monkeypatch.setattr(memory, "RECENT_SCAN_PAGES", 2)
+    sync(memory, user_id, [{"role": "user", "content": "needle"}] + [{"role": "user", "content": f"hay {i}"} for i in range(20)])
+
+    params = {"user_id": user_id, "query": "needle", "search_type": "messages", "order": "recent", "max_results": 3}
+    first = run(memory.search_memory(params))
+    assert first["results"]["messages"] == []
+    assert first["page_token"] is not None
+
+    found = []
+    page_token = first["page_token"]
+    while page_token is not None:
+        response = run(memory.search_memory({**params, "page_token": page_token}))
+        found.extend(msg["content"] for msg in response["results"]["messages"])
+        page_token = response["page_token"]
+    assert found == ["needle"]
+
+    with pytest.raises(ValueError):
+        run(memory.search_memory({**params, "page_token": "bm90LWEtcGF0aA=="}))
+
+
+def slowed(function, seconds):
+    async def slow(*args, **kwargs):
+        await asyncio.sleep(seconds)
+        return await function(*args, **kwargs)
+    return slow
+
+
+def test_budget_returns_what_arrived_in_time(memory, user_id, monkeypatch):
+    user_ref = memory.db.collection("users").document(user_id)
+    run(user_ref.set({"preferences": {"theme": "dark"}}))
+    # No snapshot yet, and the snapshot and context window reads are slow
+    monkeypatch.setattr(memory, "cached_get_all", slowed(memory.cached_get_all, 0.5))
+
+    started = time.monotonic()
+    result = run(memory.get_unified_context({"user_id": user_id, "current_interface": "terminal", "latency_budget_ms": 100}))
+
+    assert time.monotonic() - started < 0.4
+    assert result["success"]
+    assert result["partial_sections"] == ["recent_messages"]
+    assert result["recent_messages"] == []
+    assert result["user_preferences"] == {"theme": "dark"}
+
+
+def test_budget_applies_to_the_snapshot_path(memory, user_id, monkeypatch):
+    sync(memory, user_id, [{"role": "user", "content": "hello"}])
+    monkeypatch.setattr(memory, "recent_entities", slowed(memory.recent_entities, 0.5))
+
+    result = run(memory.get_unified_context({"user_id": user_id, "current_interface": "terminal", "latency_budget_ms": 100}))
+
+    assert result["partial_sections"] == ["relevant_entities"]
+    assert [msg["content"] for msg in result["recent_messages"]] == ["hello"]
+    assert context(memory, user_id)["partial_sections"] == []
+
+
+# ============================================================================
+# SEMANTIC INDEX
+# ============================================================================
+
+def test_vector_index_survives_concurrent_searches(memory, user_id):
+    from concurrent.futures import ThreadPoolExecutor
+
+    writer = memory.VectorIndex(user_id, memory.vector_index(user_id).embedder)
+    reader = memory.vector_index(user_id)
+    entity_ref = memory.entity_document(user_id, "Airtable")
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        for batch in range(10):
+            writer.add([memory.entity_posting(entity_ref, f"crm sync note {batch} {i}", "terminal", 4, new=True) for i in range(20)])
+            searches = [pool.submit(reader.search, "crm sync", 5, "terminal" if i % 2 else "all") for i in range(32)]
+            assert all(future.result() for future in searches)
+            assert len(reader.rows) == (batch + 1) * 20
+
+
+# ============================================================================
+# DOCUMENT CACHE
+# ============================================================================
+
+def test_document_cache_bounds_and_expiry(memory):
+    cache = memory.DocumentCache(max_entries=2, max_bytes=10_000, ttl_seconds=60)
+    cache.put("users/a", {"n": 1})
+    cache.put("users/b", None)
+    assert cache.get("users/a") == (True, {"n": 1})
+    # "users/b" is now least recently used
+    cache.put("users/c", {"n": 3})
+
+    assert cache.get("users/b") == (False, None)
+    assert cache.get("users/c") == (True, {"n": 3})
+    assert cache.stats()["evictions"] == 1
+
+    cache.put("users/big", {"text": "x" * 20_000})
+    assert cache.get("users/big") == (False, None)
+
+    expired = memory.DocumentCache(max_entries=10, max_bytes=10_000, ttl_seconds=0)
+    expired.put("users/a", {"n": 1})
+    assert expired.get("users/a") == (False, None)
+
+
+def test_cache_serves_repeat_reads_until_invalidated(memory, user_id, fake_only):
+    user_ref = memory.db.collection("users").document(user_id)
+    run(user_ref.set({"preferences": {"theme": "light"}}))
+
+    assert run(memory.cached_get(user_ref)).to_dict()["preferences"] == {"theme": "light"}
+    reads = memory.db.reads
+    run(user_ref.set({"preferences": {"theme": "dark"}}))
+    assert run(memory.cached_get(user_ref)).to_dict()["preferences"] == {"theme": "light"}
+    assert memory.db.reads == reads
+
+    memory.document_cache.invalidate(user_ref.path)
+    assert run(memory.cached_get(user_ref)).to_dict()["preferences"] == {"theme": "dark"}
+    assert memory.db.reads == reads + 1
+
+
+def test_listener_changes_update_the_cache(memory, user_id, fake_only):
+    entity_ref = memory.entity_document(user_id, "Airtable")
+    entities_path = f"users/{user_id}/entities"
+    memory.document_cache.put(entities_path, {})
+
+    def change(kind, data):
+        document = SimpleNamespace(reference=entity_ref, to_dict=lambda: data)
+        return SimpleNamespace(type=SimpleNamespace(name=kind), document=document)
+
+    memory._on_cache_snapshot([], [change("ADDED", {"name": "Airtable"})], None)
+    reads = memory.db.reads
+    assert run(memory.cached_get(entity_ref)).to_dict() == {"name": "Airtable"}
+    assert memory.db.reads == reads
+    # The cached recent-entities query result is dropped with it
+    assert memory.document_cache.get(entities_path) == (False, None)
+
+    memory._on_cache_snapshot([], [change("REMOVED", None)], None)
+    assert not run(memory.cached_get(entity_ref)).exists
+    assert memory.db.reads == reads + 1
+
+
+def index_js_create(memory, user_id, name, observations):
+    """Write an entity the way index.js create_unified_entities does"""
+    entity_ref = memory.entity_document(user_id, name)
+    run(entity_ref.set({
+        "entity_id": entity_ref.id,
+        "name": name,
+        "entity_type": "service",
+        "observations": [{"content": obs, "learned_at": "2026-01-01T00:00:00.000Z", "learned_from_interface": "whatsapp"}
+                         for obs in observations],
+        "metadata": {"created_at": memory.datetime.utcnow(), "updated_at": memory.datetime.utcnow()}
+    }))
+    return entity_ref
+
+
+def test_writes_ignore_a_cached_miss(memory, user_id):
+    # Caches "Airtable" as missing
+    result = run(memory.add_observations({"user_id": user_id, "interface": "terminal",
+                                          "observations": [{"entityName": "Airtable", "contents": ["x"]}]}))
+    assert result["updated_entities"][0]["status"] == "not_found"
+    index_js_create(memory, user_id, "Airtable", ["synced with the CRM"])
+
+    result = run(memory.add_observations({"user_id": user_id, "interface": "terminal",
+                                          "observations": [{"entityName": "Airtable", "contents": ["y"]}]}))
+    assert result["updated_entities"][0]["status"] == "updated"
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["z"]}]}))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert [obs["content"] for obs in airtable["observations"]] == ["synced with the CRM", "y", "z"]
+    assert airtable["observation_count"] == 3
+
+
+def test_new_entity_merges_with_a_concurrent_create(memory, user_id, monkeypatch):
+    real_get_all = memory.fresh_get_all
+
+    async def read_then_race(refs):
+        # Another interface creates the entity between our read and our write
+        snapshots = await real_get_all(refs)
+        await memory.entity_document(user_id, "Airtable").set({
+            "name": "Airtable", "observations": [{"content": "synced with the CRM"}], "observation_count": 1, "search_length": 4
+        })
+        return snapshots
+
+    monkeypatch.setattr(memory, "fresh_get_all", read_then_race)
+    run(memory.create_entities({"user_id": user_id, "interface": "terminal",
+                                "entities": [{"name": "Airtable", "entityType": "service", "observations": ["z"]}]}))
+
+    airtable = entity_data(memory, user_id, "Airtable")
+    assert [obs["content"] for obs in airtable["observations"]] == ["synced with the CRM", "z"]
+    assert airtable["observation_count"] == 2
+
+
+# ============================================================================
+# USER RESOLUTION
+# ============================================================================
+
+def map_alias(memory, alias, primary_id):
+    run(memory.db.collection("user_mappings").document(alias).set({"primary_id": primary_id}))
+
+
+def test_resolver_caches_mappings_until_they_expire(memory, user_id, fake_only):
+    map_alias(memory, "+15550001", user_id)
+    resolver = memory.UserResolver(ttl_seconds=0.05)
+
+    reads = memory.db.reads
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert run(resolver.resolve("stranger@example.com")) == "stranger@example.com"
+    assert run(resolver.resolve("stranger@example.com")) == "stranger@example.com"
+    assert memory.db.reads == reads + 2
+
+    time.sleep(0.1)
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert memory.db.reads == reads + 3
+    assert (resolver.hits, resolver.misses) == (2, 3)
+
+
+def test_preloaded_resolver_answers_unknown_ids_without_reads(memory, user_id, fake_only):
+    map_alias(memory, "+15550001", user_id)
+    resolver = memory.UserResolver(ttl_seconds=60)
+    run(resolver.preload())
+
+    reads = memory.db.reads
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert run(resolver.resolve("stranger@example.com")) == "stranger@example.com"
+    assert memory.db.reads == reads
+
+
+def test_listener_events_renew_and_expire_mappings(memory, user_id, fake_only):
+    resolver = memory.UserResolver(ttl_seconds=0.05)
+    resolver._listening = True
+
+    def doc(alias, primary_id):
+        return SimpleNamespace(id=alias, to_dict=lambda: {"primary_id": primary_id})
+
+    resolver._on_snapshot([doc("+15550001", user_id)], [], None)
+    reads = memory.db.reads
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert run(resolver.resolve("stranger@example.com")) == "stranger@example.com"
+    assert memory.db.reads == reads
+
+    removed = SimpleNamespace(type=SimpleNamespace(name="REMOVED"), document=doc("+15550001", None))
+    resolver._on_snapshot([], [removed], None)
+    assert run(resolver.resolve("+15550001")) == "+15550001"
+
+    # Even with the listener on, a mapping it never reported again is re-read
+    map_alias(memory, "+15550001", user_id)
+    time.sleep(0.1)
+    assert run(resolver.resolve("+15550001")) == user_id
+    assert memory.db.reads == reads + 1